@@ -0,0 +1,117 @@
+import threading
+
+import numpy as np
+
+import mvsdk
+from framebuffer import FrameRing
+
+
+def aligned_ring(capacity, height, width, dtype=np.uint8, align=64, pixel_format=None):
+    """FrameRing laid over one CameraAlignMalloc block, each slot starting on an `align`-byte boundary."""
+    slot_nbytes = -(-height * width * np.dtype(dtype).itemsize // align) * align
+    address = mvsdk.CameraAlignMalloc(slot_nbytes * capacity, align)
+    if not address:
+        raise MemoryError(f"CameraAlignMalloc failed for {capacity} frames of {width}x{height}")
+    return FrameRing(capacity, height, width, dtype, address=address, slot_nbytes=slot_nbytes,
+                     release=lambda: mvsdk.CameraAlignFree(address), pixel_format=pixel_format)
+
+
+class PollingAcquisition:
+    """Acquisition thread that pulls frames with CameraGetImageBufferEx3 straight into ring slots.
+
+    Each call blocks inside the SDK (ctypes drops the GIL for it) and has the SDK
+    decode directly into the next slot of an aligned FrameRing, so there is no Python
+    callback and no intermediate copy. A busy GUI thread only delays the short
+    commit step, not the wait for the frame itself.
+    """
+
+    def __init__(self, hCamera, ring, out_format=mvsdk.CAMERA_MEDIA_TYPE_MONO8, timeout_ms=1000):
+        self.hCamera = hCamera
+        self.ring = ring
+        self.out_format = out_format
+        self.timeout_ms = timeout_ms
+        self.frames = 0
+        self.timeouts = 0
+        self.errors = 0
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="PollingAcquisition", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        ring = self.ring
+        expected = (ring.shape[1], ring.shape[0])
+        while self._running:
+            seq, address = ring.claim()
+            try:
+                width, height, timestamp = mvsdk.CameraGetImageBufferEx3(
+                    self.hCamera, address, self.out_format, self.timeout_ms)
+            except mvsdk.CameraException as e:
+                if e.error_code == mvsdk.CAMERA_STATUS_TIME_OUT:
+                    self.timeouts += 1
+                else:
+                    self.errors += 1
+                    print(f"Polling acquisition error: {e}")
+                continue
+            if (width, height) != expected:
+                ring.size_mismatches += 1
+            ring.commit(seq, timestamp & 0xFFFFFFFF)  # Ex3 returns uiTimeStamp as a signed C int
+            self.frames += 1
+
+
+class GrabberAcquisition:
+    """Acquisition through the SDK's CameraGrabber, which buffers frames and counts losses itself.
+
+    The frame listener runs first, on the raw frame, and rejects frames the pipeline
+    does not want (untriggered preview frames, wrong size) so they never reach the
+    copy into the ring. Capture/Lost/Error counts and the capture rate come straight
+    from CameraGrabber_GetStat.
+    """
+
+    def __init__(self, grabber, ring, triggered_only=False):
+        self.grabber = grabber
+        self.hCamera = mvsdk.CameraGrabber_GetCameraHandle(grabber)
+        self.ring = ring
+        self.triggered_only = triggered_only
+        self.filtered = 0
+        mvsdk.CameraGrabber_SetFrameListener(grabber, self.FrameListener, 0)
+        mvsdk.CameraGrabber_SetRawCallback(grabber, self.RawCallback, 0)
+
+    @mvsdk.method(mvsdk.pfnCameraGrabberFrameListener)
+    def FrameListener(self, Grabber, Phase, pFrameBuffer, pFrameHead, Context):
+        # Phase 0 is the raw frame; returning 0 drops it before any further processing
+        if Phase != 0:
+            return 1
+        FrameHead = pFrameHead.contents
+        if (self.triggered_only and not FrameHead.bIsTrigger) or FrameHead.uBytes != self.ring.frame_nbytes:
+            self.filtered += 1
+            return 0
+        return 1
+
+    @mvsdk.method(mvsdk.pfnCameraGrabberFrameCallback)
+    def RawCallback(self, Grabber, pFrameBuffer, pFrameHead, Context):
+        self.ring.write_from_head(pFrameBuffer, pFrameHead)
+
+    def start(self):
+        mvsdk.CameraGrabber_StartLive(self.grabber)
+
+    def stop(self):
+        mvsdk.CameraGrabber_StopLive(self.grabber)
+
+    def stat(self):
+        """Native grabber counters (tSdkGrabberStat: Capture, Lost, Error, CapFps, ...)."""
+        return mvsdk.CameraGrabber_GetStat(self.grabber)
+
+    def close(self):
+        """Stop and destroy the grabber; this also closes the camera it opened."""
+        self.stop()
+        mvsdk.CameraGrabber_Destroy(self.grabber)
@@ -0,0 +1,198 @@
+"""Acquisition benchmarks against the libMVSDK stand-in in fake_mvsdk.py.
+
+Usage: python benchmark.py [width height n_frames]
+"""
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+
+import fake_mvsdk
+
+WIDTH, HEIGHT, N_FRAMES = (int(a) for a in sys.argv[1:4]) if len(sys.argv) >= 4 else (2048, 2048, 2000)
+sdk = fake_mvsdk.install(width=WIDTH, height=HEIGHT, pool_size=8)
+
+import mvsdk  # noqa: E402  (resolved against the stand-in)
+from acquisition import PollingAcquisition, aligned_ring  # noqa: E402
+from framebuffer import FrameRing  # noqa: E402
+from framelease import LeasePool  # noqa: E402
+import pixelformat  # noqa: E402
+
+
+class CallbackTimer:
+    """Wraps a snap callback and accumulates the time spent inside it."""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.total = 0.0
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        self.fn(*args)
+        self.total += time.perf_counter() - start
+
+
+def report(name, n_frames, elapsed, timer, **counters):
+    extra = ", ".join(f"{k}={v}" for k, v in counters.items())
+    print(f"{name:<14} {n_frames / elapsed:10.0f} frames/s  {timer.total / n_frames * 1e6:8.1f} us in callback  {extra}")
+
+
+def bench_copy(n_frames, fps=None):
+    """GrabCallback copy path: memmove into the ring, release the SDK buffer at once."""
+    ring = FrameRing(256, HEIGHT, WIDTH)
+    reader = ring.reader()
+    done = threading.Event()
+
+    def consume():
+        while not done.is_set() or reader.pending():
+            item = reader.read(timeout=0.05)
+            if item is not None:
+                item[1][0, 0]
+
+    def callback(hCamera, pRawData, pFrameHead, pContext):
+        try:
+            ring.write_from_head(pRawData, pFrameHead)
+        finally:
+            mvsdk.CameraReleaseImageBuffer(hCamera, pRawData)
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    timer = CallbackTimer(callback)
+    sdk.callback = mvsdk.CAMERA_SNAP_PROC(timer)
+    lost = sdk.lost
+    start = time.perf_counter()
+    sdk.fire(n_frames, fps)
+    elapsed = time.perf_counter() - start
+    done.set()
+    consumer.join()
+    report(f"copy@{fps or 'max'}", n_frames, elapsed, timer, sdk_lost=sdk.lost - lost, overruns=reader.overruns)
+
+
+def bench_lease(n_frames, fps=None, max_outstanding=6):
+    """Lease path: hand out a view over pRawData, release once the consumer is done."""
+    pool = LeasePool(1, max_outstanding)
+    leases = pool.subscribe("consumer", maxsize=max_outstanding)
+    done = threading.Event()
+    consumed = [0]
+
+    def consume():
+        while not done.is_set() or not leases.empty():
+            try:
+                lease = leases.get(timeout=0.05)
+            except queue.Empty:
+                continue
+            with lease:
+                lease.frame[0, 0]
+            consumed[0] += 1
+
+    def callback(hCamera, pRawData, pFrameHead, pContext):
+        pool.publish(pRawData, pFrameHead.contents.clone())
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    timer = CallbackTimer(callback)
+    sdk.callback = mvsdk.CAMERA_SNAP_PROC(timer)
+    lost = sdk.lost
+    start = time.perf_counter()
+    sdk.fire(n_frames, fps)
+    elapsed = time.perf_counter() - start
+    done.set()
+    consumer.join()
+    drained = time.perf_counter() - start
+    pool.close()
+    # frames/s counts callbacks; leases dropped at the cap never reach the consumer, so compare `delivered`
+    delivered = f"{consumed[0]} ({consumed[0] / drained:.0f}/s)"
+    report(f"lease@{fps or 'max'}", n_frames, elapsed, timer, delivered=delivered, sdk_lost=sdk.lost - lost,
+           lease_dropped=pool.dropped, skipped=pool.skipped["consumer"])
+
+
+def busy_gui(done):
+    """Pure-Python load standing in for a GUI thread that keeps grabbing the GIL."""
+    while not done.is_set():
+        sum(range(2000))
+
+
+def bench_source(mode, n_frames, fps, busy):
+    """Callback vs CameraGetImageBufferEx3 polling: throughput and SDK-to-ring latency."""
+    ring = aligned_ring(64, HEIGHT, WIDTH) if mode == "polling" else FrameRing(64, HEIGHT, WIDTH)
+    reader = ring.reader()
+    offset = len(sdk.frame_times)
+    latencies = []
+    done = threading.Event()
+
+    def drain():
+        while not done.is_set() or reader.pending():
+            item = reader.read(timeout=0.05)
+            if item is not None:
+                seq = item[0]
+                latencies.append(ring.sys_timestamps[seq % ring.capacity] - sdk.frame_times[offset + seq])
+
+    threads = [threading.Thread(target=drain)]
+    if busy:
+        threads.append(threading.Thread(target=busy_gui, args=(done,)))
+    for t in threads:
+        t.start()
+
+    start = time.perf_counter()
+    if mode == "polling":
+        acq = PollingAcquisition(1, ring, timeout_ms=100)
+        acq.start()
+        sdk.expose(n_frames, fps)
+        while acq.frames < n_frames and time.perf_counter() - start < 60:
+            time.sleep(0.001)
+        acq.stop()
+    else:
+        def callback(hCamera, pRawData, pFrameHead, pContext):
+            try:
+                ring.write_from_head(pRawData, pFrameHead)
+            finally:
+                mvsdk.CameraReleaseImageBuffer(hCamera, pRawData)
+        sdk.callback = mvsdk.CAMERA_SNAP_PROC(callback)
+        sdk.fire(n_frames, fps)
+    elapsed = time.perf_counter() - start
+    done.set()
+    for t in threads:
+        t.join()
+    ring.close()
+
+    lat = np.array(latencies) * 1e3
+    name = f"{mode}{'+busy' if busy else ''}@{fps or 'max'}"
+    print(f"{name:<22} {ring.write_seq / elapsed:8.0f} frames/s  latency median {np.median(lat):6.2f} ms"
+          f"  p99 {np.percentile(lat, 99):6.2f} ms  overruns={reader.overruns}")
+
+
+def bench_unpack(names=("MONO8", "MONO12", "MONO10_PACKED", "MONO12_PACKED", "BAYGR10_MIPI"), chunk=16, repeat=20):
+    """Unpack throughput per pixel format, one frame at a time and a chunk per call."""
+    rng = np.random.default_rng(0)
+    for name in names:
+        fmt = pixelformat.from_name(name)
+        stored = rng.integers(0, 256, size=chunk * fmt.frame_nbytes(HEIGHT, WIDTH), dtype=np.uint8)
+        stored = stored.view(fmt.storage_dtype).reshape((chunk,) + fmt.stored_shape(HEIGHT, WIDTH))
+        frame_out = np.empty((HEIGHT, WIDTH), fmt.dtype)
+        chunk_out = np.empty((chunk, HEIGHT, WIDTH), fmt.dtype)
+        out = (frame_out, chunk_out) if fmt.packed else (None, None)
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for frame in stored:
+                fmt.unpack(frame, out[0])
+        per_frame = (time.perf_counter() - start) / (repeat * chunk)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fmt.unpack(stored, out[1])
+        per_chunk = (time.perf_counter() - start) / (repeat * chunk)
+        print(f"unpack {name:<14} {fmt.frame_nbytes(HEIGHT, WIDTH) / 1e6:6.2f} MB/frame  "
+              f"single {1 / per_frame:8.0f} frames/s  chunk of {chunk} {1 / per_chunk:8.0f} frames/s")
+
+
+if __name__ == "__main__":
+    print(f"{WIDTH}x{HEIGHT} mono8, {N_FRAMES} frames")
+    for fps in (None, 500):
+        bench_copy(N_FRAMES, fps)
+        bench_lease(N_FRAMES, fps)
+    for busy in (False, True):
+        for mode in ("callback", "polling"):
+            bench_source(mode, N_FRAMES, 200, busy)
+    bench_unpack()
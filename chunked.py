@@ -0,0 +1,295 @@
+"""Chunked, compressed recordings.
+
+Same layout as a raw recording (see recording.py) except that P.raw is replaced by
+
+    P.chunks          compressed chunks back to back; chunk k holds frames
+                      [k * chunk_frames, (k + 1) * chunk_frames) as one block
+    P_chunks.npy      one CHUNK_DTYPE record per chunk (byte offset and size); while
+                      recording they are appended to P_chunks.bin instead, like
+                      P_frames.bin, so a recording cut short stays readable
+
+and P_recording.yml carries `storage: chunked`, `codec`, `level` and `chunk_frames`.
+Frame i lives in chunk i // chunk_frames at position i % chunk_frames, so seeking
+needs one index lookup and one chunk decompression, never the chunks before it.
+
+zlib and lzma are always available; zstd and lz4 are used when the `zstandard` /
+`lz4` packages are installed. All of them release the GIL while compressing, so a
+thread pool spreads compression across cores.
+"""
+import collections
+import lzma
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from recorder import RawRecorder
+from recording import FRAME_DTYPE, Recording
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+CHUNK_DTYPE = np.dtype([
+    ("offset", np.uint64),  # byte offset of the compressed chunk in P.chunks
+    ("nbytes", np.uint64),  # compressed size
+    ("first_frame", np.int64),
+    ("num_frames", np.int32),
+])
+
+
+def _compressor(codec, level):
+    if codec == "zlib":
+        return lambda data: zlib.compress(data, level)
+    if codec == "lzma":
+        return lambda data: lzma.compress(data, preset=level)
+    if codec == "zstd" and zstandard is not None:
+        # a ZstdCompressor must not be shared between threads, so make one per chunk
+        return lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+    if codec == "lz4" and lz4 is not None:
+        return lambda data: lz4.frame.compress(data, compression_level=level)
+    raise ValueError(f"codec {codec!r} is not available (have: {', '.join(available_codecs())})")
+
+
+def _decompressor(codec):
+    if codec == "zlib":
+        return zlib.decompress
+    if codec == "lzma":
+        return lzma.decompress
+    if codec == "zstd" and zstandard is not None:
+        return lambda data: zstandard.ZstdDecompressor().decompress(data)
+    if codec == "lz4" and lz4 is not None:
+        return lz4.frame.decompress
+    raise ValueError(f"codec {codec!r} is not available (have: {', '.join(available_codecs())})")
+
+
+def available_codecs():
+    codecs = ["zlib", "lzma"]
+    if zstandard is not None:
+        codecs.append("zstd")
+    if lz4 is not None:
+        codecs.append("lz4")
+    return codecs
+
+
+class ChunkedRecorder(RawRecorder):
+    """RawRecorder variant that compresses fixed-size chunks in a thread pool.
+
+    The writer thread copies frames out of the ring into a small pool of staging
+    chunks, hands full chunks to the compression pool and appends finished chunks
+    to P.chunks in order; a chunk's frames are indexed only once it is on disk.
+    Nothing here runs on the acquisition thread. When every
+    staging chunk is waiting on compression the writer has to block (`stalls`), and
+    the ring backlog starts to grow; keeping_up() turns False well before that
+    backlog turns into overruns.
+    """
+
+    SUFFIX = ".chunks"
+
+    def __init__(self, ring, prefix, codec="zlib", level=1, chunk_frames=32, workers=None):
+        super().__init__(ring, prefix, batch_frames=chunk_frames, preallocate_bytes=0)
+        self.codec = codec
+        self.level = level
+        self.chunk_frames = chunk_frames
+        self.workers = workers or os.cpu_count() or 1
+        self._compress = _compressor(codec, level)
+        self._pool = None
+        self._staging = [np.empty((chunk_frames,) + ring.shape, dtype=ring.frames.dtype)
+                         for _ in range(self.workers * 2)]
+        # header rows and records of the staged frames, indexed when their chunk is written
+        self._staged_heads = [np.empty(chunk_frames, ring.heads.dtype) for _ in self._staging]
+        self._staged_records = [np.empty(chunk_frames, FRAME_DTYPE) for _ in self._staging]
+        self._chunks = []
+        self._chunks_fd = None
+        self._frames_taken = 0
+        self.compressed_bytes = 0
+        self.stalls = 0
+        self.compress_seconds = 0.0
+
+    def start(self):
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="ChunkCompress")
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._chunks_fd = os.open(self.prefix + "_chunks.bin", flags, 0o644)
+        super().start()
+
+    def stop(self):
+        super().stop()
+        if self._pool:
+            self._pool.shutdown()
+            self._pool = None
+        if self._chunks_fd is not None:
+            os.close(self._chunks_fd)
+            self._chunks_fd = None
+            os.remove(self.prefix + "_chunks.bin")  # now in P_chunks.npy
+
+    def _compress_chunk(self, chunk):
+        start = time.perf_counter()
+        data = self._compress(memoryview(chunk).cast("B"))
+        return data, time.perf_counter() - start
+
+    def _write_chunk(self, index, first_frame, num_frames, future):
+        data, seconds = future.result()
+        self.compress_seconds += seconds
+        chunk = (self.compressed_bytes, len(data), first_frame, num_frames)
+        self._write(data)
+        self._chunks.append(chunk)
+        self._write(np.array([chunk], dtype=CHUNK_DTYPE), self._chunks_fd)
+        self._append_index(self._staged_heads[index][:num_frames], self._staged_records[index][:num_frames])
+        self.compressed_bytes += len(data)
+        self.frames_written += num_frames
+        self.bytes_written += num_frames * self.ring.frame_nbytes
+
+    def _run(self):
+        ring = self.ring
+        free = list(range(len(self._staging)))
+        in_flight = collections.deque()  # (staging index, first frame, num frames, future), in file order
+        staged = 0  # frames in the chunk currently being filled
+        current = free.pop()
+
+        def submit(index, num_frames):
+            chunk = self._staging[index][:num_frames]
+            first_frame = self._frames_taken - num_frames
+            in_flight.append((index, first_frame, num_frames, self._pool.submit(self._compress_chunk, chunk)))
+
+        while self._running or self._reader.pending():
+            seqs = self._reader.read_many(self.chunk_frames - staged, timeout=0.1)
+            if seqs:
+                slots, heads, records = self._records(seqs)
+                self._staged_heads[current][staged:staged + len(seqs)] = heads
+                self._staged_records[current][staged:staged + len(seqs)] = records
+                for slot in slots:
+                    self._staging[current][staged] = ring.frames[slot]
+                    staged += 1
+                self._frames_taken += len(seqs)
+                if not ring.is_valid(seqs[0]):
+                    self.torn += min(len(seqs), ring.oldest_seq() - seqs[0])
+
+            if staged == self.chunk_frames:
+                submit(current, staged)
+                staged = 0
+                if not free:
+                    self.stalls += 1
+                    index, first, n, future = in_flight.popleft()
+                    self._write_chunk(index, first, n, future)
+                    free.append(index)
+                current = free.pop()
+
+            while in_flight and in_flight[0][3].done():
+                index, first, n, future = in_flight.popleft()
+                self._write_chunk(index, first, n, future)
+                free.append(index)
+
+        if staged:
+            submit(current, staged)
+        while in_flight:
+            index, first, n, future = in_flight.popleft()
+            self._write_chunk(index, first, n, future)
+
+    @property
+    def backlog(self):
+        """Frames acquired but not yet compressed and written."""
+        return super().backlog + self.frames_pending_compression()
+
+    def frames_pending_compression(self):
+        return self._frames_taken - self.frames_written
+
+    def keeping_up(self):
+        """False once the backlog reaches half the ring; overruns follow if it keeps growing."""
+        return self.backlog < self.ring.capacity // 2
+
+    def ratio(self):
+        return self.bytes_written / self.compressed_bytes if self.compressed_bytes else 0.0
+
+    def codec_throughput(self):
+        """Uncompressed bytes per second one worker compresses; multiply by `workers` for the pool."""
+        return self.bytes_written / self.compress_seconds if self.compress_seconds else 0.0
+
+    def write_metadata(self, **extra):
+        np.save(self.prefix + "_chunks.npy", np.array(self._chunks, dtype=CHUNK_DTYPE), allow_pickle=False)
+        super().write_metadata(storage="chunked", codec=self.codec, level=self.level,
+                               chunk_frames=self.chunk_frames, compressed_bytes=self.compressed_bytes, **extra)
+
+
+class _ChunkedFrames:
+    """Array-like over P.chunks: supports frames[i], frames[a:b:c] and frames[i, y0:y1, x0:x1]."""
+
+    def __init__(self, path, chunks, chunk_frames, shape, dtype, codec, cache_chunks=4):
+        self.path = path
+        self.chunks = chunks
+        self.chunk_frames = chunk_frames
+        self.shape = shape
+        self.dtype = dtype
+        self._decompress = _decompressor(codec)
+        self._cache = collections.OrderedDict()
+        self._cache_chunks = cache_chunks
+        self._file = open(path, "rb")
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return 3
+
+    def chunk(self, k):
+        """Decompressed frames of chunk `k` (read-only, cached)."""
+        frames = self._cache.get(k)
+        if frames is not None:
+            self._cache.move_to_end(k)
+            return frames
+        offset, nbytes, first_frame, num_frames = self.chunks[k]
+        self._file.seek(int(offset))
+        data = self._decompress(self._file.read(int(nbytes)))
+        frames = np.frombuffer(data, dtype=self.dtype).reshape((int(num_frames),) + self.shape[1:])
+        self._cache[k] = frames
+        if len(self._cache) > self._cache_chunks:
+            self._cache.popitem(last=False)
+        return frames
+
+    def _frame(self, i):
+        if i < 0:
+            i += self.shape[0]
+        if not 0 <= i < self.shape[0]:
+            raise IndexError(f"frame {i} out of range for {self.shape[0]} frames")
+        return self.chunk(i // self.chunk_frames)[i % self.chunk_frames]
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        if isinstance(key, slice):
+            indices = range(*key.indices(self.shape[0]))
+            out = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+            # walk chunk by chunk so each chunk is decompressed once
+            for j, i in enumerate(indices):
+                out[j] = self._frame(i)
+            return out[(slice(None),) + rest] if rest else out
+        frame = self._frame(int(key))
+        return frame[rest] if rest else frame
+
+    def close(self):
+        self._file.close()
+
+
+class ChunkedRecording(Recording):
+    """Recording reader for chunked files; same interface as Recording."""
+
+    def _open_frames(self, shape, dtype):
+        self.chunk_index = np.load(self.prefix + "_chunks.npy")
+        if os.path.exists(self.prefix + "_chunks.bin"):
+            self.chunk_index = np.fromfile(self.prefix + "_chunks.bin", dtype=CHUNK_DTYPE)  # never stopped
+        return _ChunkedFrames(self.prefix + ".chunks", self.chunk_index, self.header["chunk_frames"],
+                              shape, dtype, self.header["codec"])
+
+    def iter_chunks(self, chunk_frames=None, start=0, stop=None):
+        """Yield (start index, frames) aligned to the stored chunks unless chunk_frames is given."""
+        yield from super().iter_chunks(chunk_frames or self.header["chunk_frames"], start, stop)
@@ -0,0 +1,114 @@
+"""Splitting an alternating-illumination frame stream into one ring per LED channel.
+
+The Arduino fires the LEDs in a fixed rotation, one per camera trigger, so frame k
+of the stream belongs to channel (k + phase) % n. Counting frames breaks as soon as
+one is dropped, so the frame number k is taken from the camera timestamp instead
+(k = round((t - t0) / period)), which skips over drops. Phase slips that timing
+alone cannot see (a trigger the camera missed, an LED that fired late) are caught
+by comparing each frame's mean intensity, sampled on a sparse grid, with the
+running level of every channel.
+"""
+import numpy as np
+
+from framebuffer import FrameRing
+from stage import FrameStage
+from timestamps import CAMERA_TICK, unwrap_ticks
+
+
+class ChannelDemux(FrameStage):
+    """Stage that copies each frame of `ring` into the FrameRing of its illumination channel.
+
+    `channels` names the LEDs in the order the Arduino fires them; `rings[name]` is
+    that channel's ring, with the same frame size, headers and timestamps as the
+    source, for previews, analysis or a recorder to read on their own. `period` is
+    the camera frame period in seconds; without it frames are assigned by count.
+    `cycles[name][slot]` is the LED rotation the frame in that slot of `rings[name]`
+    came from (set before the frame is committed): frames of different channels
+    with the same cycle were taken back to back, e.g. a fluorescence/reflectance pair.
+
+    A frame whose mean is closer to another channel's level than its own for
+    `slip_frames` frames in a row shifts the phase (counted in `slips`).
+    """
+
+    name = "ChannelDemux"
+
+    def __init__(self, ring, channels=("fluorescence", "reflectance"), period=None, phase=0,
+                 capacity=None, stride=16, slip_frames=3, smoothing=0.05, warmup=8):
+        super().__init__(ring, batch_frames=ring.capacity // 2)
+        self.channels = tuple(channels)
+        self.period = period
+        self.phase = phase
+        self.stride = stride
+        self.slip_frames = slip_frames
+        self.smoothing = smoothing
+        self.warmup = warmup
+        capacity = capacity or ring.capacity
+        self.rings = {name: FrameRing(capacity, *ring.shape, ring.frames.dtype, pixel_format=ring.pixel_format)
+                      for name in self.channels}
+        self._targets = [self.rings[name] for name in self.channels]
+        self.cycles = {name: np.full(capacity, -1, np.int64) for name in self.channels}
+        self._cycles = [self.cycles[name] for name in self.channels]
+        self.levels = np.zeros(len(self.channels))  # running mean intensity per channel
+        self.seen = np.zeros(len(self.channels), dtype=np.int64)
+        self.counts = dict.fromkeys(self.channels, 0)
+        self.slips = 0
+        self._mismatches = 0
+        self._frames = 0  # frames seen, for count-based assignment
+        self._first_tick = None
+        self._last_tick = None
+
+    def frame_numbers(self, seqs):
+        """Trigger number of each frame: from camera time when `period` is set, else by count."""
+        if self.period is None:
+            numbers = np.arange(self._frames, self._frames + len(seqs))
+        else:
+            slots = np.arange(seqs.start, seqs.stop) % self.ring.capacity
+            ticks = unwrap_ticks(self.ring.cam_timestamps[slots], self._last_tick)
+            self._last_tick = int(ticks[-1])
+            if self._first_tick is None:
+                self._first_tick = int(ticks[0])
+            numbers = np.rint((ticks - self._first_tick) * CAMERA_TICK / self.period).astype(np.int64)
+        self._frames += len(seqs)
+        return numbers
+
+    def _check_phase(self, channel, mean):
+        """Track per-channel levels and return the phase correction (0 unless a slip is confirmed)."""
+        n = len(self.channels)
+        if self.seen.min() < self.warmup:
+            self.levels[channel] += (mean - self.levels[channel]) / (self.seen[channel] + 1)
+            self.seen[channel] += 1
+            return 0
+        distance = np.abs(self.levels - mean)
+        best = int(np.argmin(distance))
+        gap = abs(self.levels[best] - self.levels[channel])
+        if best != channel and distance[best] < gap / 2:
+            self._mismatches += 1
+            if self._mismatches >= self.slip_frames:
+                self._mismatches = 0
+                self.slips += 1
+                return (best - channel) % n
+            return 0
+        self._mismatches = 0
+        self.levels[channel] += self.smoothing * (mean - self.levels[channel])
+        self.seen[channel] += 1
+        return 0
+
+    def process_batch(self, seqs):
+        ring = self.ring
+        n = len(self.channels)
+        stride = self.stride
+        for seq, number in zip(seqs, self.frame_numbers(seqs)):
+            frame = ring.frames[seq % ring.capacity]
+            channel = int(number + self.phase) % n
+            shift = self._check_phase(channel, float(frame[::stride, ::stride].mean()))
+            if shift:
+                self.phase = (self.phase + shift) % n
+                channel = int(number + self.phase) % n
+            target = self._targets[channel]
+            self._cycles[channel][target.write_seq % target.capacity] = (int(number) + self.phase) // n
+            target.copy_from(ring, seq)
+            self.counts[self.channels[channel]] += 1
+
+    def summary(self):
+        counts = ", ".join(f"{name} {count}" for name, count in self.counts.items())
+        return f"{counts}, phase slips {self.slips}"
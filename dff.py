@@ -0,0 +1,128 @@
+"""Live ΔF/F = (F - F0) / F0 with a per-pixel rolling baseline F0.
+
+Two baselines are available:
+
+    "ema"         exponential moving average with a time constant of `tau_frames`
+    "percentile"  approximate running percentile over the last `window_frames`:
+                  frames are averaged into `blocks` block means and F0 is the chosen
+                  percentile across the stored blocks, re-sorted once per block
+
+Both keep a fixed number of float32 frames, so memory does not grow with session
+length, and every buffer is allocated up front: update() and compute() only run
+in-place ufuncs on them.
+"""
+import time
+
+import numpy as np
+
+from binning import bin_frames, binned_shape
+from stage import FrameStage
+
+
+class DffEngine:
+    """Incremental ΔF/F over frames of `shape` (pixels, after unpacking), optionally binned."""
+
+    def __init__(self, shape, baseline="ema", tau_frames=300, window_frames=600, blocks=20, percentile=10,
+                 bin_factor=1, eps=1.0):
+        if baseline not in ("ema", "percentile"):
+            raise ValueError(f"unknown baseline {baseline!r}")
+        self.baseline_mode = baseline
+        self.bin_factor = bin_factor
+        self.shape = binned_shape(*shape, bin_factor)
+        self.alpha = 1.0 / tau_frames
+        self.eps = eps  # floor for F0 so dark pixels don't blow up
+        self.frames = 0
+
+        self.f = np.zeros(self.shape, np.float32)  # current (binned) frame
+        self.baseline = np.zeros(self.shape, np.float32)
+        self.dff = np.zeros(self.shape, np.float32)
+        self._tmp = np.zeros(self.shape, np.float32)
+
+        if baseline == "percentile":
+            self.block_frames = max(1, window_frames // blocks)
+            self._blocks = np.zeros((blocks,) + self.shape, np.float32)  # ring of block means
+            self._sorted = np.zeros_like(self._blocks)
+            self._block_sum = np.zeros(self.shape, np.float32)
+            self._block_count = 0
+            self._blocks_filled = 0
+            self._next_block = 0
+            self.percentile = percentile
+
+    def _load(self, frame):
+        if self.bin_factor > 1:
+            bin_frames(frame, self.bin_factor, self.f)
+        else:
+            np.copyto(self.f, frame, casting="unsafe")
+
+    def update(self, frame):
+        """Add one frame to the baseline."""
+        self._load(frame)
+        if self.frames == 0:
+            np.copyto(self.baseline, self.f)
+        self.frames += 1
+        if self.baseline_mode == "ema":
+            np.subtract(self.f, self.baseline, out=self._tmp)
+            self._tmp *= self.alpha
+            self.baseline += self._tmp
+            return
+
+        self._block_sum += self.f
+        self._block_count += 1
+        if self._block_count < self.block_frames:
+            return
+        block = self._blocks[self._next_block]
+        np.multiply(self._block_sum, 1.0 / self._block_count, out=block)
+        self._block_sum[...] = 0
+        self._block_count = 0
+        self._next_block = (self._next_block + 1) % len(self._blocks)
+        self._blocks_filled = min(self._blocks_filled + 1, len(self._blocks))
+
+        filled = self._sorted[:self._blocks_filled]
+        np.copyto(filled, self._blocks[:self._blocks_filled])
+        filled.sort(axis=0)
+        index = int(round(self.percentile / 100 * (self._blocks_filled - 1)))
+        np.copyto(self.baseline, filled[index])
+
+    def compute(self):
+        """ΔF/F of the most recent frame against the current baseline, into self.dff."""
+        np.maximum(self.baseline, self.eps, out=self._tmp)
+        np.subtract(self.f, self.baseline, out=self.dff)
+        self.dff /= self._tmp
+        return self.dff
+
+
+class DffStage(FrameStage):
+    """Runs a DffEngine on every frame of a ring and publishes maps `output_hz` times a second.
+
+    Each map is copied into one of two preallocated output buffers, so `latest` and
+    the map passed to `on_map(seq, dff)` stay valid until the next-but-one output.
+    """
+
+    name = "DffStage"
+
+    def __init__(self, ring, engine, output_hz=5.0, on_map=None):
+        super().__init__(ring)
+        self.engine = engine
+        self.output_interval = 1.0 / output_hz
+        self.on_map = on_map
+        self.latest = None  # (seq, map) of the last published map
+        self.maps_published = 0
+        self._maps = np.zeros((2,) + engine.shape, np.float32)
+        self._last_output = 0.0
+        self._unpacked = None
+        fmt = ring.pixel_format
+        if fmt is not None and fmt.packed:
+            self._unpacked = np.empty(ring.pixel_shape, fmt.dtype)
+
+    def process(self, seq, frame):
+        self.engine.update(self.ring.unpacked(frame, self._unpacked))
+        now = time.perf_counter()
+        if now - self._last_output < self.output_interval:
+            return
+        self._last_output = now
+        out = self._maps[self.maps_published % 2]
+        np.copyto(out, self.engine.compute())
+        self.maps_published += 1
+        self.latest = (seq, out)
+        if self.on_map is not None:
+            self.on_map(seq, out)
@@ -0,0 +1,172 @@
+"""Stand-in for libMVSDK.so so the acquisition paths can be benchmarked without a camera.
+
+install() must run before anything imports mvsdk: it swaps ctypes' library loaders
+for one that returns a FakeSDK, so the real mvsdk wrappers (argument packing,
+CameraException, callbacks through CFUNCTYPE) are exercised unchanged.
+"""
+import collections
+import ctypes
+import sys
+import threading
+import time
+
+
+class _Func:
+    # mvsdk sets .restype on some entry points, which a bound method would refuse
+    def __init__(self, fn):
+        self.fn = fn
+        self.restype = None
+        self.argtypes = None
+
+    def __call__(self, *args):
+        return self.fn(*args)
+
+
+def _ref(arg):
+    # byref(x) arrives as a CArgObject; the wrapped object is what the C side would write to
+    return getattr(arg, "_obj", arg)
+
+
+class FakeSDK:
+    """A single mono camera with a fixed pool of driver buffers, like the real SDK."""
+
+    def __init__(self, width=2048, height=2048, pool_size=8, media_type=0x01080001):
+        self.width = width
+        self.height = height
+        self.media_type = media_type  # CAMERA_MEDIA_TYPE_MONO8
+        self.frame_nbytes = width * height
+        self._pool = [ctypes.create_string_buffer(self.frame_nbytes) for _ in range(pool_size)]
+        pattern = bytes(range(256)) * (self.frame_nbytes // 256 + 1)
+        for buf in self._pool:
+            ctypes.memmove(buf, pattern, self.frame_nbytes)
+        self._free = collections.deque(ctypes.addressof(buf) for buf in self._pool)
+        self._ready = threading.Semaphore(0)  # frames "exposed" but not yet fetched by polling
+        self._aligned = {}
+        self.callback = None
+        self.timestamp = 0
+        self.delivered = 0
+        self.lost = 0  # frames the sensor produced while every driver buffer was held
+        self.frame_times = []  # time.time() each frame became available, for latency measurements
+        for name in dir(self):
+            if name.startswith("Camera"):
+                setattr(self, name, _Func(getattr(self, name)))
+
+    def _next_head(self, head):
+        self.timestamp = (self.timestamp + 100) & 0xFFFFFFFF  # 10 ms in 0.1 ms ticks
+        head.uiMediaType = self.media_type
+        head.uBytes = self.frame_nbytes
+        head.iWidth = self.width
+        head.iHeight = self.height
+        head.uiTimeStamp = self.timestamp
+        head.fAnalogGain = 1.0
+        return head
+
+    def fire(self, n_frames, fps=None):
+        """Deliver `n_frames` through the registered callback, paced at `fps` or as fast as possible."""
+        import mvsdk
+        head = mvsdk.tSdkFrameHead()
+        phead = ctypes.pointer(head)
+        start = time.perf_counter()
+        for i in range(n_frames):
+            if fps:
+                delay = start + i / fps - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                address = self._free.popleft()
+            except IndexError:
+                self.lost += 1
+                continue
+            self.delivered += 1
+            self._next_head(head)
+            self.frame_times.append(time.time())
+            self.callback(1, address, phead, None)
+
+    def expose(self, n_frames, fps=None):
+        """Make `n_frames` available to CameraGetImageBuffer*/Ex3 polling, paced like fire()."""
+        start = time.perf_counter()
+        for i in range(n_frames):
+            if fps:
+                delay = start + i / fps - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            self.frame_times.append(time.time())
+            self._ready.release()
+
+    # --- SDK entry points used by the acquisition code ---
+
+    def CameraGetErrorString(self, code):
+        return b"stand-in error %d" % code
+
+    def CameraSetCallbackFunction(self, hCamera, callback, context, reserved):
+        self.callback = callback
+        return 0
+
+    def CameraReleaseImageBuffer(self, hCamera, pbyBuffer):
+        self._free.append(pbyBuffer.value)
+        return 0
+
+    def CameraGetImageBuffer(self, hCamera, pFrameInfo, pbyBuffer, wTimes):
+        if not self._ready.acquire(timeout=wTimes / 1000):
+            return -12  # CAMERA_STATUS_TIME_OUT
+        try:
+            address = self._free.popleft()
+        except IndexError:
+            self.lost += 1
+            return -12
+        self.delivered += 1
+        _ref(pbyBuffer).value = address
+        self._next_head(_ref(pFrameInfo))
+        return 0
+
+    def CameraGetImageBufferEx3(self, hCamera, pImageData, uOutFormat, piWidth, piHeight, puTimeStamp, wTimes):
+        if not self._ready.acquire(timeout=wTimes / 1000):
+            return -12
+        self.delivered += 1
+        ctypes.memmove(pImageData.value, self._pool[0], self.frame_nbytes)
+        self.timestamp = (self.timestamp + 100) & 0xFFFFFFFF
+        _ref(piWidth).value = self.width
+        _ref(piHeight).value = self.height
+        _ref(puTimeStamp).value = self.timestamp
+        return 0
+
+    def CameraSetIspOutFormat(self, hCamera, uFormat):
+        return 0
+
+    def CameraAlignMalloc(self, size, align):
+        raw = ctypes.create_string_buffer(size + align)
+        address = (ctypes.addressof(raw) + align - 1) // align * align
+        self._aligned[address] = raw
+        return address
+
+    def CameraAlignFree(self, membuffer):
+        self._aligned.pop(membuffer.value, None)
+
+
+class _Loader:
+    def __init__(self, sdk):
+        self.sdk = sdk
+
+    def LoadLibrary(self, name):
+        return self.sdk
+
+    def __getattr__(self, name):
+        return self.sdk
+
+
+def install(**kwargs):
+    """Create a FakeSDK, import mvsdk against it and return the FakeSDK."""
+    if "mvsdk" in sys.modules:
+        raise RuntimeError("mvsdk is already imported; install the stand-in first")
+    sdk = FakeSDK(**kwargs)
+    saved = {name: getattr(ctypes, name) for name in ("cdll", "windll") if hasattr(ctypes, name)}
+    ctypes.cdll = ctypes.windll = _Loader(sdk)
+    try:
+        import mvsdk  # noqa: F401
+    finally:
+        for name in ("cdll", "windll"):
+            if name in saved:
+                setattr(ctypes, name, saved[name])
+            else:
+                delattr(ctypes, name)
+    return sdk
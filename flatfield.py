@@ -0,0 +1,213 @@
+"""Dark-frame and flat-field correction: corrected = (frame - offset) * gain.
+
+Calibration averages a stack of dark frames (light path closed) and a stack of
+flat frames (uniform illumination), streaming, into float32 mean images. From
+them come the two maps: `offset` is the dark image and `gain` scales each pixel's
+dark-subtracted flat response to the mean response, so corrected frames keep the
+scale of the raw ones. Maps are stored as .npz files (dark, flat, offset, gain,
+and the bit depth of the frames they were averaged from).
+
+FlatFieldStage applies the maps to every frame into preallocated buffers, with
+one in-place subtract and one in-place multiply per frame (numpy has no fused
+ufunc for the two; neither allocates). It can instead hand the same dark and flat
+images to the SDK's own flat-fielding; the SDK corrects in its image processing,
+so that only reaches the ring in polling acquisition, and downstream stages then
+read the source ring directly. Maps only apply to frames on the scale they were
+calibrated on: polling widens >8-bit formats to MONO16, so maps averaged there
+cannot be given to the SDK, which corrects the raw pixels.
+"""
+import os
+import threading
+
+import numpy as np
+
+import pixelformat
+from framebuffer import FrameRing
+from framehead import FRAME_HEAD_DTYPE
+from recording import open_recording
+from stage import FrameStage
+
+
+def pixel_bits(ring):
+    """Bit depth of a ring's (unpacked) pixels: its pixel format's, else its whole dtype (polling output)."""
+    fmt = ring.pixel_format
+    return fmt.bits if fmt is not None else ring.frames.dtype.itemsize * 8
+
+
+class FlatField:
+    """Offset and gain maps from mean `dark` and `flat` images (h, w).
+
+    Pixels whose flat response is not above `min_signal` (dead or unlit) keep a
+    gain of 1; `bad_pixels` counts them. `bits` is the bit depth of the frames
+    the images were averaged from (see pixel_bits), None when unknown (unchecked).
+    """
+
+    def __init__(self, dark, flat, min_signal=1.0, bits=None):
+        self.bits = bits
+        self.dark = np.asarray(dark, np.float32)
+        self.flat = np.asarray(flat, np.float32)
+        if self.dark.shape != self.flat.shape:
+            raise ValueError(f"dark image is {self.dark.shape}, flat image is {self.flat.shape}")
+        self.shape = self.dark.shape
+        signal = self.flat - self.dark
+        valid = signal > min_signal
+        if not valid.any():
+            raise ValueError("the flat image is no brighter than the dark image")
+        self.bad_pixels = int(valid.size - valid.sum())
+        self.offset = self.dark
+        self.gain = np.ones(self.shape, np.float32)
+        self.gain[valid] = signal[valid].mean() / signal[valid]
+
+    def apply(self, frame, out):
+        """Correct `frame` into the float32 array `out` (in place when `out` is `frame`)."""
+        np.subtract(frame, self.offset, out=out)
+        out *= self.gain
+        return out
+
+    def check_bits(self, bits, what):
+        """Raise ValueError unless the maps were calibrated on `bits`-bit pixels (or on an unknown depth)."""
+        if self.bits is not None and self.bits != bits:
+            raise ValueError(f"flat-field maps were calibrated on {self.bits}-bit pixels, {what} are {bits}-bit")
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        bits = {} if self.bits is None else {"bits": self.bits}
+        np.savez(path, dark=self.dark, flat=self.flat, offset=self.offset, gain=self.gain, **bits)
+
+
+def load_flat_field(path):
+    """FlatField saved with FlatField.save()."""
+    with np.load(path) as maps:
+        bits = int(maps["bits"]) if "bits" in maps else None  # older files don't record it
+        return FlatField(maps["dark"], maps["flat"], bits=bits)
+
+
+class CalibrationStage(FrameStage):
+    """Averages the next `num_frames` frames of a ring; `done` is set when mean() is ready."""
+
+    name = "CalibrationStage"
+
+    def __init__(self, ring, num_frames=100):
+        super().__init__(ring)
+        self.num_frames = num_frames
+        self.count = 0
+        self.done = threading.Event()
+        self.bits = pixel_bits(ring)  # for FlatField(..., bits=)
+        self._sum = np.zeros(ring.pixel_shape, np.float64)
+        fmt = ring.pixel_format
+        self._unpacked = np.empty(ring.pixel_shape, fmt.dtype) if fmt is not None and fmt.packed else None
+
+    def process(self, seq, frame):
+        if self.count >= self.num_frames:
+            return
+        self._sum += self.ring.unpacked(frame, self._unpacked)
+        self.count += 1
+        if self.count == self.num_frames:
+            self.done.set()
+
+    def mean(self):
+        return (self._sum / max(self.count, 1)).astype(np.float32)
+
+
+def mean_image(prefix, first=0, step=1, chunk_frames=256):
+    """Mean frame of a recording (e.g. a recorded dark or flat stack), one chunk at a time."""
+    recording = open_recording(prefix)
+    total = np.zeros((recording.frame_height, recording.frame_width), np.float64)
+    count = 0
+    for start in range(first, len(recording), chunk_frames * step):
+        frames = recording.frames[start:min(start + chunk_frames * step, len(recording)):step]
+        total += np.sum(frames, axis=0, dtype=np.float64)
+        count += len(frames)
+    return (total / max(count, 1)).astype(np.float32)
+
+
+def _raw_image(image, fmt):
+    """Mean image rounded to the pixels of `fmt` and stored the way the camera delivers it."""
+    pixels = np.clip(np.rint(image), 0, (1 << fmt.bits) - 1).astype(fmt.dtype)
+    if not fmt.packed:
+        return np.ascontiguousarray(pixels)
+    if fmt.bits != 12 or fmt.group_bytes != 3:
+        raise ValueError(f"cannot pack calibration images as {fmt.name}")
+    return np.ascontiguousarray(pixelformat.pack_12(pixels))
+
+
+def push_to_camera(hCamera, field, media_type):
+    """Load the dark and flat images of `field` into the SDK's flat-fielding and enable it.
+
+    The images are passed as raw frames of `media_type` (the camera's current
+    format), so the field must have been calibrated on raw pixel values (copy or
+    grabber acquisition); ValueError if it was calibrated at another bit depth.
+    """
+    import mvsdk  # only needed with a camera; the maps themselves work offline
+
+    fmt = pixelformat.from_media_type(media_type)
+    field.check_bits(fmt.bits, f"raw {fmt.name} pixels")
+    height, width = field.shape
+    images = [_raw_image(field.dark, fmt), _raw_image(field.flat, fmt)]
+    heads = []
+    for image in images:
+        head = np.zeros((), FRAME_HEAD_DTYPE)
+        head["uiMediaType"], head["uBytes"] = media_type, image.nbytes
+        head["iWidth"], head["iHeight"] = width, height
+        heads.append(mvsdk.tSdkFrameHead.from_buffer_copy(head.tobytes()))
+    mvsdk.CameraFlatFieldingCorrectSetParameter(hCamera, images[0].ctypes.data, heads[0],
+                                                images[1].ctypes.data, heads[1])
+    mvsdk.CameraFlatFieldingCorrectSetEnable(hCamera, 1)
+
+
+class FlatFieldStage(FrameStage):
+    """Flat-field corrects every frame of `ring` into its own `output` FrameRing.
+
+    Output pixels keep the (unpacked) dtype of the input, rounded and clipped to
+    its range; headers and timestamps are carried over. With `hardware` the maps
+    go to the SDK's flat-fielding on `hCamera` (raw format `media_type`) instead:
+    frames reach `ring` already corrected, `output` is `ring` itself and the stage
+    is not started. set_hardware(False) turns the SDK's correction off again;
+    downstream stages see uncorrected frames until the pipeline is rebuilt.
+    """
+
+    name = "FlatFieldStage"
+
+    def __init__(self, ring, field, hCamera=None, media_type=None, capacity=None, hardware=False):
+        super().__init__(ring)
+        if tuple(ring.pixel_shape) != tuple(field.shape):
+            raise ValueError(f"flat-field maps are {field.shape}, frames are {ring.pixel_shape}")
+        self.field = field
+        self.hCamera = hCamera
+        self.media_type = media_type
+        self.hardware = False
+        if hardware:
+            self.set_hardware(True)
+            self.output = ring
+            return
+        field.check_bits(pixel_bits(ring), "the frames")
+        fmt = ring.pixel_format
+        pixel_dtype = fmt.dtype if fmt is not None else ring.frames.dtype
+        self.output = FrameRing(capacity or ring.capacity, *ring.pixel_shape, pixel_dtype)
+        self._f = np.zeros(ring.pixel_shape, np.float32)
+        self._top = (1 << fmt.bits) - 1 if fmt is not None else np.iinfo(pixel_dtype).max
+        # (x - (offset - 0.5 / gain)) * gain = (x - offset) * gain + 0.5, so truncating to integers rounds
+        self._offset = field.offset - 0.5 / field.gain
+        self._unpacked = np.empty(ring.pixel_shape, fmt.dtype) if fmt is not None and fmt.packed else None
+
+    def set_hardware(self, on):
+        """Turn the SDK's flat-fielding with this stage's maps on or off."""
+        import mvsdk
+
+        if on:
+            push_to_camera(self.hCamera, self.field, self.media_type)
+        else:
+            mvsdk.CameraFlatFieldingCorrectSetEnable(self.hCamera, 0)
+        self.hardware = on
+
+    def process(self, seq, frame):
+        ring, output = self.ring, self.output
+        src = seq % ring.capacity
+        out_seq, _ = output.claim()
+        slot = out_seq % output.capacity
+        np.subtract(ring.unpacked(frame, self._unpacked), self._offset, out=self._f)
+        self._f *= self.field.gain
+        np.clip(self._f, 0, self._top, out=self._f)
+        np.copyto(output.frames[slot], self._f, casting="unsafe")
+        output.heads[slot] = ring.heads[src]
+        output.commit(out_seq, ring.cam_timestamps[src], ring.sys_timestamps[src])
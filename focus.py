@@ -0,0 +1,101 @@
+"""Focus assist: a sharpness score of the newest frame, a few times a second.
+
+The default score is the variance of the Laplacian of a binned central crop,
+divided by its squared mean so it does not change with LED brightness or gain;
+"sdk" uses the camera SDK's CameraEvaluateImageDefinition on the same crop,
+unbinned, instead. Like the histogram monitor, the stage is throttled and skips frames, so
+it costs the same whatever the camera frame rate.
+"""
+import numpy as np
+
+import mvsdk
+from binning import bin_frames, binned_shape
+from stage import FrameStage
+
+
+class FocusStage(FrameStage):
+    """Scores the newest frame of `ring` `rate` times a second and keeps the last `history` scores.
+
+    `roi` is the fraction of the width and height, centred, that is scored, binned
+    by `bin_factor` first. With `method="sdk"`, `hCamera` and `algorithm` are passed
+    to CameraEvaluateImageDefinition with the crop copied out unbinned (the SDK
+    takes camera pixels) and a MONO8/MONO16 frame header describing that copy;
+    the ring's own headers describe the camera frame, not a crop of it or binned
+    or corrected copies. `score` is the newest value and `peak` the best since
+    start() or reset_peak().
+    """
+
+    name = "FocusStage"
+
+    def __init__(self, ring, rate=10.0, roi=0.5, bin_factor=2, history=300, method="laplacian", hCamera=None,
+                 algorithm=0):
+        super().__init__(ring, max_rate=rate)
+        if method not in ("laplacian", "sdk"):
+            raise ValueError(f"unknown focus method {method!r}")
+        self.method = method
+        self.hCamera = hCamera
+        self.algorithm = algorithm
+        fmt = ring.pixel_format
+        height, width = ring.pixel_shape
+        crop_h, crop_w = max(3 * bin_factor, int(height * roi)), max(3 * bin_factor, int(width * roi))
+        self.rows = slice((height - crop_h) // 2, (height + crop_h) // 2)
+        self.cols = slice((width - crop_w) // 2, (width + crop_w) // 2)
+        self.bin_factor = bin_factor
+        self.shape = binned_shape(crop_h, crop_w, bin_factor)
+        self.history = np.full(history, np.nan)
+        self.count = 0
+        self.score = None
+        self.peak = None
+        self._small = np.zeros(self.shape, np.float32)
+        self._laplacian = np.zeros((self.shape[0] - 2, self.shape[1] - 2), np.float32)
+        self._unpacked = np.empty((height, width), fmt.dtype) if fmt is not None and fmt.packed else None
+        self._head = None
+        self._crop = None
+        if method == "sdk":
+            dtype = fmt.dtype if fmt is not None else ring.frames.dtype
+            media_types = {np.dtype(np.uint8): mvsdk.CAMERA_MEDIA_TYPE_MONO8,
+                           np.dtype(np.uint16): mvsdk.CAMERA_MEDIA_TYPE_MONO16}
+            if dtype not in media_types:
+                raise ValueError(f"the SDK focus score needs 8- or 16-bit pixels, this ring holds {dtype}")
+            self._crop = np.empty((crop_h, crop_w), dtype)
+            self._head = mvsdk.tSdkFrameHead()
+            self._head.uiMediaType = media_types[dtype]
+            self._head.uBytes = self._crop.nbytes
+            self._head.iWidth, self._head.iHeight = crop_w, crop_h
+
+    def reset_peak(self):
+        self.peak = None
+
+    def laplacian_score(self, frame):
+        """Variance of the 4-neighbour Laplacian over the squared mean, of the binned crop."""
+        small = self._small
+        bin_frames(self.ring.unpacked(frame, self._unpacked)[self.rows, self.cols], self.bin_factor, small)
+        laplacian = self._laplacian
+        np.multiply(small[1:-1, 1:-1], 4, out=laplacian)
+        laplacian -= small[:-2, 1:-1]
+        laplacian -= small[2:, 1:-1]
+        laplacian -= small[1:-1, :-2]
+        laplacian -= small[1:-1, 2:]
+        values = laplacian.ravel()
+        mean = values.mean()
+        variance = np.dot(values, values) / values.size - mean * mean
+        brightness = small.mean()
+        return float(variance / max(brightness * brightness, 1e-12))
+
+    def sdk_score(self, frame):
+        np.copyto(self._crop, self.ring.unpacked(frame, self._unpacked)[self.rows, self.cols])
+        return mvsdk.CameraEvaluateImageDefinition(self.hCamera, self.algorithm, self._crop.ctypes.data, self._head)
+
+    def process(self, seq, frame):
+        score = self.sdk_score(frame) if self.method == "sdk" else self.laplacian_score(frame)
+        self.history[self.count % len(self.history)] = score
+        self.count += 1
+        self.score = score
+        if self.peak is None or score > self.peak:
+            self.peak = score
+
+    def scores(self):
+        """The stored scores, oldest first."""
+        if self.count <= len(self.history):
+            return self.history[:self.count].copy()
+        return np.roll(self.history, -(self.count % len(self.history)))
@@ -0,0 +1,216 @@
+import ctypes
+import threading
+import time
+
+import numpy as np
+
+from framehead import FRAME_HEAD_DTYPE, FRAME_HEAD_NBYTES
+
+
+class FrameRing:
+    """Fixed-capacity ring of preallocated frames filled by the camera callback.
+
+    Every frame gets a sequence number that only ever increases; it lives in slot
+    seq % capacity until the producer comes round again. The producer never blocks
+    and never allocates: each frame is a single memmove into the next slot. Consumers
+    read through a RingReader, which tracks its own position and counts the frames it
+    missed because it fell more than a full ring behind.
+
+    By default the ring owns its memory. Pass `address` (and optionally a padded
+    `slot_nbytes`) to lay it over an external block such as a CameraAlignMalloc
+    allocation; `release` is then called by close() to free that block.
+
+    Alongside each slot the ring keeps the frame's tSdkFrameHead as a row of
+    `heads` (FRAME_HEAD_DTYPE, see framehead.py) when the producer passes it to
+    write_from_head(); otherwise that row is left zeroed.
+
+    Slots hold frames exactly as the camera delivers them. For packed formats
+    `pixel_format` (see pixelformat.py) says how to turn a slot into pixels, and
+    `width` is then the stored row length, not the pixel width.
+    """
+
+    def __init__(self, capacity, height, width, dtype=np.uint8, address=None, slot_nbytes=None, release=None,
+                 pixel_format=None):
+        if capacity < 2:
+            raise ValueError("ring capacity must be at least 2 frames")
+        dtype = np.dtype(dtype)
+        self.capacity = capacity
+        if address is None:
+            self.frames = np.empty((capacity, height, width), dtype=dtype)
+            slot_nbytes = self.frames[0].nbytes
+        else:
+            slot_nbytes = slot_nbytes or height * width * dtype.itemsize
+            block = (ctypes.c_ubyte * (slot_nbytes * capacity)).from_address(address)
+            self.frames = np.ndarray((capacity, height, width), dtype=dtype, buffer=block,
+                                     strides=(slot_nbytes, width * dtype.itemsize, dtype.itemsize))
+        self._release = release
+        self.pixel_format = pixel_format
+        self.slot_nbytes = slot_nbytes
+        self.seqs = np.full(capacity, -1, dtype=np.int64)
+        self.cam_timestamps = np.zeros(capacity, dtype=np.uint32)  # tSdkFrameHead.uiTimeStamp, 0.1 ms
+        self.sys_timestamps = np.zeros(capacity, dtype=np.float64)  # time.time() at arrival
+        self.heads = np.zeros(capacity, dtype=FRAME_HEAD_DTYPE)
+        self._heads_base = self.heads.ctypes.data
+        self._head_nbytes = self.heads["uBytes"]  # column views, taken once so the callback never builds them
+        self._head_timestamps = self.heads["uiTimeStamp"]
+        self.frame_nbytes = self.frames[0].nbytes
+        self.write_seq = 0  # sequence number the next frame will get
+        self.size_mismatches = 0
+        self._base = self.frames.ctypes.data
+        self._cond = threading.Condition()
+
+    @property
+    def shape(self):
+        return self.frames.shape[1:]
+
+    @property
+    def pixel_shape(self):
+        """(height, width) in pixels once unpacked; differs from `shape` only for packed formats."""
+        height, width = self.shape
+        if self.pixel_format is not None:
+            width = self.pixel_format.width_from_stored(width)
+        return height, width
+
+    def unpacked(self, frame, out=None):
+        """Pixels of a slot view, unpacking packed formats (into `out` if given)."""
+        if self.pixel_format is None:
+            return frame
+        return self.pixel_format.unpack(frame, out)
+
+    def _commit(self, slot, seq, timestamp, sys_timestamp=None):
+        self.seqs[slot] = seq
+        self.cam_timestamps[slot] = timestamp
+        self.sys_timestamps[slot] = time.time() if sys_timestamp is None else sys_timestamp
+        with self._cond:
+            self.write_seq = seq + 1
+            self._cond.notify_all()
+        return seq
+
+    def _copy(self, slot, address, nbytes):
+        if nbytes != self.frame_nbytes:
+            # Short or oversized frame (resolution change, truncated transfer): copy what fits.
+            self.size_mismatches += 1
+            nbytes = min(nbytes, self.frame_nbytes)
+        ctypes.memmove(self._base + slot * self.slot_nbytes, address, nbytes)
+
+    def write_from_address(self, address, nbytes, timestamp=0):
+        """Copy a raw frame at `address` into the next slot and return its sequence number."""
+        seq = self.write_seq
+        slot = seq % self.capacity
+        self._copy(slot, address, nbytes)
+        return self._commit(slot, seq, timestamp)
+
+    def write_from_head(self, address, head):
+        """Like write_from_address, taking size and timestamp from `head`, a pointer to the tSdkFrameHead.
+
+        The header is logged into `heads` with one memmove; no field is read through ctypes.
+        """
+        seq = self.write_seq
+        slot = seq % self.capacity
+        ctypes.memmove(self._heads_base + slot * FRAME_HEAD_NBYTES, head, FRAME_HEAD_NBYTES)
+        self._copy(slot, address, int(self._head_nbytes[slot]))
+        return self._commit(slot, seq, self._head_timestamps[slot])
+
+    def copy_from(self, ring, seq):
+        """Copy frame `seq` of another ring of the same frame size, with its header and both timestamps."""
+        src = seq % ring.capacity
+        slot = self.write_seq % self.capacity
+        self.heads[slot] = ring.heads[src]
+        self._copy(slot, ring._base + src * ring.slot_nbytes, ring.frame_nbytes)
+        return self._commit(slot, self.write_seq, ring.cam_timestamps[src], ring.sys_timestamps[src])
+
+    def claim(self):
+        """Return (seq, address) of the next slot for a producer that fills it in place.
+
+        The slot's previous frame is already treated as overwritten; publish the new one
+        with commit(seq, timestamp).
+        """
+        seq = self.write_seq
+        return seq, self._base + (seq % self.capacity) * self.slot_nbytes
+
+    def commit(self, seq, timestamp=0, sys_timestamp=None):
+        return self._commit(seq % self.capacity, seq, timestamp, sys_timestamp)
+
+    def write(self, frame, timestamp=0):
+        """Copy a NumPy frame into the next slot and return its sequence number."""
+        seq = self.write_seq
+        slot = seq % self.capacity
+        np.copyto(self.frames[slot], frame, casting="unsafe")
+        return self._commit(slot, seq, timestamp)
+
+    def oldest_seq(self):
+        """Oldest sequence number that is still intact (the slot after it may be mid-write)."""
+        return max(0, self.write_seq - self.capacity + 1)
+
+    def is_valid(self, seq):
+        """True while the frame for `seq` has not been (and is not being) overwritten."""
+        return self.oldest_seq() <= seq < self.write_seq
+
+    def get(self, seq):
+        """Return a view of frame `seq`, or None if it has already been overwritten."""
+        if not self.is_valid(seq):
+            return None
+        return self.frames[seq % self.capacity]
+
+    def latest(self):
+        """Return (seq, view) of the newest frame, or None before the first frame."""
+        seq = self.write_seq - 1
+        if seq < 0:
+            return None
+        return seq, self.frames[seq % self.capacity]
+
+    def close(self):
+        """Free externally owned frame memory; the ring must not be used afterwards."""
+        if self._release is not None:
+            release, self._release = self._release, None
+            self.frames = None
+            release()
+
+    def reader(self, from_start=False):
+        """Create a consumer cursor; by default it only sees frames written from now on."""
+        return RingReader(self, self.oldest_seq() if from_start else self.write_seq)
+
+
+class RingReader:
+    """Per-consumer read position into a FrameRing.
+
+    Views returned by read() point straight into the ring, so a slow consumer should
+    check ring.is_valid(seq) after using one if it cannot afford a torn frame.
+    """
+
+    def __init__(self, ring, start_seq):
+        self.ring = ring
+        self.read_seq = start_seq
+        self.overruns = 0  # frames this consumer never saw because the producer lapped it
+
+    def pending(self):
+        return self.ring.write_seq - self.read_seq
+
+    def _catch_up(self):
+        oldest = self.ring.oldest_seq()
+        if self.read_seq < oldest:
+            self.overruns += oldest - self.read_seq
+            self.read_seq = oldest
+
+    def read(self, timeout=None):
+        """Return (seq, view) of the next unread frame, or None if nothing arrives within `timeout`."""
+        ring = self.ring
+        with ring._cond:
+            if not ring._cond.wait_for(lambda: ring.write_seq > self.read_seq, timeout):
+                return None
+            self._catch_up()
+        seq = self.read_seq
+        self.read_seq += 1
+        return seq, ring.frames[seq % ring.capacity]
+
+    def read_many(self, max_frames, timeout=None):
+        """Return the sequence numbers of up to `max_frames` unread frames (empty on timeout)."""
+        ring = self.ring
+        with ring._cond:
+            if not ring._cond.wait_for(lambda: ring.write_seq > self.read_seq, timeout):
+                return range(0)
+            self._catch_up()
+            stop = min(ring.write_seq, self.read_seq + max_frames)
+        seqs = range(self.read_seq, stop)
+        self.read_seq = stop
+        return seqs
@@ -0,0 +1,53 @@
+"""Per-frame tSdkFrameHead log as a NumPy structured array.
+
+FRAME_HEAD_DTYPE has exactly the byte layout of mvsdk.tSdkFrameHead, so a header
+is logged with one memmove from the pointer the SDK hands the callback, and a
+whole session's headers can be queried column by column (heads["uiExpTime"],
+heads["bIsTrigger"], ...) without a Python object per frame.
+
+It is spelled out here rather than derived from mvsdk so recordings can be read
+on machines without the camera SDK; check_layout() verifies it against the SDK.
+"""
+import ctypes
+import os
+
+import numpy as np
+
+FRAME_HEAD_DTYPE = np.dtype([
+    ("uiMediaType", np.uint32),  # pixel format, see pixelformat.py
+    ("uBytes", np.uint32),  # frame size in bytes
+    ("iWidth", np.int32),
+    ("iHeight", np.int32),
+    ("iWidthZoomSw", np.int32),
+    ("iHeightZoomSw", np.int32),
+    ("bIsTrigger", np.int32),  # nonzero for triggered frames
+    ("uiTimeStamp", np.uint32),  # 0.1 ms ticks, wraps at 2**32
+    ("uiExpTime", np.uint32),  # exposure in us
+    ("fAnalogGain", np.float32),
+    ("iGamma", np.int32),
+    ("iContrast", np.int32),
+    ("iSaturation", np.int32),
+    ("fRgain", np.float32),
+    ("fGgain", np.float32),
+    ("fBgain", np.float32),
+])
+
+FRAME_HEAD_NBYTES = FRAME_HEAD_DTYPE.itemsize
+
+
+def check_layout(struct):
+    """Raise if FRAME_HEAD_DTYPE does not match the ctypes tSdkFrameHead `struct` byte for byte."""
+    if ctypes.sizeof(struct) != FRAME_HEAD_NBYTES:
+        raise TypeError(f"tSdkFrameHead is {ctypes.sizeof(struct)} bytes, FRAME_HEAD_DTYPE is {FRAME_HEAD_NBYTES}")
+    for name, _ in struct._fields_:
+        offset = getattr(struct, name).offset
+        if FRAME_HEAD_DTYPE.fields[name][1] != offset:
+            raise TypeError(f"tSdkFrameHead.{name} is at offset {offset}, FRAME_HEAD_DTYPE disagrees")
+
+
+def load_heads(path):
+    """Memory-map a header log written by the recorder (raw FRAME_HEAD_DTYPE records)."""
+    nbytes = os.path.getsize(path)
+    if nbytes == 0:
+        return np.zeros(0, FRAME_HEAD_DTYPE)  # np.memmap refuses empty files
+    return np.memmap(path, dtype=FRAME_HEAD_DTYPE, mode="r", shape=(nbytes // FRAME_HEAD_NBYTES,))
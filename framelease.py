@@ -0,0 +1,139 @@
+import ctypes
+import queue
+import threading
+
+import numpy as np
+
+import mvsdk
+import pixelformat
+
+
+class FrameLease:
+    """Zero-copy view of a frame that still lives in an SDK buffer.
+
+    `frame` points straight at pRawData, shaped by the frame's pixel format (packed
+    formats stay packed; see pixelformat.py), and `head` is a private copy of the
+    tSdkFrameHead. Every holder calls release() when done; the SDK buffer goes back
+    via CameraReleaseImageBuffer only once the last holder has let go, after which
+    `frame` must not be touched.
+    """
+
+    __slots__ = ("pool", "seq", "address", "head", "frame", "_refs")
+
+    def __init__(self, pool, seq, address, head, frame):
+        self.pool = pool
+        self.seq = seq
+        self.address = address
+        self.head = head
+        self.frame = frame
+        self._refs = 1
+
+    def acquire(self):
+        with self.pool._lock:
+            if self._refs == 0:
+                raise RuntimeError("frame lease already returned to the SDK")
+            self._refs += 1
+        return self
+
+    def release(self):
+        with self.pool._lock:
+            self._refs -= 1
+            last = self._refs == 0
+        if last:
+            self.pool._return(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class LeasePool:
+    """Hands out FrameLeases to subscribed consumers and returns buffers to the SDK.
+
+    At most `max_outstanding` SDK buffers are held at once. A frame arriving while the
+    cap is reached is released straight back to the SDK and counted in `dropped`, so a
+    stalled consumer can never drain the SDK's internal buffer pool. Each consumer gets
+    its own bounded queue; a full queue means that consumer skips the frame (counted
+    per consumer) without affecting the others.
+    """
+
+    def __init__(self, hCamera, max_outstanding=8, release=None):
+        self.hCamera = hCamera
+        self.max_outstanding = max_outstanding
+        self._release = release or mvsdk.CameraReleaseImageBuffer
+        self._lock = threading.Lock()
+        self._consumers = {}
+        self._array_types = {}  # ctypes array type per buffer size, so the hot path never builds one
+        self.outstanding = 0
+        self.published = 0
+        self.dropped = 0
+        self.skipped = {}
+
+    def subscribe(self, name, maxsize=4):
+        """Register a consumer and return the queue its leases will arrive on."""
+        q = queue.Queue(maxsize)
+        self._consumers[name] = q
+        self.skipped[name] = 0
+        return q
+
+    def unsubscribe(self, name):
+        q = self._consumers.pop(name, None)
+        while q is not None:
+            try:
+                q.get_nowait().release()
+            except queue.Empty:
+                break
+
+    def _view(self, address, head):
+        nbytes = head.uBytes
+        array_type = self._array_types.get(nbytes)
+        if array_type is None:
+            array_type = self._array_types[nbytes] = ctypes.c_ubyte * nbytes
+        data = np.frombuffer(array_type.from_address(address), dtype=np.uint8)
+        try:
+            fmt = pixelformat.from_media_type(head.uiMediaType)
+            if nbytes == fmt.frame_nbytes(head.iHeight, head.iWidth):
+                return data.view(fmt.storage_dtype).reshape(fmt.stored_shape(head.iHeight, head.iWidth))
+        except ValueError:
+            pass  # unknown format or odd width: hand out the flat bytes
+        return data
+
+    def publish(self, address, head):
+        """Wrap an SDK buffer in a lease and offer it to every consumer.
+
+        `head` must be a copy that outlives the callback (tSdkFrameHead.clone()).
+        Returns False if the outstanding-lease cap forced the buffer straight back.
+        """
+        with self._lock:
+            if self.outstanding >= self.max_outstanding:
+                self.dropped += 1
+                over_cap = True
+            else:
+                self.outstanding += 1
+                over_cap = False
+        if over_cap:
+            self._release(self.hCamera, address)
+            return False
+
+        lease = FrameLease(self, self.published, address, head, self._view(address, head))
+        self.published += 1
+        for name, q in list(self._consumers.items()):
+            lease.acquire()
+            try:
+                q.put_nowait(lease)
+            except queue.Full:
+                self.skipped[name] += 1
+                lease.release()
+        lease.release()  # drop the publisher's own reference
+        return True
+
+    def _return(self, lease):
+        self._release(self.hCamera, lease.address)
+        with self._lock:
+            self.outstanding -= 1
+
+    def close(self):
+        for name in list(self._consumers):
+            self.unsubscribe(name)
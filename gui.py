@@ -2,10 +2,9 @@ from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QPushButton, QVBoxLayout, QWidget,
     QLabel, QLineEdit, QSpinBox, QHBoxLayout, QSlider, QDoubleSpinBox,QSplitter, QGroupBox
 )
-from PyQt5.QtCore import Qt, QMetaObject, Q_ARG
+from PyQt5.QtCore import Qt, QMetaObject, Q_ARG, QTimer, pyqtSignal
 from PyQt5.QtGui import QImage, QPixmap
 import cv2
-import threading
 import time
 import serial
 import serial.tools.list_ports
@@ -14,11 +13,33 @@ import mvsdk
 import numpy as np
 import yaml
 import os
-import queue
+from framebuffer import FrameRing
+from recorder import RawRecorder, required_bandwidth
+from chunked import ChunkedRecorder
+from acquisition import GrabberAcquisition, PollingAcquisition, aligned_ring
+import pixelformat
+import framehead
+from timestamps import TimestampTracker
+from demux import ChannelDemux
+from dff import DffEngine, DffStage
+from hemo import HemoStage
+from binning import BinningStage
+from flatfield import CalibrationStage, FlatField, FlatFieldStage, load_flat_field
+from focus import FocusStage
+from histogram import HistogramStage
+from motion import MotionStage
+from phasemap import PhaseAccumulator, PhaseMapStage, phase_image
+from preview import PreviewStage
+from regions import RegionProjector, RegionStage
+from svd import SVDStage
+from trials import TrialAverager, TrialStage
+from resolution import clamp_roi, current_size, measure_max_rate, set_hardware_binning, set_transfer_roi, supported_modes
 os.add_dll_directory("C:\Windows\System32")
 
 
 class MainWindow(QMainWindow):
+    preview_ready = pyqtSignal(object)  # a PreviewStage with a new image, emitted from its own thread
+
     def __init__(self):
         super().__init__()
         self.config = {}
@@ -26,9 +47,37 @@ class MainWindow(QMainWindow):
         self.init_ui()
         self.arduino = None  # initializing as none as I don't have an arduino with me atm
         self.hCamera = None
-        self.frame_queue = queue.Queue()
-        self.display_thread = None
+        self.cap = None
+        self.grabber = None  # only used in "grabber" acquisition mode
+        self.transfer_roi = None  # the transfer ROI last set on the camera, so it can be switched off again
+        self.roi_report = ""  # max frame rate / bandwidth before and after the last ROI change
+        self.frame_ring = None  # allocated once the camera resolution is known
+        self.stream_ring = None  # what recording and analysis read: frame_ring, or its software-binned copy
+        self.stages = []  # FrameStage threads in pipeline order (binning, demux, analysis)
+        self.binner = None
+        self.flatfield = None  # dark/flat-field correction; its output ring becomes the stream
+        self.calibration = None  # (kind, CalibrationStage) while a dark or flat stack is being averaged
+        self.calibration_images = {}  # finished "dark" / "flat" mean images, until both exist
+        self.recorders = []  # one per stream: the whole ring, or one per LED channel when demultiplexing
+        self.motion = None  # live motion correction; its output ring becomes the stream
+        self.demux = None
+        self.dff = None  # live ΔF/F stage; its newest map is self.dff.latest
+        self.hemo = None  # live hemodynamic correction, needs the demultiplexer
+        self.phasemap = None  # live amplitude/phase maps at the stimulus frequency
+        self.svd = None  # near-real-time SVD of the binned stream, saved next to each recording
+        self.trials = None  # event-locked averages of stimulus trials signalled by the Arduino
+        self.regions = None  # ROI / atlas region traces, logged next to each recording
+        self.recording_prefix = None
+        self.preview = None  # renders the newest frame into video_label
+        self.histogram = None  # intensity histogram / saturation monitor on the camera frames
+        self.focus = None  # focus assist, only while the Focus Assist button is on
+        self.acquisition = None  # PollingAcquisition or GrabberAcquisition, for those modes
+        self.callback_registered = False  # GrabCallback writes into frame_ring ("copy" mode)
+        self.last_stats = (time.time(), 0)
+        self.timing = None  # TimestampTracker fed from the ring by the stats timer
+        self.timing_reader = None
         self.camera_running = False
+        self.preview_ready.connect(self.show_preview)
 
         self.initialize_camera()
         self.initialize_arduino()
@@ -37,10 +86,10 @@ class MainWindow(QMainWindow):
 
     def save_config(self):
         """Save current settings to config.yml."""
-        self.config["CAMERA"] = {
+        self.config["CAMERA"].update({
             "EXPOSURE_TIME": self.camera_exposure_input.value(),
             "ANALOG_GAIN": self.camera_gain_slider.value(),
-        }
+        })
         self.config["ARDUINO"] = {
             "PORT": self.arduino_port_input.text(),
             "F_LED": self.f_led_input.value(),
@@ -78,6 +127,112 @@ class MainWindow(QMainWindow):
             "EXTERN": 0,
         })
         self.config.setdefault("CAMERA", {}).setdefault("SAVE_DIR", "C://OWFI/")
+        self.config["CAMERA"].setdefault("RING_CAPACITY", 256)  # frames held in the acquisition ring buffer
+        self.config["CAMERA"].setdefault("ACQUISITION_MODE", "copy")  # "copy", "polling" or "grabber"
+        self.config.setdefault("RECORDING", {
+            "BATCH_FRAMES": 32,  # frames per disk write
+            "PREALLOCATE_MB": 1024,  # file is grown ahead of the writer in extents of this size
+        })
+        self.config["RECORDING"].setdefault("FORMAT", "raw")  # "raw" or compressed "chunked"
+        self.config["RECORDING"].setdefault("CODEC", "zlib")  # chunked: zlib, lzma, or zstd/lz4 if installed
+        self.config["RECORDING"].setdefault("LEVEL", 1)
+        self.config["RECORDING"].setdefault("CHUNK_FRAMES", 32)
+        self.config["RECORDING"].setdefault("WORKERS", 0)  # compression threads, 0 = one per core
+        self.config["CAMERA"].setdefault("TRIGGERED_ONLY", False)  # grabber mode: drop untriggered frames in the SDK listener
+        self.config.setdefault("DEMUX", {
+            "CHANNELS": [],  # LED names in firing order, e.g. [fluorescence, reflectance]; empty = one stream
+        })
+        self.config["DEMUX"].setdefault("PHASE", 0)  # channel of the first frame
+        self.config["DEMUX"].setdefault("STRIDE", 16)  # pixel step of the mean-intensity phase check
+        self.config.setdefault("DFF", {
+            "ENABLED": False,
+            "BASELINE": "ema",  # "ema" or windowed "percentile"
+            "TAU_S": 30.0,  # ema time constant
+            "WINDOW_S": 60.0,  # percentile window
+            "PERCENTILE": 10,
+            "BIN": 4,  # spatial binning before ΔF/F
+            "OUTPUT_HZ": 5.0,  # maps published per second
+            "CHANNEL": "",  # LED channel to use when demultiplexing (default: the first)
+        })
+        self.config.setdefault("HEMO", {
+            "ENABLED": False,
+            "FLUORESCENCE": "fluorescence",  # DEMUX channel names
+            "REFLECTANCE": "reflectance",
+            "BIN": 4,
+            "OUTPUT_HZ": 5.0,
+        })
+        self.config["CAMERA"].setdefault("HW_BIN_MODE", None)  # on-sensor "sum", "average" or "skip"; None = full resolution
+        self.config["CAMERA"].setdefault("HW_BIN_SIZE", 2)
+        self.config["CAMERA"].setdefault("ROI", None)  # [x, y, width, height] in sensor pixels; None = full frame
+        self.config["CAMERA"].setdefault("ROI_MODE", "sensor")  # "sensor" reads out less, "transfer" only sends less
+        self.config.setdefault("BINNING", {
+            "FACTOR": 1,  # software binning after acquisition; 1 = off
+            "MODE": "mean",  # "mean" keeps the pixel type, "sum" gives uint32
+        })
+        self.config.setdefault("PREVIEW", {
+            "RATE": 30.0,  # preview refreshes per second, whatever the camera frame rate
+            "CHANNEL": "",  # LED channel to show when demultiplexing (default: the first)
+        })
+        self.config["PREVIEW"].setdefault("AUTO_LEVELS", 1.0)  # seconds between contrast updates from the data; 0 = use WINDOW
+        self.config["PREVIEW"].setdefault("WINDOW", None)  # [black, white] pixel values when AUTO_LEVELS is 0 (default: full range)
+        self.config["PREVIEW"].setdefault("COLORMAP", "")  # OpenCV colormap name, e.g. "inferno"; "" = gray
+        self.config.setdefault("MONITOR", {
+            "ENABLED": True,
+            "RATE": 2.0,  # histograms per second
+            "STRIDE": 8,  # histogram every STRIDE-th pixel in each direction
+            "SATURATION_WARN": 0.001,  # warn when more than this fraction of pixels is clipped
+        })
+        self.config.setdefault("FOCUS", {
+            "METHOD": "laplacian",  # or "sdk" for CameraEvaluateImageDefinition
+            "SDK_ALGORITHM": 0,
+            "RATE": 10.0,  # scores per second
+            "ROI": 0.5,  # centred fraction of the frame that is scored
+            "BIN": 2,
+        })
+        self.config.setdefault("MOTION", {
+            "ENABLED": False,
+            "BIN": 4,  # shifts are estimated on frames binned this much
+            "BATCH_FRAMES": 8,  # frames per FFT call
+            "REFERENCE_FRAMES": 30,  # initial reference; frames before it are passed through uncorrected
+            "SMOOTHING": 0.02,  # weight of each corrected frame in the running reference
+        })
+        self.config.setdefault("PHASEMAP", {
+            "ENABLED": False,
+            "FREQUENCY_HZ": 0.1,  # stimulus repetition frequency
+            "BIN": 4,
+            "OUTPUT_HZ": 1.0,  # maps published per second
+            "CHANNEL": "",  # LED channel to use when demultiplexing (default: the first)
+        })
+        self.config.setdefault("SVD", {
+            "ENABLED": False,
+            "RANK": 100,
+            "BIN": 4,
+            "TRAIN_FRAMES": 1000,  # frames decomposed before the rest are projected; bounds the fit's memory
+            "MAX_FRAMES": 500000,  # time courses kept in memory; older frames are dropped from the saved SVD
+            "CHANNEL": "",  # LED channel to use when demultiplexing (default: the first)
+        })
+        self.config.setdefault("TRIALS", {
+            "ENABLED": False,
+            "PRE_S": 1.0,  # seconds before each event in the average
+            "POST_S": 3.0,
+            "BIN": 4,
+            "CHANNEL": "",  # LED channel to use when demultiplexing (default: the first)
+            "EVENT_PREFIX": "T",  # Arduino lines "T <condition>" mark a stimulus onset
+        })
+        self.config.setdefault("FLATFIELD", {
+            "ENABLED": False,
+            "PATH": "C://OWFI/flatfield.npz",  # maps written by Acquire Dark / Acquire Flat
+            # hand the maps to the SDK's flat-fielding instead (polling mode only); the SDK corrects raw pixels,
+            # so with >8-bit pixels the maps must be acquired in copy or grabber mode (polling widens them to 16 bits)
+            "HARDWARE": False,
+            "CALIBRATION_FRAMES": 100,  # frames averaged per dark / flat image
+        })
+        self.config.setdefault("REGIONS", {
+            "ENABLED": False,
+            "LABELS": "",  # .npy label image (h, w), or boolean masks (regions, h, w), at the stream resolution
+            "CHANNEL": "",  # LED channel to use when demultiplexing (default: the first)
+        })
+        self.config["CAMERA"].setdefault("MEDIA_TYPE", None)  # e.g. "MONO12_PACKED"; None keeps the camera's current format
 
 # GUI
 
@@ -124,6 +279,26 @@ class MainWindow(QMainWindow):
             lambda value: self.camera_gain_label.setText(f"Analog Gain: {value}")
         )
 
+        # Region of interest, in full-resolution sensor pixels (width/height 0 = full frame)
+        roi = self.config["CAMERA"]["ROI"] or [0, 0, 0, 0]
+        roi_label = QLabel("ROI x, y, width, height:")
+        roi_label.setStyleSheet(param_label_style)
+        camera_layout.addWidget(roi_label)
+        roi_layout = QHBoxLayout()
+        self.roi_inputs = []
+        for value in roi:
+            box = QSpinBox()
+            box.setRange(0, 16384)
+            box.setSingleStep(16)
+            box.setValue(value)
+            box.setStyleSheet("color: white;")
+            roi_layout.addWidget(box)
+            self.roi_inputs.append(box)
+        self.apply_roi_button = QPushButton("Apply ROI")
+        self.apply_roi_button.clicked.connect(self.apply_roi_from_inputs)
+        roi_layout.addWidget(self.apply_roi_button)
+        camera_layout.addLayout(roi_layout)
+
         camera_group.setLayout(camera_layout)
 
         # Arduino Settings Group
@@ -193,17 +368,35 @@ class MainWindow(QMainWindow):
         self.stop_button = QPushButton("Stop Capture")
         self.set_params_button = QPushButton("Set Parameters")
         self.retry_button = QPushButton("Retry Arduino Connection")
+        self.record_button = QPushButton("Start Recording")
+        self.snapshot_button = QPushButton("Save Frame")
 
         self.start_button.clicked.connect(self.start_capture)
         self.stop_button.clicked.connect(self.stop_capture)
         self.set_params_button.clicked.connect(self.set_parameters)
         self.retry_button.clicked.connect(self.retry_arduino_connection)
+        self.record_button.clicked.connect(self.toggle_recording)
+        self.snapshot_button.clicked.connect(self.save_frames)
+        self.dark_button = QPushButton("Acquire Dark")
+        self.flat_button = QPushButton("Acquire Flat")
+        self.dark_button.clicked.connect(lambda: self.acquire_calibration("dark"))
+        self.flat_button.clicked.connect(lambda: self.acquire_calibration("flat"))
+        self.focus_button = QPushButton("Focus Assist")
+        self.focus_button.setCheckable(True)
+        self.focus_button.toggled.connect(self.toggle_focus)
+        self.focus_timer = QTimer(self)
+        self.focus_timer.timeout.connect(self.draw_focus)
 
         button_layout = QHBoxLayout()
         button_layout.addWidget(self.start_button)
         button_layout.addWidget(self.stop_button)
         button_layout.addWidget(self.set_params_button)
         button_layout.addWidget(self.retry_button)
+        button_layout.addWidget(self.record_button)
+        button_layout.addWidget(self.snapshot_button)
+        button_layout.addWidget(self.focus_button)
+        button_layout.addWidget(self.dark_button)
+        button_layout.addWidget(self.flat_button)
 
         button_widget = QWidget()
         button_widget.setLayout(button_layout)
@@ -218,6 +411,36 @@ class MainWindow(QMainWindow):
         settings_layout = QVBoxLayout()
         settings_layout.addWidget(camera_group)
         settings_layout.addWidget(arduino_group)
+
+        # Acquisition throughput, refreshed once a second
+        self.stats_label = QLabel("Acquisition: idle")
+        self.stats_label.setStyleSheet(param_label_style)
+        self.stats_label.setWordWrap(True)
+        settings_layout.addWidget(self.stats_label)
+        # Intensity histogram of the camera frames (log counts), outlined in red when too many pixels clip
+        self.histogram_label = QLabel()
+        self.histogram_label.setFixedSize(256, 80)
+        self.histogram_label.setStyleSheet("background-color: black;")
+        settings_layout.addWidget(self.histogram_label)
+        # Focus score history while focus assist is on; the peak so far is marked
+        self.focus_label = QLabel()
+        self.focus_label.setFixedSize(256, 80)
+        self.focus_label.setStyleSheet("background-color: black;")
+        self.focus_label.hide()
+        settings_layout.addWidget(self.focus_label)
+        # Live phase map (hue = phase, brightness = amplitude) while PHASEMAP is enabled
+        self.phase_label = QLabel()
+        self.phase_label.setFixedSize(256, 192)
+        self.phase_label.setStyleSheet("background-color: black;")
+        self.phase_label.setVisible(self.config["PHASEMAP"]["ENABLED"])
+        settings_layout.addWidget(self.phase_label)
+        self.stats_timer = QTimer(self)
+        self.stats_timer.timeout.connect(self.update_stats)
+        self.stats_timer.start(1000)
+        # Stimulus events are stamped when they are read, so the serial port is polled often
+        self.events_timer = QTimer(self)
+        self.events_timer.timeout.connect(self.poll_arduino_events)
+        self.events_timer.start(5)
         settings_widget.setLayout(settings_layout)
         splitter.addWidget(settings_widget)
         splitter.setStretchFactor(0, 3)  # Live preview larger
@@ -241,15 +464,20 @@ class MainWindow(QMainWindow):
                 return
 
             DevInfo = DevList[0]  # Select the first camera
-            self.hCamera = mvsdk.CameraInit(DevInfo, -1, -1)
-
-            cap = mvsdk.CameraGetCapability(self.hCamera)
+            if self.config["CAMERA"]["ACQUISITION_MODE"] == "grabber":
+                # the grabber opens the camera itself and hands us its handle
+                self.grabber = mvsdk.CameraGrabber_Create(DevInfo)
+                self.hCamera = mvsdk.CameraGrabber_GetCameraHandle(self.grabber)
+            else:
+                self.hCamera = mvsdk.CameraInit(DevInfo, -1, -1)
+
+            framehead.check_layout(mvsdk.tSdkFrameHead)  # the ring logs headers by raw memmove
+            self.cap = cap = mvsdk.CameraGetCapability(self.hCamera)
             print(f"Expected buffer size: {cap.sResolutionRange.iWidthMax * cap.sResolutionRange.iHeightMax}")  
-            
+            print(f"Hardware bin/skip modes: {supported_modes(cap)}")
 
-            self.height = cap.sResolutionRange.iHeightMax
-            self.width = cap.sResolutionRange.iWidthMax
-            print(f"Camera resolution: {self.width}x{self.height}")
+            self.pixel_format = self.select_media_type(cap)
+            print(f"Pixel format: {self.pixel_format.name}")
 
             # Configure the camera
             mvsdk.CameraSetTriggerMode(self.hCamera, 2) # HARDWARE trigger
@@ -258,15 +486,13 @@ class MainWindow(QMainWindow):
             mvsdk.CameraSetExposureTime(self.hCamera, self.camera_exposure_input.value() * 1000)  # Initial exposure
             mvsdk.CameraSetAnalogGain(self.hCamera, self.camera_gain_slider.value())  # Initial gain
             mvsdk.CameraPlay(self.hCamera)  # Start the camera
-
-            # start live feed thread
             self.camera_running = True
-            self.display_thread = threading.Thread(target=self.display_frames, daemon=True)
-            self.display_thread.start()
-
-            # set callback
-            mvsdk.CameraSetCallbackFunction(self.hCamera, self.GrabCallback, None)
 
+            self.build_pipeline()
+            if self.config["CAMERA"]["ROI"]:
+                fps, bandwidth = measure_max_rate(self.hCamera, self.frame_ring.frame_nbytes)
+                self.roi_report = f"ROI {self.config['CAMERA']['ROI']}: max {fps:.1f} fps, {bandwidth / 1e6:.1f} MB/s"
+                print(self.roi_report)
             print("Camera initialized successfully.")
 
         except Exception as e:
@@ -274,7 +500,367 @@ class MainWindow(QMainWindow):
             # self.start_button.setEnabled(False)
             # self.stop_button.setEnabled(False)
 
-    
+    def configure_sensor(self):
+        """Apply CAMERA: ROI and hardware binning to the camera and read its output size into width/height."""
+        camera_config = self.config["CAMERA"]
+        roi = clamp_roi(self.cap, camera_config["ROI"]) if camera_config["ROI"] else None
+
+        # Output size after the sensor ROI and any on-sensor binning; every buffer of the pipeline is derived from it
+        sensor_roi = roi if camera_config["ROI_MODE"] == "sensor" else None
+        self.width, self.height = set_hardware_binning(self.hCamera, self.cap, camera_config["HW_BIN_MODE"],
+                                                       camera_config["HW_BIN_SIZE"], sensor_roi)
+        if camera_config["ROI_MODE"] == "transfer" and (roi or self.transfer_roi):
+            set_transfer_roi(self.hCamera, roi)
+            self.transfer_roi = roi
+            self.width, self.height = current_size(self.hCamera)
+        print(f"Camera resolution: {self.width}x{self.height}" + (f" (ROI {roi})" if roi else ""))
+
+    def build_pipeline(self, sensor_configured=False):
+        """Size everything from the camera's current output: ring, acquisition, binning, demux, stages."""
+        camera_config = self.config["CAMERA"]
+        mode = camera_config["ACQUISITION_MODE"]
+        if mode not in ("copy", "polling", "grabber"):
+            # zero-copy leases (framelease.py) have no ring for the preview, stages and recorder to read;
+            # they are only measured in benchmark.py
+            print(f"ACQUISITION_MODE {mode!r} is not supported by the GUI, using \"copy\".")
+            mode = camera_config["ACQUISITION_MODE"] = "copy"
+        if not sensor_configured:
+            self.configure_sensor()
+
+        # Preallocate the frame ring once; acquisition only ever copies into it
+        capacity = camera_config["RING_CAPACITY"]
+        if mode == "polling":
+            # the SDK decodes straight into aligned ring slots, widened to 16 bits for >8-bit formats
+            out_format = mvsdk.CAMERA_MEDIA_TYPE_MONO16 if self.pixel_format.bits > 8 else mvsdk.CAMERA_MEDIA_TYPE_MONO8
+            self.frame_ring = aligned_ring(capacity, self.height, self.width,
+                                           pixelformat.from_media_type(out_format).dtype)
+            mvsdk.CameraSetIspOutFormat(self.hCamera, out_format)
+        else:
+            # raw frames land in the ring as delivered; packed formats are unpacked on read
+            self.frame_ring = FrameRing(capacity, *self.pixel_format.stored_shape(self.height, self.width),
+                                        self.pixel_format.storage_dtype, pixel_format=self.pixel_format)
+
+        self.timing = TimestampTracker(self.f_led_input.value())
+        self.timing_reader = self.frame_ring.reader()
+
+        # set callback, or start the polling thread / grabber
+        if mode == "polling":
+            self.acquisition = PollingAcquisition(self.hCamera, self.frame_ring, out_format)
+            self.acquisition.start()
+        elif mode == "grabber":
+            self.acquisition = GrabberAcquisition(self.grabber, self.frame_ring, camera_config["TRIGGERED_ONLY"])
+            self.acquisition.start()
+        else:
+            mvsdk.CameraSetCallbackFunction(self.hCamera, self.GrabCallback, None)
+            self.callback_registered = True
+
+        self.stream_ring = self.frame_ring
+        if self.config["FLATFIELD"]["ENABLED"]:
+            self.start_flatfield()
+        if self.config["BINNING"]["FACTOR"] > 1:
+            self.binner = BinningStage(self.stream_ring, self.config["BINNING"]["FACTOR"],
+                                       self.config["BINNING"]["MODE"])
+            self.stream_ring = self.binner.output
+            self.stages.append(self.binner)
+
+        if self.config["MOTION"]["ENABLED"]:
+            config = self.config["MOTION"]
+            self.motion = MotionStage(self.stream_ring, config["BIN"], config["BATCH_FRAMES"],
+                                      config["REFERENCE_FRAMES"], config["SMOOTHING"])
+            self.stream_ring = self.motion.output
+            self.stages.append(self.motion)
+
+        channels = self.config["DEMUX"]["CHANNELS"]
+        if channels:
+            self.demux = ChannelDemux(self.stream_ring, channels, 1.0 / self.f_led_input.value(),
+                                      self.config["DEMUX"]["PHASE"], stride=self.config["DEMUX"]["STRIDE"])
+            self.stages.append(self.demux)
+
+        if self.config["DFF"]["ENABLED"]:
+            self.start_dff()
+        if self.config["HEMO"]["ENABLED"]:
+            self.start_hemo()
+        if self.config["PHASEMAP"]["ENABLED"]:
+            self.start_phasemap()
+        if self.config["SVD"]["ENABLED"]:
+            config = self.config["SVD"]
+            ring = self.stream_ring
+            if self.demux:
+                ring = self.demux.rings[config["CHANNEL"] or self.demux.channels[0]]
+            self.svd = SVDStage(ring, config["RANK"], config["BIN"], config["TRAIN_FRAMES"],
+                                max_frames=config["MAX_FRAMES"])
+            self.stages.append(self.svd)
+        if self.config["TRIALS"]["ENABLED"]:
+            self.start_trials()
+        if self.config["REGIONS"]["ENABLED"]:
+            self.start_regions()
+        self.start_preview()
+        if self.config["MONITOR"]["ENABLED"]:
+            self.histogram = HistogramStage(self.frame_ring, self.config["MONITOR"]["RATE"],
+                                            self.config["MONITOR"]["STRIDE"])
+            self.stages.append(self.histogram)
+        for stage in self.stages:
+            stage.start()
+
+    def teardown_pipeline(self):
+        """Stop recording, acquisition and every stage, and free the rings (the camera stays open)."""
+        if self.recorders:
+            self.toggle_recording()  # finish the files and sidecars before the rings go away
+        if self.acquisition:
+            self.acquisition.stop()
+        if self.callback_registered:
+            mvsdk.CameraSetCallbackFunction(self.hCamera, None, None)  # no late frame may land in a ring being freed
+            self.callback_registered = False
+        if self.flatfield and self.flatfield.hardware:
+            self.flatfield.set_hardware(False)
+        for stage in self.stages:
+            stage.stop()  # upstream first, so each stage drains what the previous one produced
+        self.stages = []
+        self.calibration = None
+        self.binner = self.flatfield = self.motion = self.demux = self.dff = self.hemo = self.phasemap = self.svd = self.trials = self.regions = self.preview = self.histogram = None
+        if self.focus:
+            self.focus_button.setChecked(False)  # the stage itself was stopped above
+        if self.frame_ring:
+            self.frame_ring.close()
+        self.frame_ring = self.stream_ring = None
+        self.timing = self.timing_reader = None
+
+    def apply_roi(self, roi):
+        """Crop to `roi` (x, y, width, height in sensor pixels; None = full frame) and rebuild the pipeline.
+
+        Measures the free-running frame rate and link bandwidth before and after, so
+        the effect of the crop is reported. Both measurements run with the pipeline
+        torn down (recording stopped), so the untriggered frames never reach the
+        ring, the recorders or the stages; the trigger mode is restored after each.
+        """
+        if not self.hCamera:
+            print("No camera.")
+            return
+        had_pipeline = self.frame_ring is not None
+        self.teardown_pipeline()
+        before = None
+        if had_pipeline:
+            before = measure_max_rate(self.hCamera, self.pixel_format.frame_nbytes(self.height, self.width))
+        self.config["CAMERA"]["ROI"] = list(clamp_roi(self.cap, roi)) if roi else None
+        mvsdk.CameraPause(self.hCamera)
+        try:
+            self.configure_sensor()
+        finally:
+            mvsdk.CameraPlay(self.hCamera)
+        after = measure_max_rate(self.hCamera, self.pixel_format.frame_nbytes(self.height, self.width))
+        mvsdk.CameraPause(self.hCamera)
+        try:
+            self.build_pipeline(sensor_configured=True)
+        finally:
+            mvsdk.CameraPlay(self.hCamera)
+        lines = [f"{label}: max {rate[0]:.1f} fps, {rate[1] / 1e6:.1f} MB/s"
+                 for label, rate in (("before", before), ("after", after)) if rate]
+        self.roi_report = f"ROI {self.config['CAMERA']['ROI'] or 'full frame'}: " + "; ".join(lines)
+        print(self.roi_report)
+
+    def apply_roi_from_inputs(self):
+        x, y, width, height = (box.value() for box in self.roi_inputs)
+        self.apply_roi([x, y, width, height] if width and height else None)
+
+    def select_media_type(self, cap):
+        """Apply CAMERA: MEDIA_TYPE if set and return the PixelFormat the camera now delivers."""
+        media_types = [cap.pMediaTypeDesc[i] for i in range(cap.iMediaTypeDesc)]
+        wanted = self.config["CAMERA"]["MEDIA_TYPE"]
+        if wanted:
+            fmt = pixelformat.from_name(wanted)
+            for index, media_type in enumerate(media_types):
+                if media_type.iMediaType == fmt.media_type:
+                    mvsdk.CameraSetMediaType(self.hCamera, index)
+                    break
+            else:
+                print(f"Camera does not support {wanted}, keeping its current format.")
+        current = media_types[mvsdk.CameraGetMediaType(self.hCamera)].iMediaType
+        return pixelformat.from_media_type(current)
+
+    def start_flatfield(self):
+        """Put dark/flat-field correction first in the stream, in software or in the SDK (FLATFIELD: HARDWARE)."""
+        config = self.config["FLATFIELD"]
+        try:
+            field = load_flat_field(config["PATH"])
+        except (OSError, ValueError) as e:
+            print(f"FLATFIELD: cannot use {config['PATH']!r}: {e}")
+            return
+        if config["HARDWARE"]:
+            if self.config["CAMERA"]["ACQUISITION_MODE"] != "polling":
+                print("FLATFIELD: the SDK only flat-fields frames it processes (polling mode); correcting in software.")
+            else:
+                try:
+                    # frames reach the ring corrected, so nothing runs and the stream stays on it
+                    self.flatfield = FlatFieldStage(self.frame_ring, field, self.hCamera, self.pixel_format.media_type,
+                                                    hardware=True)
+                    return
+                except (mvsdk.CameraException, ValueError) as e:
+                    print(f"FLATFIELD: SDK flat-fielding failed ({e}); correcting in software.")
+                    if field.bits is not None and field.bits != self.pixel_format.bits:
+                        print("FLATFIELD: for HARDWARE, acquire the dark and flat images in copy or grabber mode.")
+        try:
+            self.flatfield = FlatFieldStage(self.frame_ring, field)
+        except ValueError as e:
+            print(f"FLATFIELD: cannot use {config['PATH']!r}: {e}")
+            return
+        self.stream_ring = self.flatfield.output
+        self.stages.append(self.flatfield)
+
+    def acquire_calibration(self, kind):
+        """Average FLATFIELD: CALIBRATION_FRAMES camera frames as the "dark" (sensor covered) or "flat" image."""
+        if self.frame_ring is None or self.calibration:
+            print("Calibration needs the ring buffer, and one stack at a time.")
+            return
+        if self.flatfield and self.flatfield.hardware:
+            self.flatfield.set_hardware(False)  # average uncorrected frames
+        stage = CalibrationStage(self.frame_ring, self.config["FLATFIELD"]["CALIBRATION_FRAMES"])
+        stage.start()
+        self.stages.append(stage)
+        self.calibration = (kind, stage)
+        print(f"Acquiring {stage.num_frames} {kind} frames...")
+
+    def check_calibration(self):
+        """Keep a finished dark/flat average; once both exist, save the maps and rebuild the pipeline with them."""
+        kind, stage = self.calibration
+        if not stage.done.is_set():
+            return
+        stage.stop()
+        self.stages.remove(stage)
+        self.calibration = None
+        image = stage.mean()
+        self.calibration_images[kind] = (image, stage.bits)
+        print(f"{kind} image: mean {image.mean():.1f} over {stage.count} {stage.bits}-bit frames")
+        if len(self.calibration_images) < 2:
+            return
+        config = self.config["FLATFIELD"]
+        (dark, dark_bits), (flat, flat_bits) = self.calibration_images.pop("dark"), self.calibration_images.pop("flat")
+        try:
+            if dark_bits != flat_bits:
+                raise ValueError(f"dark frames were {dark_bits}-bit, flat frames {flat_bits}-bit")
+            field = FlatField(dark, flat, bits=flat_bits)
+        except ValueError as e:
+            print(f"Flat-field calibration failed: {e}")
+            return
+        field.save(config["PATH"])
+        print(f"Flat-field maps saved to {config['PATH']} ({field.bad_pixels} pixels left uncorrected)")
+        if config["ENABLED"]:
+            self.apply_roi(self.config["CAMERA"]["ROI"])  # rebuilds the pipeline, which loads the new maps
+
+    def start_dff(self):
+        """Start the live ΔF/F stage on the whole stream, or on one LED channel when demultiplexing."""
+        config = self.config["DFF"]
+        ring = self.stream_ring
+        if self.demux:
+            ring = self.demux.rings[config["CHANNEL"] or self.demux.channels[0]]
+        fps = self.f_led_input.value() / (len(self.demux.channels) if self.demux else 1)
+        engine = DffEngine(ring.pixel_shape, config["BASELINE"],
+                           tau_frames=max(1, int(config["TAU_S"] * fps)),
+                           window_frames=max(1, int(config["WINDOW_S"] * fps)),
+                           percentile=config["PERCENTILE"], bin_factor=config["BIN"])
+        self.dff = DffStage(ring, engine, config["OUTPUT_HZ"])
+        self.stages.append(self.dff)
+
+    def start_hemo(self):
+        """Start live hemodynamic correction on the demultiplexed fluorescence/reflectance channels."""
+        config = self.config["HEMO"]
+        if not self.demux:
+            print("Hemodynamic correction needs DEMUX: CHANNELS with a fluorescence and a reflectance channel.")
+            return
+        self.hemo = HemoStage(self.demux, config["FLUORESCENCE"], config["REFLECTANCE"], config["BIN"],
+                              config["OUTPUT_HZ"])
+        self.stages.append(self.hemo)
+
+    def start_phasemap(self):
+        """Start accumulating amplitude/phase maps on the stream, or on one LED channel when demultiplexing."""
+        config = self.config["PHASEMAP"]
+        ring = self.stream_ring
+        if self.demux:
+            ring = self.demux.rings[config["CHANNEL"] or self.demux.channels[0]]
+        accumulator = PhaseAccumulator(ring.pixel_shape, config["FREQUENCY_HZ"], config["BIN"])
+        self.phasemap = PhaseMapStage(ring, accumulator, config["OUTPUT_HZ"])
+        self.stages.append(self.phasemap)
+
+    def start_trials(self):
+        """Start trial averaging on the stream, or on one LED channel when demultiplexing."""
+        config = self.config["TRIALS"]
+        ring = self.stream_ring
+        if self.demux:
+            ring = self.demux.rings[config["CHANNEL"] or self.demux.channels[0]]
+        fps = self.f_led_input.value() / (len(self.demux.channels) if self.demux else 1)
+        pre, post = int(round(config["PRE_S"] * fps)), int(round(config["POST_S"] * fps))
+        if pre >= ring.capacity:
+            print(f"TRIALS: PRE_S needs {pre} frames but the ring holds {ring.capacity}; raise RING_CAPACITY.")
+        try:
+            averager = TrialAverager(ring.pixel_shape, pre, post, config["BIN"])
+        except ValueError as e:
+            print(f"TRIALS: {e} at {fps:.1f} frames/s; raise POST_S.")
+            return
+        self.trials = TrialStage(ring, averager)
+        self.stages.append(self.trials)
+
+    def start_regions(self):
+        """Start extracting region traces from the stream, or from one LED channel when demultiplexing."""
+        config = self.config["REGIONS"]
+        ring = self.stream_ring
+        if self.demux:
+            ring = self.demux.rings[config["CHANNEL"] or self.demux.channels[0]]
+        try:
+            labels = np.load(config["LABELS"])
+            if labels.ndim == 3:
+                projector = RegionProjector.from_masks(labels)
+            else:
+                projector = RegionProjector.from_labels(labels)
+            self.regions = RegionStage(ring, projector)
+        except (OSError, ValueError) as e:
+            print(f"REGIONS: cannot use {config['LABELS']!r}: {e}")
+            return
+        self.stages.append(self.regions)
+
+    def poll_arduino_events(self):
+        """Hand stimulus events the Arduino has sent since the last call to the trial averager."""
+        if not self.arduino or not self.trials:
+            return
+        prefix = self.config["TRIALS"]["EVENT_PREFIX"]
+        while self.arduino.in_waiting:
+            line = self.arduino.readline().decode("utf-8", "replace").strip()
+            fields = line.split()
+            if fields and fields[0] == prefix:
+                # host time at arrival, on the same clock as the frames' sys_timestamps
+                self.trials.add_event(time.time(), fields[1] if len(fields) > 1 else "0")
+            elif line:
+                print(f"Arduino: {line}")
+
+    def draw_phasemap(self):
+        """Render the newest phase map into phase_label."""
+        _, amplitude, phase = self.phasemap.latest
+        image = phase_image(amplitude, phase)
+        height, width = image.shape[:2]
+        pixmap = QPixmap.fromImage(QImage(image.data, width, height, 3 * width, QImage.Format_RGB888))
+        self.phase_label.setPixmap(pixmap.scaled(self.phase_label.size(), Qt.KeepAspectRatio))
+
+    def start_preview(self):
+        """Start the live preview on the stream, or on one LED channel when demultiplexing."""
+        config = self.config["PREVIEW"]
+        ring = self.stream_ring
+        if self.demux:
+            ring = self.demux.rings[config["CHANNEL"] or self.demux.channels[0]]
+        bits = None
+        if self.binner and self.binner.mode == "sum":
+            # block sums carry 2 log2(factor) more bits than the camera pixels
+            bits = self.pixel_format.bits + 2 * int(np.ceil(np.log2(self.binner.factor)))
+        colormap = getattr(cv2, f"COLORMAP_{config['COLORMAP'].upper()}") if config["COLORMAP"] else None
+        preview = PreviewStage(ring, (self.video_label.width(), self.video_label.height()), config["RATE"], bits,
+                               colormap=colormap, window=config["WINDOW"], auto_levels=config["AUTO_LEVELS"])
+        # the signal carries the stage, which keeps the buffer under its image alive until it is drawn
+        preview.on_image = lambda image: self.preview_ready.emit(preview)
+        self.preview = preview
+        self.stages.append(preview)
+
+    def show_preview(self, preview):
+        """GUI-thread end of the preview: copy the image into the label, then let the stage draw the next."""
+        if preview is self.preview and self.camera_running:
+            self.video_label.setPixmap(QPixmap.fromImage(preview.image))
+        preview.displayed()
 
     def initialize_arduino(self):
         try:
@@ -290,14 +876,160 @@ class MainWindow(QMainWindow):
     def closeEvent(self, event):
         self.save_config()  # Save current settings
         self.camera_running = False
-        if self.display_thread:
-            self.display_thread.join()
-        if self.hCamera:
+        print(f"Acquisition stats: {self.stats_text()}")
+        self.teardown_pipeline()
+        if isinstance(self.acquisition, GrabberAcquisition):
+            self.acquisition.close()  # destroys the grabber and the camera it opened
+        elif self.hCamera:
             mvsdk.CameraUnInit(self.hCamera)
         if self.arduino:
             self.arduino.close()
         event.accept()
 
+    def stats_text(self):
+        """One-line summary of acquisition throughput and losses for the current mode."""
+        if self.frame_ring is None:
+            return "idle"
+        if isinstance(self.acquisition, GrabberAcquisition):
+            stat = self.acquisition.stat()
+            return (f"{stat.CapFps:.1f} fps, captured {stat.Capture}, lost {stat.Lost}, "
+                    f"errors {stat.Error}, filtered {self.acquisition.filtered}")
+        now, frames = time.time(), self.frame_ring.write_seq
+        last_time, last_frames = self.last_stats
+        self.last_stats = (now, frames)
+        text = f"{(frames - last_frames) / (now - last_time):.1f} fps, frames {frames}"
+        if isinstance(self.acquisition, PollingAcquisition):
+            text += f", timeouts {self.acquisition.timeouts}, errors {self.acquisition.errors}"
+        text += f", size mismatches {self.frame_ring.size_mismatches}"
+        if self.motion and self.motion.latest:
+            _, _, dy, dx, peak = self.motion.latest
+            text += f"; motion {dy:+.1f}, {dx:+.1f} px (peak {peak:.2f}), overruns {self.motion.overruns}"
+        if self.demux:
+            text += f"; channels: {self.demux.summary()}, overruns {self.demux.overruns}"
+        if self.dff and self.dff.latest:
+            dff_map = self.dff.latest[1]
+            text += f"; ΔF/F {np.percentile(dff_map, 1):+.3f}..{np.percentile(dff_map, 99):+.3f}, stage overruns {self.dff.overruns}"
+        if self.phasemap:
+            accumulator = self.phasemap.accumulator
+            text += (f"; phase map {accumulator.frames} frames, {accumulator.cycles():.1f} cycles, "
+                     f"stage overruns {self.phasemap.overruns}")
+        if self.trials:
+            summary = self.trials.averager.summary()
+            counts = ", ".join(f"{condition} {trials}" for condition, trials in summary.items())
+            text += (f"; trials done {self.trials.trials_done} ({counts or 'none yet'}), "
+                     f"missed {self.trials.missed}, stage overruns {self.trials.overruns}")
+        if self.flatfield:
+            if self.flatfield.hardware:
+                text += "; flat-field in SDK"
+            else:
+                text += f"; flat-field in software, stage overruns {self.flatfield.overruns}"
+        if self.calibration:
+            kind, stage = self.calibration
+            text += f"; {kind} frames {stage.count}/{stage.num_frames}"
+        if self.regions:
+            text += f"; {len(self.regions.projector)} region traces, stage overruns {self.regions.overruns}"
+        if self.svd:
+            svd = self.svd
+            if svd.U is not None:
+                state = f"{svd.projected} frames projected ({svd.dropped} dropped)"
+            else:
+                state = "fitting components" if svd.fitting else "learning components"
+            text += f"; SVD {state}, {svd.skipped} skipped while fitting, stage overruns {svd.overruns}"
+        if self.hemo:
+            text += f"; hemo correction {self.hemo.regression.n} pairs, stage overruns {self.hemo.overruns}"
+        for recorder in self.recorders:
+            text += (f"; recording {os.path.basename(recorder.prefix)} {recorder.throughput() / 1e6:.1f} MB/s, "
+                     f"backlog {recorder.backlog}, overruns {recorder.overruns}")
+            if isinstance(recorder, ChunkedRecorder):
+                status = "keeping up" if recorder.keeping_up() else "FALLING BEHIND"
+                text += f", {recorder.codec} {recorder.ratio():.1f}x, {status}"
+        return text
+
+    def update_timing(self):
+        """Feed the frames that arrived since the last tick to the timestamp tracker."""
+        ring = self.frame_ring
+        overruns = self.timing_reader.overruns
+        seqs = self.timing_reader.read_many(ring.capacity, timeout=0)
+        if self.timing_reader.overruns != overruns:
+            self.timing.resync()  # frames we skipped are not camera drops
+        if seqs:
+            slots = np.arange(seqs.start, seqs.stop) % ring.capacity
+            self.timing.update(ring.cam_timestamps[slots], ring.sys_timestamps[slots])
+
+    def update_stats(self):
+        text = self.stats_text()
+        for stage in self.stages:
+            if stage.errors:
+                text += f"; {stage.name} FAILED on {stage.errors} batches ({stage.last_error})"
+        if self.timing is not None:
+            self.update_timing()
+            text += f"; timing: {self.timing.summary()}"
+        if self.roi_report:
+            text += f"; {self.roi_report}"
+        if self.histogram and self.histogram.latest:
+            text += f"; {self.histogram.summary()}"
+            if self.histogram.saturated > self.config["MONITOR"]["SATURATION_WARN"]:
+                text += " - SATURATING, lower gain or exposure"
+            self.draw_histogram()
+        if self.phasemap and self.phasemap.latest:
+            self.draw_phasemap()
+        if self.calibration:
+            self.check_calibration()
+        if self.focus and self.focus.count:
+            text += f"; focus {self.focus.score:.4g}, peak {self.focus.peak:.4g}"
+        self.stats_label.setText(f"Acquisition: {text}")
+
+    @staticmethod
+    def draw_bars(label, values, top=None):
+        """Draw `values` as a bar chart scaled so `top` (default: the largest value) fills `label`."""
+        height, width = label.height(), label.width()
+        top = top or values.max()
+        bars = (np.nan_to_num(values) * (height / max(top, 1e-12))).astype(int)
+        columns = np.repeat(bars, -(-width // len(bars)))[:width]
+        image = np.zeros((height, width), np.uint8)
+        image[:, :len(columns)] = np.where(np.arange(height)[::-1, None] < columns, 200, 0)
+        label.setPixmap(QPixmap.fromImage(QImage(image.data, width, height, width, QImage.Format_Grayscale8)))
+
+    def draw_histogram(self):
+        """Draw the monitor's newest histogram as bars of log counts into histogram_label."""
+        _, counts, saturated = self.histogram.latest
+        self.draw_bars(self.histogram_label, np.log1p(counts))
+        warn = saturated > self.config["MONITOR"]["SATURATION_WARN"]
+        self.histogram_label.setStyleSheet(f"background-color: black; border: 2px solid {'red' if warn else 'black'};")
+
+    def toggle_focus(self, on):
+        """Start or stop the focus assist stage on the preview's ring."""
+        if on and self.preview and not self.focus:
+            config = self.config["FOCUS"]
+            try:
+                self.focus = FocusStage(self.preview.ring, config["RATE"], config["ROI"], config["BIN"],
+                                        method=config["METHOD"], hCamera=self.hCamera,
+                                        algorithm=config["SDK_ALGORITHM"])
+            except ValueError as e:
+                print(f"FOCUS: {e}")
+                self.focus_button.setChecked(False)
+                return
+            self.focus.start()
+            self.stages.append(self.focus)
+            self.focus_label.show()
+            self.focus_timer.start(100)  # the plot needs to keep up with a hand on the focus knob
+        elif not on and self.focus:
+            if self.focus in self.stages:
+                self.focus.stop()
+                self.stages.remove(self.focus)
+            self.focus = None
+            self.focus_timer.stop()
+            self.focus_label.hide()
+            self.focus_button.setText("Focus Assist")
+
+    def draw_focus(self):
+        """Plot the focus score history scaled to its peak, and show the newest score against the peak."""
+        if not self.focus or not self.focus.count:
+            return
+        peak = self.focus.peak
+        self.draw_bars(self.focus_label, self.focus.scores()[-self.focus_label.width():], peak)
+        self.focus_button.setText(f"Focus {self.focus.score / peak:.0%} of peak" if peak > 0 else "Focus Assist")
+
     # looking back at it I hate this function and should probably just remove it
     def retry_arduino_connection(self):
         self.initialize_arduino()
@@ -348,7 +1080,6 @@ class MainWindow(QMainWindow):
         print("Triggering capture...")
         self.send_arduino_command(b'X\n')  # Command Arduino to begin capture
         self.camera_running = True
-        self.camera_feed_event.set()  # Start the camera feed
 
     def stop_capture(self):
         """Stop the capture process by sending the appropriate command to the Arduino."""
@@ -358,8 +1089,7 @@ class MainWindow(QMainWindow):
 
         print("Stopping capture...")
         self.send_arduino_command(b'Q\n')  # Command Arduino to stop capturing
-        self.camera_running = False 
-        self.camera_feed_event.clear() # Stop the camera feed
+        self.camera_running = False
         self.send_arduino_command(b'STOP\n')  # might need to replace stop command with whatever the arduino code uses
         # Reset the live preview
         self.video_label.setStyleSheet("background-color: black;")
@@ -370,12 +1100,11 @@ class MainWindow(QMainWindow):
 
     @mvsdk.method(mvsdk.CAMERA_SNAP_PROC)
     def GrabCallback(self, hCamera, pRawData, pFrameHead, pContext):
-        # print("GrabCallback") 
         try:
-            # Convert the buffer to a NumPy array
-            # print("Callback triggered")
-            frame_data = (mvsdk.c_ubyte * pFrameHead.contents.uBytes).from_address(pRawData)
-            self.frame_queue.put(frame_data)
+            # Copy frame and header into the next preallocated ring slot before handing the buffer back to the SDK
+            ring = self.frame_ring
+            if ring is not None:  # a frame already in flight during teardown
+                ring.write_from_head(pRawData, pFrameHead)
         finally:
             mvsdk.CameraReleaseImageBuffer(hCamera, pRawData)
 
@@ -383,23 +1112,75 @@ class MainWindow(QMainWindow):
 
 
     def save_frames(self):
-        """Capture and save the current frame."""
+        """Save the newest frame losslessly as a PNG snapshot (use recording for continuous data)."""
+        latest = self.frame_ring.latest() if self.frame_ring else None
+        if latest is None:
+            print("No frame to save yet.")
+            return
         try:
-            FrameHead, pFrameBuffer, FrameData = mvsdk.CameraGetImageBuffer(self.hCamera, 200)
-            frame = np.frombuffer(FrameData, dtype=np.uint8).reshape((self.height, self.width))
-            
-            # Use the save directory from the config
+            seq, frame = latest
             save_dir = self.config["CAMERA"].get("SAVE_DIR", "C://OWFI/")
-            filename = os.path.join(save_dir, f"capture_{int(time.time())}.jpg")
-            
             os.makedirs(save_dir, exist_ok=True)  # Ensure directory exists
-            cv2.imwrite(filename, frame)
+            filename = os.path.join(save_dir, f"capture_{int(time.time())}_{seq}.png")
+            frame = self.frame_ring.unpacked(frame)  # 16-bit PNG for >8-bit formats
+            cv2.imwrite(filename, frame.copy())  # copy so the ring can't change it mid-encode
             print(f"Frame saved as {filename}")
-
-            mvsdk.CameraReleaseImageBuffer(self.hCamera, FrameHead)
         except Exception as e:
             print(f"Failed to save frame: {e}")
 
+    def toggle_recording(self):
+        """Start or stop streaming every frame to a raw file in SAVE_DIR (one file per LED channel if demultiplexing)."""
+        if self.recorders:
+            for recorder in self.recorders:
+                recorder.stop()
+                print(f"Recording saved to {recorder.path}: {recorder.frames_written} frames, "
+                      f"{recorder.overruns} overruns, {recorder.torn} torn")
+            self.recorders = []
+            if self.motion:
+                self.motion.log_to(None)
+            if self.regions:
+                self.regions.log_to(None)
+            if self.trials and self.trials.averager.summary():
+                self.trials.averager.save(self.recording_prefix + "_trials.npz")
+                print(f"Trial averages saved to {self.recording_prefix}_trials.npz")
+            if self.svd and self.svd.U is not None:
+                # everything projected since the pipeline started; match it to the recording by seq or timestamp
+                self.svd.save(self.recording_prefix + "_svd")
+                kept = self.svd.projected - self.svd.dropped
+                print(f"SVD of the stream saved to {self.recording_prefix}_svd ({kept} frames)")
+            self.record_button.setText("Start Recording")
+            return
+        if self.frame_ring is None:
+            print("Recording needs the ring buffer (not available without a camera).")
+            return
+
+        save_dir = self.config["CAMERA"].get("SAVE_DIR", "C://OWFI/")
+        prefix = self.recording_prefix = os.path.join(save_dir, time.strftime("recording_%Y%m%d_%H%M%S"))
+        rec_config = self.config["RECORDING"]
+        streams = {"": self.stream_ring}
+        if self.demux:
+            streams = {f"_{name}": ring for name, ring in self.demux.rings.items()}
+        for suffix, ring in streams.items():
+            if rec_config["FORMAT"] == "chunked":
+                recorder = ChunkedRecorder(ring, prefix + suffix, rec_config["CODEC"], rec_config["LEVEL"],
+                                           rec_config["CHUNK_FRAMES"], rec_config["WORKERS"] or None)
+            else:
+                recorder = RawRecorder(ring, prefix + suffix, rec_config["BATCH_FRAMES"],
+                                       rec_config["PREALLOCATE_MB"] * 1024 * 1024)
+            recorder.start()
+            self.recorders.append(recorder)
+        if self.motion:
+            self.motion.log_to(prefix + "_shifts.bin")  # matched to the frames by seq, or cam_timestamp per channel
+        if self.regions:
+            self.regions.log_to(prefix)
+        if self.flatfield:
+            self.flatfield.field.save(prefix + "_flatfield.npz")  # the maps these frames were corrected with
+        height, width = self.stream_ring.pixel_shape
+        bytes_per_pixel = self.stream_ring.frame_nbytes / (width * height)  # 1.5 for 12-bit packed
+        needed = required_bandwidth(width, height, bytes_per_pixel, self.f_led_input.value())
+        print(f"Recording to {prefix}{'_<channel>' if self.demux else ''} "
+              f"(needs {needed / 1e6:.1f} MB/s at {self.f_led_input.value()} Hz)")
+        self.record_button.setText("Stop Recording")
 
     def adjust_exposure(self, value):
         """Adjust the camera's exposure."""
@@ -417,23 +1198,6 @@ class MainWindow(QMainWindow):
         except Exception as e:
             print(f"Failed to adjust gain: {e}")
 
-    def save_frames(self):
-        """Capture and save the current frame."""
-        try:
-            FrameHead, pFrameBuffer, FrameData = mvsdk.CameraGetImageBuffer(self.hCamera, 200)
-            frame = np.frombuffer(FrameData, dtype=np.uint8)
-            frame = frame.reshape((FrameHead.iHeight, FrameHead.iWidth))
-
-            filename = f"capture_{int(time.time())}.jpg"
-            cv2.imwrite(filename, frame)
-            print(f"Frame saved as {filename}")
-
-            mvsdk.CameraReleaseImageBuffer(self.hCamera, FrameHead)
-        except Exception as e:
-            print(f"Failed to save frame: {e}")
-
-
-
 # Run the application
 app = QApplication([])
 
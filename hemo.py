@@ -0,0 +1,307 @@
+"""Hemodynamic correction of fluorescence with the reflectance channel.
+
+Blood absorbs both the excitation light and the fluorescence, so part of every
+fluorescence change is really a change in reflectance. Per pixel, the normalized
+fluorescence F/F̄ - 1 is regressed on the normalized reflectance R/R̄ - 1 and the
+fitted part is subtracted:
+
+    corrected = (F/F̄ - 1) - β (R/R̄ - 1),   β = cov(F, R) / var(R) · R̄ / F̄
+
+F̄, R̄ and β only need per-pixel running sums, so the same HemoRegression serves
+the live stage (sums grow as frames arrive) and the offline pass over a recording,
+which runs two streaming passes (sums, then correction) per spatial tile in a
+process pool, so neither RAM nor the wall clock depend on one core holding the
+whole movie. Both pair frames by LED cycle (live from the demultiplexer, offline
+from the camera timestamps), so a dropped frame loses one pair, not the pairing.
+"""
+import collections
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from binning import bin_frames, binned_shape
+from recording import open_recording, write_recording_files
+from stage import FrameStage
+from timestamps import CAMERA_TICK, unwrap_ticks
+
+
+class HemoRegression:
+    """Per-pixel running sums of fluorescence/reflectance pairs and the correction they imply.
+
+    Sums are float64 and taken relative to the first pair, which keeps var(R) and
+    cov(F, R) accurate over millions of frames.
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.n = 0
+        self.f0 = np.zeros(self.shape, np.float64)
+        self.r0 = np.zeros(self.shape, np.float64)
+        self.sf = np.zeros(self.shape, np.float64)
+        self.sr = np.zeros(self.shape, np.float64)
+        self.srr = np.zeros(self.shape, np.float64)
+        self.sfr = np.zeros(self.shape, np.float64)
+        self._df = np.zeros(self.shape, np.float64)
+        self._dr = np.zeros(self.shape, np.float64)
+        self._prod = np.zeros(self.shape, np.float64)
+
+    def add(self, f, r):
+        """Add one pair of frames, in place."""
+        if self.n == 0:
+            np.copyto(self.f0, f)
+            np.copyto(self.r0, r)
+        np.subtract(f, self.f0, out=self._df)
+        np.subtract(r, self.r0, out=self._dr)
+        self.sf += self._df
+        self.sr += self._dr
+        np.multiply(self._dr, self._dr, out=self._prod)
+        self.srr += self._prod
+        np.multiply(self._df, self._dr, out=self._prod)
+        self.sfr += self._prod
+        self.n += 1
+
+    def add_batch(self, fs, rs):
+        """Add (k, ...) stacks of pairs at once (allocates k-frame temporaries; for offline chunks)."""
+        if len(fs) == 0:
+            return
+        if self.n == 0:
+            np.copyto(self.f0, fs[0])
+            np.copyto(self.r0, rs[0])
+        df = fs - self.f0
+        dr = rs - self.r0
+        self.sf += df.sum(axis=0)
+        self.sr += dr.sum(axis=0)
+        self.srr += np.einsum("k...,k...->...", dr, dr)
+        self.sfr += np.einsum("k...,k...->...", df, dr)
+        self.n += len(fs)
+
+    def coefficients(self, eps=1e-6):
+        """(F̄, R̄, β) per pixel from the pairs seen so far."""
+        n = max(self.n, 1)
+        mean_df, mean_dr = self.sf / n, self.sr / n
+        var_r = self.srr / n - mean_dr * mean_dr
+        cov = self.sfr / n - mean_df * mean_dr
+        mean_f, mean_r = self.f0 + mean_df, self.r0 + mean_dr
+        beta = cov / np.maximum(var_r, eps) * mean_r / np.maximum(mean_f, eps)
+        return mean_f.astype(np.float32), mean_r.astype(np.float32), beta.astype(np.float32)
+
+
+def correct(f, r, mean_f, mean_r, beta, out, scratch):
+    """Write (F/F̄ - 1) - β (R/R̄ - 1) into `out`, using `scratch` (both float32, shape of f) for R."""
+    np.divide(f, mean_f, out=out)
+    np.divide(r, mean_r, out=scratch)
+    scratch -= 1
+    scratch *= beta
+    out -= 1
+    out -= scratch
+    return out
+
+
+class HemoStage(FrameStage):
+    """Live hemodynamic correction on two channels of a ChannelDemux.
+
+    Reads the `fluorescence` ring, and the `reflectance` ring through a reader of
+    its own. Each fluorescence frame is paired with the reflectance frame of the
+    same LED cycle (demux.cycles); when that frame was dropped or overwritten the
+    fluorescence frame is counted in `unpaired` and skipped. Pairs go into the
+    running regression, and a corrected map is published `output_hz` times a
+    second (latest / on_map, double-buffered like DffStage). Early maps use few
+    pairs and settle as the sums grow.
+    """
+
+    name = "HemoStage"
+
+    def __init__(self, demux, fluorescence="fluorescence", reflectance="reflectance", bin_factor=4, output_hz=5.0,
+                 on_map=None, wait=0.1):
+        super().__init__(demux.rings[fluorescence])
+        self.reflectance = demux.rings[reflectance]
+        self.wait = wait  # how long a fluorescence frame waits for a reflectance frame not demultiplexed yet
+        self._f_cycles = demux.cycles[fluorescence]
+        self._r_cycles = demux.cycles[reflectance]
+        self._r_reader = None
+        self._pending = collections.deque()  # (cycle, seq) of reflectance frames read but not yet paired
+        self.bin_factor = bin_factor
+        fmt = self.ring.pixel_format
+        self.pixel_shape = self.ring.pixel_shape
+        self.shape = binned_shape(*self.pixel_shape, bin_factor)
+        self.regression = HemoRegression(self.shape)
+        self.output_interval = 1.0 / output_hz
+        self.on_map = on_map
+        self.latest = None
+        self.maps_published = 0
+        self.unpaired = 0
+        self._f = np.zeros(self.shape, np.float32)
+        self._r = np.zeros(self.shape, np.float32)
+        self._scratch = np.zeros(self.shape, np.float32)
+        self._maps = np.zeros((2,) + self.shape, np.float32)
+        self._unpacked = None
+        if fmt is not None and fmt.packed:
+            self._unpacked = np.empty(self.pixel_shape, fmt.dtype)
+        self._last_output = 0.0
+
+    def _load(self, ring, frame, out):
+        bin_frames(ring.unpacked(frame, self._unpacked), self.bin_factor, out)
+
+    def start(self):
+        self._r_reader = self.reflectance.reader()
+        super().start()
+
+    def _match(self, cycle):
+        """Seq of the reflectance frame of LED cycle `cycle`, or None if there is none."""
+        ring, pending = self.reflectance, self._pending
+        timeout = 0
+        while True:
+            for r_seq in self._r_reader.read_many(ring.capacity, timeout):
+                pending.append((int(self._r_cycles[r_seq % ring.capacity]), r_seq))
+            while pending and pending[0][0] < cycle:
+                pending.popleft()  # its fluorescence frame was dropped
+            if pending:
+                if pending[0][0] > cycle:
+                    return None  # this cycle's reflectance frame was dropped
+                r_seq = pending.popleft()[1]
+                return r_seq if ring.is_valid(r_seq) else None
+            if timeout:
+                return None
+            timeout = self.wait
+
+    def process(self, seq, frame):
+        r_seq = self._match(int(self._f_cycles[seq % self.ring.capacity]))
+        if r_seq is None:
+            self.unpaired += 1
+            return
+        self._load(self.ring, frame, self._f)
+        self._load(self.reflectance, self.reflectance.frames[r_seq % self.reflectance.capacity], self._r)
+        self.regression.add(self._f, self._r)
+        now = time.perf_counter()
+        if now - self._last_output < self.output_interval or self.regression.n < 2:
+            return
+        self._last_output = now
+        out = self._maps[self.maps_published % 2]
+        correct(self._f, self._r, *self.regression.coefficients(), out, self._scratch)
+        self.maps_published += 1
+        self.latest = (seq, out)
+        if self.on_map is not None:
+            self.on_map(seq, out)
+
+
+def pair_frames(f_records, r_records, channels=2):
+    """Indices into each channel's FRAME_DTYPE records of the fluorescence/reflectance pairs of one LED cycle.
+
+    Frames are numbered by camera time, like ChannelDemux.frame_numbers, with the
+    trigger period taken as the median fluorescence interval over `channels` (LEDs
+    in the rotation). Each fluorescence frame pairs with the reflectance frame at
+    the trigger offset after it in the rotation (from the first frame of each
+    channel), as the demultiplexer pairs them with fluorescence first; a frame
+    whose partner was dropped is left out.
+    """
+    f_ticks = unwrap_ticks(f_records["cam_timestamp"])
+    if len(f_ticks) < 2 or len(r_records) == 0:
+        return np.arange(0), np.arange(0)
+    # unwrapped from the fluorescence start, so both channels count from the same origin
+    r_ticks = unwrap_ticks(r_records["cam_timestamp"], int(f_ticks[0]) - (1 << 31))
+    period = np.median(np.diff(f_ticks)) / channels
+    origin = min(f_ticks[0], r_ticks[0])
+    f_numbers = np.rint((f_ticks - origin) / period).astype(np.int64)
+    r_numbers = np.rint((r_ticks - origin) / period).astype(np.int64)
+    offset = int(r_numbers[0] - f_numbers[0]) % channels
+    f_index = np.arange(len(f_numbers))
+    r_index = np.minimum(np.searchsorted(r_numbers, f_numbers + offset), len(r_numbers) - 1)
+    paired = r_numbers[r_index] == f_numbers + offset
+    return f_index[paired], r_index[paired]
+
+
+class _Source:
+    """One channel of a recording: every `step`-th frame from `first` (opened once per worker task)."""
+
+    def __init__(self, source):
+        prefix, self.first, self.step = source
+        self.recording = open_recording(prefix)
+
+    def __len__(self):
+        return max(0, (len(self.recording) - self.first + self.step - 1) // self.step)
+
+    @property
+    def records(self):
+        return self.recording.records[self.first::self.step][:len(self)]
+
+    def chunk(self, indices, rows, bin_factor):
+        """Frames at ascending channel `indices` (read as one strided span), rows `rows`, as float32."""
+        start, stop = int(indices[0]), int(indices[-1]) + 1
+        frames = np.asarray(self.recording.frames[self.first + start * self.step:self.first + stop * self.step:self.step,
+                                                  rows])
+        if stop - start != len(indices):
+            frames = frames[indices - start]  # skip the frames that lost their partner
+        if bin_factor == 1:
+            return frames.astype(np.float32)
+        out = np.empty(frames.shape[:-2] + binned_shape(*frames.shape[-2:], bin_factor), np.float32)
+        return bin_frames(frames, bin_factor, out)
+
+
+def _tile_chunks(fluorescence, reflectance, rows, pairs, bin_factor, chunk_frames):
+    f_src, r_src = _Source(fluorescence), _Source(reflectance)
+    f_index, r_index = pairs
+    for start in range(0, len(f_index), chunk_frames):
+        stop = min(start + chunk_frames, len(f_index))
+        yield (start, stop, f_src.chunk(f_index[start:stop], rows, bin_factor),
+               r_src.chunk(r_index[start:stop], rows, bin_factor))
+
+
+def _tile_sums(fluorescence, reflectance, rows, pairs, bin_factor, chunk_frames, width):
+    regression = HemoRegression(binned_shape(rows.stop - rows.start, width, bin_factor))
+    for _, _, fs, rs in _tile_chunks(fluorescence, reflectance, rows, pairs, bin_factor, chunk_frames):
+        regression.add_batch(fs.astype(np.float64), rs.astype(np.float64))
+    return regression.coefficients()
+
+
+def _tile_correct(fluorescence, reflectance, rows, pairs, bin_factor, chunk_frames, coefficients, out_path,
+                  out_shape):
+    out = np.memmap(out_path, dtype=np.float32, mode="r+", shape=out_shape)
+    out_rows = slice(rows.start // bin_factor, rows.stop // bin_factor)
+    for start, stop, fs, rs in _tile_chunks(fluorescence, reflectance, rows, pairs, bin_factor, chunk_frames):
+        # fs and rs are this task's own float32 copies, so correct in place into fs
+        correct(fs, rs, *coefficients, fs, rs)
+        out[start:stop, out_rows] = fs
+    out.flush()
+
+
+def correct_recording(fluorescence, reflectance, out_prefix, bin_factor=1, tile_rows=128, chunk_frames=256,
+                      workers=None, channels=None):
+    """Hemodynamic-correct a recording into a float32 recording at `out_prefix`.
+
+    `fluorescence` and `reflectance` are (prefix, first frame, step) sources: use
+    (P, 0, 2) and (P, 1, 2) for one interleaved recording, or (P_fluorescence, 0, 1)
+    and (P_reflectance, 0, 1) for the per-channel files the demultiplexer writes.
+    Frames are paired by LED cycle with pair_frames(); `channels` is the number of
+    LEDs in the rotation (default: the fluorescence step if above 1, else 2). The
+    output holds one frame per pair, with the fluorescence frame's record.
+    The image is split into bands of `tile_rows` rows, one task per band per pass.
+    Call it under `if __name__ == "__main__":` on Windows (it starts processes).
+    """
+    f_src, r_src = _Source(fluorescence), _Source(reflectance)
+    channels = channels or (fluorescence[2] if fluorescence[2] > 1 else 2)
+    pairs = pair_frames(f_src.records, r_src.records, channels)
+    num_pairs = len(pairs[0])
+    f_rec = f_src.recording
+    height = f_rec.frame_height - f_rec.frame_height % bin_factor
+    tile_rows = max(bin_factor, tile_rows - tile_rows % bin_factor)
+    tiles = [slice(y, min(y + tile_rows, height)) for y in range(0, height, tile_rows)]
+    out_shape = (num_pairs,) + binned_shape(f_rec.frame_height, f_rec.frame_width, bin_factor)
+    out_path = out_prefix + ".raw"
+
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    np.memmap(out_path, dtype=np.float32, mode="w+", shape=out_shape).flush()
+    with ProcessPoolExecutor(workers or os.cpu_count()) as pool:
+        sums = [pool.submit(_tile_sums, fluorescence, reflectance, rows, pairs, bin_factor, chunk_frames,
+                            f_rec.frame_width) for rows in tiles]
+        passes = [pool.submit(_tile_correct, fluorescence, reflectance, rows, pairs, bin_factor, chunk_frames,
+                              future.result(), out_path, out_shape) for rows, future in zip(tiles, sums)]
+        for future in passes:
+            future.result()
+
+    records = f_src.records[pairs[0]]
+    write_recording_files(out_prefix, records, out_shape[2], out_shape[1], np.float32,
+                          source=os.path.basename(fluorescence[0]), correction="hemodynamic",
+                          bin_factor=bin_factor)
+    return out_prefix
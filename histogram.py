@@ -0,0 +1,56 @@
+"""Live intensity histogram and saturation monitor, for setting gain and exposure.
+
+Runs as a throttled FrameStage on a strided subsample of the newest frame, so its
+cost is a fixed few bincounts per second however fast the camera runs, and
+`cpu_fraction()` reports what it actually takes.
+"""
+import numpy as np
+
+from stage import FrameStage
+
+
+class HistogramStage(FrameStage):
+    """Histogram of every `stride`-th pixel of the newest frame, `rate` times a second.
+
+    Pixel values are binned into `bins` (a power of two) equal-width bins over the
+    `bits`-bit range. A pixel counts as saturated at `saturation` or above (default:
+    the largest `bits`-bit value). `latest` is (seq, counts, saturated fraction);
+    the counts arrays alternate between two preallocated buffers, so each stays
+    valid until the next-but-one update.
+    """
+
+    name = "HistogramStage"
+
+    def __init__(self, ring, rate=2.0, stride=8, bins=256, bits=None, saturation=None):
+        super().__init__(ring, max_rate=rate)
+        fmt = ring.pixel_format
+        height, width = ring.pixel_shape
+        pixel_dtype = fmt.dtype if fmt is not None else ring.frames.dtype
+        self.stride = stride
+        self.bits = bits or (fmt.bits if fmt is not None else pixel_dtype.itemsize * 8)
+        self.bins = bins
+        self.shift = max(self.bits - (bins.bit_length() - 1), 0)
+        self.saturation = saturation or (1 << self.bits) - 1
+        self.saturated = 0.0
+        self.latest = None
+        self.histograms = 0
+        sample_shape = (-(-height // stride), -(-width // stride))
+        self._sample = np.empty(sample_shape, pixel_dtype)
+        self._clipped = np.empty(sample_shape, bool)
+        self._counts = np.zeros((2, bins), np.int64)
+        self._unpacked = np.empty((height, width), fmt.dtype) if fmt is not None and fmt.packed else None
+
+    def process(self, seq, frame):
+        sample = self._sample
+        np.copyto(sample, self.ring.unpacked(frame, self._unpacked)[::self.stride, ::self.stride])
+        np.greater_equal(sample, self.saturation, out=self._clipped)
+        saturated = np.count_nonzero(self._clipped) / sample.size
+        np.right_shift(sample, self.shift, out=sample)
+        counts = self._counts[self.histograms % 2]
+        counts[:] = np.bincount(sample.ravel(), minlength=self.bins)[:self.bins]
+        self.histograms += 1
+        self.saturated = saturated
+        self.latest = (seq, counts, saturated)
+
+    def summary(self):
+        return f"saturated {self.saturated:.2%}, monitor CPU {self.cpu_fraction():.1%}"
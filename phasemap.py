@@ -0,0 +1,160 @@
+"""Per-pixel amplitude and phase at one stimulus frequency (periodic-stimulus / retinotopic mapping).
+
+Instead of keeping the movie for an FFT, each frame x(t) is added into a single
+DFT bin as it arrives:
+
+    X = Σ x(t) e^(-2πi f t)
+
+with t the frame's own camera time, so dropped frames leave no phase error (a
+plain Goertzel recursion assumes evenly spaced samples). Memory is two float32
+accumulators and a running sum per pixel whatever the session length. The mean
+image leaks into the bin when the recording is not a whole number of cycles;
+subtracting mean · Σ e^(-2πi f t) removes it exactly.
+"""
+import time
+
+import cv2
+import numpy as np
+
+from binning import bin_frames, binned_shape
+from recording import open_recording
+from stage import FrameStage
+from timestamps import CAMERA_TICK, unwrap_ticks
+
+
+class PhaseAccumulator:
+    """Running single-bin DFT at `frequency` Hz of frames of `shape`, optionally binned."""
+
+    def __init__(self, shape, frequency, bin_factor=1):
+        self.frequency = frequency
+        self.bin_factor = bin_factor
+        self.shape = binned_shape(*shape, bin_factor)
+        self.frames = 0
+        self.t0 = None
+        self.t = None  # time of the newest frame
+        self.weights = 0j  # Σ e^(-2πi f t), to take the mean back out of the bin
+        self.real = np.zeros(self.shape, np.float32)
+        self.imag = np.zeros(self.shape, np.float32)
+        self.total = np.zeros(self.shape, np.float64)
+        self._f = np.zeros(self.shape, np.float32)
+        self._tmp = np.zeros(self.shape, np.float32)
+
+    def add(self, frame, t):
+        """Add one frame taken at `t` seconds (any clock; the first frame's time is phase zero)."""
+        if self.bin_factor > 1:
+            bin_frames(frame, self.bin_factor, self._f)
+        else:
+            np.copyto(self._f, frame, casting="unsafe")
+        if self.t0 is None:
+            self.t0 = t
+        self.t = t
+        angle = 2 * np.pi * self.frequency * (t - self.t0)
+        c, s = np.cos(angle), -np.sin(angle)
+        self.weights += complex(c, s)
+        np.multiply(self._f, c, out=self._tmp)
+        self.real += self._tmp
+        np.multiply(self._f, s, out=self._tmp)
+        self.imag += self._tmp
+        self.total += self._f
+        self.frames += 1
+
+    def add_batch(self, frames, times):
+        """Add (k, ...) frames at once (allocates a binned copy of the batch; for offline chunks)."""
+        if len(frames) == 0:
+            return
+        if self.bin_factor > 1:
+            binned = np.empty((len(frames),) + self.shape, np.float32)
+            frames = bin_frames(frames, self.bin_factor, binned)
+        if self.t0 is None:
+            self.t0 = times[0]
+        self.t = times[-1]
+        angle = 2 * np.pi * self.frequency * (np.asarray(times, np.float64) - self.t0)
+        c, s = np.cos(angle).astype(np.float32), -np.sin(angle).astype(np.float32)
+        self.weights += complex(c.sum(), s.sum())
+        self.real += np.tensordot(c, frames, axes=1)
+        self.imag += np.tensordot(s, frames, axes=1)
+        self.total += frames.sum(axis=0, dtype=np.float64)
+        self.frames += len(frames)
+
+    def cycles(self):
+        """Stimulus cycles covered so far."""
+        return 0.0 if self.t is None else self.frequency * (self.t - self.t0)
+
+    def maps(self, relative=True):
+        """(amplitude, phase) per pixel; amplitude as a fraction of the mean when `relative`, phase in -π..π."""
+        n = max(self.frames, 1)
+        mean = self.total / n
+        spectrum = self.real - mean * self.weights.real + 1j * (self.imag - mean * self.weights.imag)
+        amplitude = 2 * np.abs(spectrum) / n
+        if relative:
+            amplitude /= np.maximum(mean, 1e-9)
+        return amplitude.astype(np.float32), np.angle(spectrum).astype(np.float32)
+
+
+def phase_image(amplitude, phase, top=None):
+    """RGB uint8 rendering: hue from phase, brightness from amplitude (scaled so `top` is full)."""
+    top = top or np.percentile(amplitude, 99) or 1.0
+    hsv = np.empty(amplitude.shape + (3,), np.uint8)
+    hsv[..., 0] = ((phase + np.pi) * (180 / (2 * np.pi))).astype(np.uint8) % 180  # OpenCV hue is 0..179
+    hsv[..., 1] = 255
+    hsv[..., 2] = np.clip(amplitude * (255 / top), 0, 255).astype(np.uint8)
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
+
+
+class PhaseMapStage(FrameStage):
+    """Feeds every frame of a ring to a PhaseAccumulator, timed by the camera clock.
+
+    Amplitude and phase maps are published `output_hz` times a second as `latest`
+    = (seq, amplitude, phase), alternating between two preallocated pairs of
+    buffers like DffStage.
+    """
+
+    name = "PhaseMapStage"
+
+    def __init__(self, ring, accumulator, output_hz=1.0, on_map=None):
+        super().__init__(ring)
+        self.accumulator = accumulator
+        self.output_interval = 1.0 / output_hz
+        self.on_map = on_map
+        self.latest = None
+        self.maps_published = 0
+        self._maps = np.zeros((2, 2) + accumulator.shape, np.float32)
+        self._last_tick = None
+        self._last_output = 0.0
+        self._unpacked = None
+        fmt = ring.pixel_format
+        if fmt is not None and fmt.packed:
+            self._unpacked = np.empty(ring.pixel_shape, fmt.dtype)
+
+    def process(self, seq, frame):
+        tick = int(unwrap_ticks([self.ring.cam_timestamps[seq % self.ring.capacity]], self._last_tick)[0])
+        self._last_tick = tick
+        self.accumulator.add(self.ring.unpacked(frame, self._unpacked), tick * CAMERA_TICK)
+        now = time.perf_counter()
+        if now - self._last_output < self.output_interval:
+            return
+        self._last_output = now
+        out = self._maps[self.maps_published % 2]
+        out[0], out[1] = self.accumulator.maps()
+        self.maps_published += 1
+        self.latest = (seq, out[0], out[1])
+        if self.on_map is not None:
+            self.on_map(seq, out[0], out[1])
+
+
+def phase_map(prefix, frequency, bin_factor=1, first=0, step=1, chunk_frames=256, t0=None):
+    """(amplitude, phase) maps of a recording in one streaming pass over chunks of frames.
+
+    Use `first`/`step` to take one LED channel of an interleaved recording, and `t0`
+    (camera-clock seconds, as in Recording.timestamps("camera")) to measure phase
+    from the stimulus start rather than the first frame.
+    """
+    recording = open_recording(prefix)
+    times = recording.timestamps("camera")[first::step]
+    accumulator = PhaseAccumulator((recording.frame_height, recording.frame_width), frequency, bin_factor)
+    accumulator.t0 = t0
+    for start in range(0, len(times), chunk_frames):
+        stop = min(start + chunk_frames, len(times))
+        frames = np.asarray(recording.frames[first + start * step:first + stop * step:step], np.float32)
+        accumulator.add_batch(frames, times[start:stop])
+    return accumulator.maps()
@@ -0,0 +1,158 @@
+"""Pixel formats of tSdkFrameHead.uiMediaType and vectorized unpack kernels.
+
+Every format knows how its frames are stored (storage dtype and bytes per row) and
+how to turn stored rows into plain uint8/uint16 pixels. Unpacking works on any
+leading shape, so the same call handles one frame (h, row) or a whole chunk
+(n, h, row). Unpacked 16-bit formats are returned as views, without copying.
+
+The media type codes are the ones in mvsdk.py, repeated here so recordings can be
+read on machines without the camera SDK.
+"""
+import numpy as np
+
+_MONO = 0x01000000
+_OCCUPY8BIT = 0x00080000
+_OCCUPY10BIT = 0x000A0000
+_OCCUPY12BIT = 0x000C0000
+_OCCUPY16BIT = 0x00100000
+
+
+def _unpack_12_packed(raw, out):
+    # GigE Vision Mono12Packed: 2 pixels in 3 bytes
+    # b0 = p0[11:4], b1 = p1[3:0] << 4 | p0[3:0], b2 = p1[11:4]
+    g = raw.reshape(raw.shape[:-1] + (-1, 3))
+    o = out.reshape(out.shape[:-1] + (-1, 2))
+    b1 = g[..., 1]
+    np.left_shift(g[..., 0], 4, out=o[..., 0], dtype=np.uint16)
+    o[..., 0] |= b1 & 0x0F
+    np.left_shift(g[..., 2], 4, out=o[..., 1], dtype=np.uint16)
+    o[..., 1] |= b1 >> 4
+
+
+def _unpack_10_packed(raw, out):
+    # GigE Vision Mono10Packed: 2 pixels in 3 bytes
+    # b0 = p0[9:2], b1 = p1[1:0] << 4 | p0[1:0], b2 = p1[9:2]
+    g = raw.reshape(raw.shape[:-1] + (-1, 3))
+    o = out.reshape(out.shape[:-1] + (-1, 2))
+    b1 = g[..., 1]
+    np.left_shift(g[..., 0], 2, out=o[..., 0], dtype=np.uint16)
+    o[..., 0] |= b1 & 0x03
+    np.left_shift(g[..., 2], 2, out=o[..., 1], dtype=np.uint16)
+    o[..., 1] |= (b1 >> 4) & 0x03
+
+
+def _unpack_10_mipi(raw, out):
+    # MIPI RAW10: 4 pixels in 5 bytes, b0..b3 = pk[9:2], b4 holds the four 2-bit remainders
+    g = raw.reshape(raw.shape[:-1] + (-1, 5))
+    o = out.reshape(out.shape[:-1] + (-1, 4))
+    low = g[..., 4]
+    for k in range(4):
+        np.left_shift(g[..., k], 2, out=o[..., k], dtype=np.uint16)
+        o[..., k] |= (low >> (2 * k)) & 0x03
+
+
+class PixelFormat:
+    """Storage layout and unpack kernel for one media type."""
+
+    def __init__(self, name, media_type, bits, group_pixels=1, group_bytes=None, kernel=None):
+        self.name = name
+        self.media_type = media_type
+        self.bits = bits
+        self.dtype = np.dtype(np.uint8 if bits <= 8 else np.uint16)  # unpacked pixels
+        self.packed = kernel is not None
+        self.storage_dtype = np.dtype(np.uint8) if self.packed else self.dtype
+        self.group_pixels = group_pixels
+        self.group_bytes = group_bytes or self.dtype.itemsize
+        self._kernel = kernel
+
+    def __repr__(self):
+        return f"PixelFormat({self.name})"
+
+    def stored_shape(self, height, width):
+        """(rows, row length in storage_dtype units) of one stored frame."""
+        if width % self.group_pixels:
+            raise ValueError(f"{self.name} needs a width divisible by {self.group_pixels}, got {width}")
+        if self.packed:
+            return height, width // self.group_pixels * self.group_bytes
+        return height, width
+
+    def frame_nbytes(self, height, width):
+        rows, row = self.stored_shape(height, width)
+        return rows * row * self.storage_dtype.itemsize
+
+    def width_from_stored(self, stored_width):
+        """Pixel width of a frame whose stored rows are `stored_width` storage units long."""
+        if self.packed:
+            return stored_width // self.group_bytes * self.group_pixels
+        return stored_width
+
+    def unpack(self, raw, out=None):
+        """Unpack stored rows (..., h, row) into pixels (..., h, w).
+
+        Unpacked formats come back as a view of `raw`. For packed formats `out`, if
+        given, must be a C-contiguous array of the output shape and dtype.
+        """
+        if raw.dtype != self.storage_dtype:
+            raw = raw.view(self.storage_dtype)
+        if not self.packed:
+            return raw
+        shape = raw.shape[:-1] + (self.width_from_stored(raw.shape[-1]),)
+        if out is None:
+            out = np.empty(shape, dtype=self.dtype)
+        elif out.shape != shape or out.dtype != self.dtype or not out.flags.c_contiguous:
+            raise ValueError(f"out must be a C-contiguous {self.dtype} array of shape {shape}")
+        self._kernel(np.ascontiguousarray(raw), out)
+        return out
+
+
+def _formats():
+    formats = [
+        PixelFormat("MONO8", _MONO | _OCCUPY8BIT | 0x0001, 8),
+        PixelFormat("MONO10", _MONO | _OCCUPY16BIT | 0x0003, 10),
+        PixelFormat("MONO10_PACKED", _MONO | _OCCUPY12BIT | 0x0004, 10, 2, 3, _unpack_10_packed),
+        PixelFormat("MONO12", _MONO | _OCCUPY16BIT | 0x0005, 12),
+        PixelFormat("MONO12_PACKED", _MONO | _OCCUPY12BIT | 0x0006, 12, 2, 3, _unpack_12_packed),
+        PixelFormat("MONO14", _MONO | _OCCUPY16BIT | 0x0025, 14),
+        PixelFormat("MONO16", _MONO | _OCCUPY16BIT | 0x0007, 16),
+    ]
+    # Bayer raw data is stored the same way as mono; demosaicing is left to analysis
+    for i, order in enumerate(("GR", "RG", "GB", "BG")):
+        formats += [
+            PixelFormat(f"BAY{order}8", _MONO | _OCCUPY8BIT | (0x0008 + i), 8),
+            PixelFormat(f"BAY{order}10", _MONO | _OCCUPY16BIT | (0x000C + i), 10),
+            PixelFormat(f"BAY{order}12", _MONO | _OCCUPY16BIT | (0x0010 + i), 12),
+            PixelFormat(f"BAY{order}16", _MONO | _OCCUPY16BIT | (0x002E + i), 16),
+            PixelFormat(f"BAY{order}10_MIPI", _MONO | _OCCUPY10BIT | (0x0026 + i), 10, 4, 5, _unpack_10_mipi),
+            PixelFormat(f"BAY{order}10_PACKED", _MONO | _OCCUPY12BIT | (0x0026 + i), 10, 2, 3, _unpack_10_packed),
+            PixelFormat(f"BAY{order}12_PACKED", _MONO | _OCCUPY12BIT | (0x002A + i), 12, 2, 3, _unpack_12_packed),
+        ]
+    return formats
+
+
+FORMATS = {fmt.media_type: fmt for fmt in _formats()}
+FORMATS_BY_NAME = {fmt.name: fmt for fmt in FORMATS.values()}
+
+
+def from_media_type(media_type):
+    """PixelFormat for a tSdkFrameHead.uiMediaType / tSdkMediaType.iMediaType value."""
+    try:
+        return FORMATS[media_type]
+    except KeyError:
+        raise ValueError(f"unsupported media type 0x{media_type:08X}") from None
+
+
+def from_name(name):
+    try:
+        return FORMATS_BY_NAME[name]
+    except KeyError:
+        raise ValueError(f"unknown pixel format {name!r}") from None
+
+
+def pack_12(frames):
+    """Inverse of the MONO12_PACKED kernel, for tests and synthetic data."""
+    p = frames.astype(np.uint16).reshape(frames.shape[:-1] + (-1, 2))
+    out = np.empty(p.shape[:-1] + (3,), dtype=np.uint8)
+    out[..., 0] = p[..., 0] >> 4
+    out[..., 1] = (p[..., 0] & 0x0F) | ((p[..., 1] & 0x0F) << 4)
+    out[..., 2] = p[..., 1] >> 4
+    return out.reshape(frames.shape[:-1] + (-1,))
@@ -0,0 +1,146 @@
+"""Live preview: the newest frame, downscaled to the preview size, as an 8-bit QImage.
+
+The preview is a throttled FrameStage, so it only ever looks at the newest frame
+and never makes the acquisition or the recorders wait. Each frame is downscaled
+into one reused buffer, mapped to 8 bits into the buffer a QImage was built over
+once, and handed to the GUI thread; while the GUI still holds the previous image
+new frames are skipped rather than queued.
+
+The 8-bit mapping is a lookup table with one entry per pixel value (65536 for
+16-bit data), rebuilt only when the window changes, so drawing a frame is a
+single np.take whatever the contrast settings or colormap.
+"""
+import time
+
+import cv2
+import numpy as np
+from PyQt5.QtGui import QImage
+
+from stage import FrameStage
+
+RESIZABLE_DTYPES = (np.uint8, np.uint16, np.int16, np.float32, np.float64)  # what cv2.resize accepts
+
+
+class DisplayMap:
+    """Lookup table from `bits`-bit pixel values to 8-bit gray, or RGB through a colormap.
+
+    `colormap` is an OpenCV colormap id (cv2.COLORMAP_INFERNO, ...). The window
+    (pixel values shown as black and white) is set directly with set_window() or
+    set_level(), or from the data with auto_levels().
+    """
+
+    def __init__(self, bits=16, colormap=None):
+        self.bits = min(bits, 16)
+        self.size = 1 << self.bits
+        self.colors = None
+        if colormap is not None:
+            ramp = np.arange(256, dtype=np.uint8).reshape(-1, 1)
+            self.colors = np.ascontiguousarray(cv2.applyColorMap(ramp, colormap)[:, 0, ::-1])  # BGR -> RGB
+        self.channels = 1 if self.colors is None else 3
+        self._values = np.arange(self.size, dtype=np.float32)
+        self.lut = None
+        self.window = None
+        self.set_window(0, self.size - 1)
+
+    def set_window(self, low, high):
+        """Show `low` and below as black, `high` and above as white (or the colormap ends)."""
+        low, high = float(low), max(float(high), float(low) + 1)
+        ramp = (self._values - low) * (255.0 / (high - low))
+        np.clip(ramp, 0, 255, out=ramp)
+        gray = ramp.astype(np.uint8)
+        # swap in a complete table, so a frame being drawn never sees a half-built one
+        self.lut = gray if self.colors is None else self.colors[gray]
+        self.window = (low, high)
+
+    def set_level(self, level, width):
+        self.set_window(level - width / 2, level + width / 2)
+
+    def auto_levels(self, pixels, low=0.5, high=99.5, step=4):
+        """Set the window to the `low`..`high` percentiles of every `step`-th pixel of `pixels`."""
+        counts = np.bincount(pixels[::step, ::step].ravel(), minlength=self.size)
+        cumulative = np.cumsum(counts)
+        total = cumulative[-1]
+        self.set_window(np.searchsorted(cumulative, total * low / 100),
+                        np.searchsorted(cumulative, total * high / 100))
+
+    def apply(self, pixels, out):
+        """Map integer `pixels` into `out` (shape of pixels, plus 3 for RGB) with one table lookup."""
+        return np.take(self.lut, pixels, axis=0, out=out, mode="clip")
+
+
+class PreviewStage(FrameStage):
+    """Renders the newest frame of `ring` into `image` at most `rate` times a second.
+
+    `size` is the (width, height) box the preview must fit in; frames are shrunk by
+    an integer factor to fit (never enlarged). `bits` is the significant bit depth of
+    the pixels. They are shown through `display`, a DisplayMap in gray or through
+    `colormap`, with a fixed `window` (default: the full range) or, with
+    `auto_levels` set, a window that follows the 0.5..99.5 percentiles of the
+    preview, re-estimated every `auto_levels` seconds.
+    `on_image(image)` is called from the stage thread, typically to emit a Qt
+    signal; the receiver calls displayed() once it has copied the image (e.g. into
+    a QPixmap).
+    """
+
+    name = "PreviewStage"
+
+    def __init__(self, ring, size=(800, 600), rate=30.0, bits=None, on_image=None, colormap=None, window=None,
+                 auto_levels=1.0):
+        super().__init__(ring, max_rate=rate)
+        fmt = ring.pixel_format
+        height, width = ring.pixel_shape
+        pixel_dtype = fmt.dtype if fmt is not None else ring.frames.dtype
+        self.step = max(1, -(-width // size[0]), -(-height // size[1]))
+        self.shape = (-(-height // self.step), -(-width // self.step))
+        self.bits = bits or (fmt.bits if fmt is not None else pixel_dtype.itemsize * 8)
+        self.shift = max(self.bits - 16, 0)  # lookup tables stop at 16 bits
+        self.display = DisplayMap(self.bits - self.shift, colormap)
+        if window:
+            self.display.set_window(*window)
+        self.auto_levels = auto_levels
+        self._last_levels = 0.0
+        self.on_image = on_image
+        self.images = 0
+        self.seq = None  # sequence number of the frame in `image`
+        self._resize = pixel_dtype.type in RESIZABLE_DTYPES and self.step > 1
+        self._small = np.empty(self.shape, pixel_dtype)
+        self._unpacked = np.empty((height, width), fmt.dtype) if fmt is not None and fmt.packed else None
+        channels = self.display.channels
+        self._pixels = np.zeros(self.shape + ((channels,) if channels > 1 else ()), np.uint8)
+        self.image = QImage(self._pixels.data, self.shape[1], self.shape[0], self.shape[1] * channels,
+                            QImage.Format_Grayscale8 if channels == 1 else QImage.Format_RGB888)
+        self._shown = True
+
+    def displayed(self):
+        """Called by the receiver once it no longer needs `image`; the next frame may then be drawn."""
+        self._shown = True
+
+    def downscale(self, frame):
+        """Shrink a frame into the reused preview-size buffer."""
+        frame = self.ring.unpacked(frame, self._unpacked)
+        if self._resize:
+            cv2.resize(frame, self.shape[::-1], dst=self._small, interpolation=cv2.INTER_AREA)
+        else:
+            np.copyto(self._small, frame[::self.step, ::self.step], casting="unsafe")
+        return self._small
+
+    def render(self, small):
+        """Map downscaled pixels to 8 bits in the image buffer."""
+        if self.shift:
+            np.right_shift(small, self.shift, out=small)
+        now = time.perf_counter()
+        if self.auto_levels and now - self._last_levels >= self.auto_levels:
+            self._last_levels = now
+            self.display.auto_levels(small)
+        self.display.apply(small, self._pixels)
+
+    def process(self, seq, frame):
+        if not self._shown:
+            self.skipped += 1  # the GUI is still drawing the last one
+            return
+        self.render(self.downscale(frame))
+        self.seq = seq
+        self.images += 1
+        if self.on_image is not None:
+            self._shown = False
+            self.on_image(self.image)
@@ -1,17 +1,30 @@
 import numpy as np
 import matplotlib.pyplot as plt
 
+from recording import Recording
+from timestamps import analyze
 
 
 save_dir = "C:/Users/maxst/VS-data/"
-metadata = np.load(save_dir+'M240416_SPK_IDR3_FB1_metadata.npy', allow_pickle=True).item()
-num_frames = metadata['num_frames']
-frame_width = metadata['frame_width']
-frame_height = metadata['frame_height']
-data_type = metadata['data_type']
-frame_timestamps = metadata['frame_timestamps']
-sys_timestamps = metadata['sys_clock_timestamps']
+rec = Recording(save_dir+'M240416_SPK_IDR3_FB1')
+num_frames = len(rec)
+frame_width = rec.frame_width
+frame_height = rec.frame_height
+data_type = rec.dtype
+frame_timestamps = rec.timestamps("camera")
+sys_timestamps = rec.timestamps("sys")
 
-print(num_frames, len(frame_timestamps))    
-plt.plot(np.diff(frame_timestamps)[:])
-plt.show()
\ No newline at end of file
+fps = 25  # ARDUINO: F_LED the session was acquired at
+timing = analyze(rec, fps)
+print(num_frames, len(frame_timestamps))
+print(timing.summary())
+for index, missing in timing.drops:
+    print(f"  {missing} frame(s) dropped before frame {index} (t = {frame_timestamps[index] - frame_timestamps[0]:.3f} s)")
+
+fig, (ax_interval, ax_residual) = plt.subplots(2, 1, sharex=True)
+ax_interval.plot(np.diff(frame_timestamps)[:])
+ax_interval.plot(timing.drops[:, 0] - 1, np.diff(frame_timestamps)[timing.drops[:, 0] - 1], "rx")
+ax_interval.set_ylabel("frame interval (s)")
+ax_residual.plot(timing.clock.residuals(frame_timestamps, sys_timestamps) * 1e3)
+ax_residual.set_ylabel("host - fitted camera clock (ms)")
+plt.show()
@@ -0,0 +1,170 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+from recording import FRAME_DTYPE, write_recording_files
+
+
+def required_bandwidth(width, height, bytes_per_pixel, fps):
+    """Bytes per second the disk has to sustain for a given stream."""
+    return width * height * bytes_per_pixel * fps
+
+
+class RawRecorder:
+    """Streams frames from a FrameRing into a single raw file on a dedicated writer thread.
+
+    The writer drains the ring through its own RingReader, so the camera callback
+    never waits on the disk. Frames are written in batches straight out of the ring
+    slots (one write per contiguous run, no staging copy) and the file is grown ahead
+    of the writer in large preallocated extents. Once a batch is on disk, its
+    tSdkFrameHead rows are appended to P_heads.bin and its FRAME_DTYPE records to
+    P_frames.bin, so a recording cut short by a crash keeps an index of every frame
+    it holds (Recording reads P_frames.bin when it is there). On stop() the file is
+    trimmed and the index is turned into P_frames.npy (layout in recording.py).
+
+    If the writer falls more than a ring behind, the frames it missed are counted in
+    `overruns`; a batch whose slots were recycled while being written is counted in
+    `torn`.
+    """
+
+    SUFFIX = ".raw"
+
+    def __init__(self, ring, prefix, batch_frames=32, preallocate_bytes=1 << 30):
+        self.ring = ring
+        self.prefix = prefix
+        self.path = prefix + self.SUFFIX
+        self.batch_frames = batch_frames
+        self.preallocate_bytes = max(preallocate_bytes, ring.frame_nbytes * batch_frames)
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.torn = 0
+        self._allocated = 0
+        self._reader = None
+        self._fd = None
+        self._heads_fd = None
+        self._index_fd = None
+        self._running = False
+        self._thread = None
+        self._started_at = None
+
+    @property
+    def overruns(self):
+        return self._reader.overruns if self._reader else 0
+
+    @property
+    def backlog(self):
+        """Frames acquired but not yet written; steadily growing means the disk can't keep up."""
+        return self._reader.pending() if self._reader else 0
+
+    def start(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+        self._fd = os.open(self.path, flags, 0o644)
+        self._heads_fd = os.open(self.prefix + "_heads.bin", flags, 0o644)
+        self._index_fd = os.open(self.prefix + "_frames.bin", flags, 0o644)
+        self.write_metadata()  # header of an empty recording, until stop() writes the real one
+        self._reader = self.ring.reader()
+        self._running = True
+        self._started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="RawRecorder", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Flush everything already in the ring, close the file and write the sidecar."""
+        self._running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._fd is not None:
+            if self._allocated:
+                os.ftruncate(self._fd, self.bytes_written)  # drop the unused preallocated tail
+            os.close(self._fd)
+            os.close(self._heads_fd)
+            os.close(self._index_fd)
+            self._fd = self._heads_fd = self._index_fd = None
+            self.write_metadata()
+            os.remove(self.prefix + "_frames.bin")  # now in P_frames.npy
+
+    def _preallocate(self, needed):
+        if needed <= self._allocated:
+            return
+        size = self._allocated + max(self.preallocate_bytes, needed - self._allocated)
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(self._fd, self._allocated, size - self._allocated)
+        else:
+            os.ftruncate(self._fd, size)  # Windows: extend the file so NTFS reserves the clusters
+        self._allocated = size
+
+    def _write(self, data, fd=None):
+        view = memoryview(data).cast("B")
+        fd = self._fd if fd is None else fd
+        while view:
+            n = os.write(fd, view)
+            view = view[n:]
+
+    def _records(self, seqs):
+        """Ring slots, header rows and FRAME_DTYPE records of `seqs`."""
+        ring = self.ring
+        slots = [seq % ring.capacity for seq in seqs]
+        records = np.empty(len(seqs), dtype=FRAME_DTYPE)
+        records["seq"] = seqs
+        records["cam_timestamp"] = ring.cam_timestamps[slots]
+        records["sys_timestamp"] = ring.sys_timestamps[slots]
+        return slots, ring.heads[slots], records
+
+    def _append_index(self, heads, records):
+        """Append header rows and records of frames that are already on disk to the index files."""
+        self._write(heads, self._heads_fd)
+        self._write(records, self._index_fd)
+
+    def _take_records(self, seqs):
+        """Index `seqs` (written already) and return their ring slots."""
+        slots, heads, records = self._records(seqs)
+        self._append_index(heads, records)
+        return slots
+
+    def _run(self):
+        ring = self.ring
+        contiguous = ring.frames.flags.c_contiguous
+        while self._running or self._reader.pending():
+            seqs = self._reader.read_many(self.batch_frames, timeout=0.1)
+            if not seqs:
+                continue
+            self._preallocate(self.bytes_written + len(seqs) * ring.frame_nbytes)
+            slots = [seq % ring.capacity for seq in seqs]
+            first = slots[0]
+            if contiguous:
+                # at most two runs: up to the end of the ring, then from its start
+                head = min(len(slots), ring.capacity - first)
+                self._write(ring.frames[first:first + head])
+                if head < len(slots):
+                    self._write(ring.frames[:len(slots) - head])
+            else:
+                for slot in slots:
+                    self._write(np.ascontiguousarray(ring.frames[slot]))
+            self._take_records(seqs)  # indexed only once the frames are written
+            if not ring.is_valid(seqs[0]):
+                self.torn += min(len(seqs), ring.oldest_seq() - seqs[0])
+            self.frames_written += len(seqs)
+            self.bytes_written += len(seqs) * ring.frame_nbytes
+
+    def throughput(self):
+        """Average bytes per second written since start()."""
+        if not self._started_at:
+            return 0.0
+        return self.bytes_written / max(time.time() - self._started_at, 1e-9)
+
+    def write_metadata(self, **extra):
+        height, width = self.ring.shape
+        data_type = self.ring.frames.dtype
+        fmt = self.ring.pixel_format
+        if fmt is not None:
+            # packed frames are stored as delivered and unpacked by the reader
+            width = fmt.width_from_stored(width)
+            data_type = fmt.dtype
+            extra["pixel_format"] = fmt.name
+        records = np.fromfile(self.prefix + "_frames.bin", dtype=FRAME_DTYPE)
+        write_recording_files(self.prefix, records, width, height, data_type,
+                              overruns=self.overruns, torn=self.torn, **extra)
@@ -0,0 +1,203 @@
+"""On-disk recording layout and a lazy, memory-mapped reader for it.
+
+A recording with prefix `P` is three files:
+
+    P.raw             frames back to back, C order, num_frames x frame_height x frame_width
+                      of data_type, no header, so it can be np.memmap'ed directly
+    P_frames.npy      one FRAME_DTYPE record per frame (plain .npy, no pickle); while
+                      recording they are appended to P_frames.bin instead, which is
+                      what a recording cut short by a crash is left with
+    P_heads.bin       the frame's tSdkFrameHead as one FRAME_HEAD_DTYPE record per frame,
+                      same order as P_frames.npy, no header (see framehead.py); zeroed
+                      rows where the acquisition path had no header (polling)
+    P_recording.yml   recording-wide fields: format, num_frames, frame_width,
+                      frame_height, data_type, created, and pixel_format when the
+                      frames are stored packed (e.g. MONO12_PACKED, see pixelformat.py)
+
+Recordings from before this layout (P.raw plus a pickled P_metadata.npy dict) are
+still readable. A compressed recording replaces P.raw with P.chunks plus a chunk
+index and has `storage: chunked` in its header (see chunked.py); open_recording()
+picks the right reader.
+"""
+import os
+import time
+
+import numpy as np
+import yaml
+
+import pixelformat
+from framehead import load_heads
+from timestamps import CAMERA_TICK, unwrap_ticks
+
+FORMAT_VERSION = 1
+
+# Per-frame record, written to P_frames.npy
+FRAME_DTYPE = np.dtype([
+    ("seq", np.int64),  # acquisition sequence number; gaps mean the writer missed frames
+    ("cam_timestamp", np.uint32),  # tSdkFrameHead.uiTimeStamp, 0.1 ms ticks, wraps at 2**32
+    ("sys_timestamp", np.float64),  # host time.time() when the frame reached the ring
+])
+
+
+def write_recording_files(prefix, frame_records, frame_width, frame_height, data_type, **extra):
+    """Write the per-frame index and the recording header for the frames already in P.raw."""
+    np.save(prefix + "_frames.npy", np.asarray(frame_records, dtype=FRAME_DTYPE), allow_pickle=False)
+    header = {
+        "format": FORMAT_VERSION,
+        "num_frames": int(len(frame_records)),
+        "frame_width": int(frame_width),
+        "frame_height": int(frame_height),
+        "data_type": str(np.dtype(data_type)),
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    header.update(extra)
+    with open(prefix + "_recording.yml", "w") as f:
+        yaml.safe_dump(header, f)
+
+
+def _load_legacy(prefix):
+    # Sessions written before P_frames.npy existed: a pickled dict from our own recorder
+    metadata = np.load(prefix + "_metadata.npy", allow_pickle=True).item()
+    records = np.zeros(metadata["num_frames"], dtype=FRAME_DTYPE)
+    records["seq"] = np.arange(len(records))
+    n = min(len(records), len(metadata["frame_timestamps"]))
+    records["cam_timestamp"][:n] = np.asarray(metadata["frame_timestamps"][:n])
+    records["sys_timestamp"][:n] = np.asarray(metadata["sys_clock_timestamps"][:n])
+    header = {key: metadata[key] for key in ("num_frames", "frame_width", "frame_height", "data_type")}
+    header["format"] = 0
+    return header, records
+
+
+class _UnpackedFrames:
+    """Array-like over packed stored frames that unpacks only the frames indexed."""
+
+    def __init__(self, raw, pixel_format, width):
+        self.raw = raw
+        self.pixel_format = pixel_format
+        self.shape = raw.shape[:2] + (width,)
+        self.dtype = pixel_format.dtype
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        frames = self.pixel_format.unpack(np.asarray(self.raw[key]))
+        if not rest:
+            return frames
+        return frames[(slice(None),) + rest] if frames.ndim == 3 else frames[rest]
+
+
+class Recording:
+    """Memory-mapped view of a recording; opening it reads only the header.
+
+    Index it like an array (rec[100], rec[1000:2000:2]) to get frames, or select a
+    time window with rec.between(t0, t1). Only the pages actually touched are read.
+    """
+
+    def __init__(self, prefix):
+        if prefix.endswith(".raw"):
+            prefix = prefix[:-4]
+        self.prefix = prefix
+        if os.path.exists(prefix + "_recording.yml"):
+            with open(prefix + "_recording.yml") as f:
+                self.header = yaml.safe_load(f)
+            self.records = np.load(prefix + "_frames.npy", mmap_mode="r")
+            if os.path.exists(prefix + "_frames.bin"):
+                # never stopped: the streamed index says how many frames made it to disk
+                self.records = np.fromfile(prefix + "_frames.bin", dtype=FRAME_DTYPE)
+                self.header["num_frames"] = len(self.records)
+        else:
+            self.header, self.records = _load_legacy(prefix)
+        self.num_frames = self.header["num_frames"]
+        self.frame_width = self.header["frame_width"]
+        self.frame_height = self.header["frame_height"]
+        self.dtype = np.dtype(self.header["data_type"])
+        self.pixel_format = None
+        stored_shape, stored_dtype = (self.frame_height, self.frame_width), self.dtype
+        if "pixel_format" in self.header:
+            self.pixel_format = pixelformat.from_name(self.header["pixel_format"])
+            stored_shape = self.pixel_format.stored_shape(self.frame_height, self.frame_width)
+            stored_dtype = self.pixel_format.storage_dtype
+        # `raw` is the data as stored; `frames` unpacks packed formats on access
+        self.raw = self._open_frames((self.num_frames,) + stored_shape, stored_dtype)
+        self.frames = self.raw
+        if self.pixel_format is not None and self.pixel_format.packed:
+            self.frames = _UnpackedFrames(self.raw, self.pixel_format, self.frame_width)
+        self._time_index = {}
+        self._heads = None
+
+    def _open_frames(self, shape, dtype):
+        if not self.num_frames:
+            return np.zeros(shape, dtype)  # np.memmap refuses empty files
+        return np.memmap(self.prefix + ".raw", dtype=dtype, mode="r", shape=shape)
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, key):
+        return self.frames[key]
+
+    @property
+    def shape(self):
+        return self.frames.shape
+
+    @property
+    def heads(self):
+        """Per-frame tSdkFrameHead records (FRAME_HEAD_DTYPE), memory-mapped on first use."""
+        if self._heads is None:
+            if not os.path.exists(self.prefix + "_heads.bin"):
+                raise FileNotFoundError(f"{self.prefix} has no frame header log")
+            self._heads = load_heads(self.prefix + "_heads.bin")
+        return self._heads
+
+    def timestamps(self, clock="sys"):
+        """Per-frame times in seconds: host clock ("sys") or unwrapped camera clock ("camera")."""
+        if clock == "sys":
+            return np.asarray(self.records["sys_timestamp"])
+        if clock == "camera":
+            return unwrap_ticks(self.records["cam_timestamp"]) * CAMERA_TICK
+        raise ValueError(f"unknown clock {clock!r}")
+
+    def _sorted_times(self, clock):
+        times = self._time_index.get(clock)
+        if times is None:
+            # the host clock can step backwards (NTP); clamp so searchsorted stays valid
+            times = self._time_index[clock] = np.maximum.accumulate(self.timestamps(clock))
+        return times
+
+    def index_range(self, t0, t1, clock="sys"):
+        """Frame index range [start, stop) whose timestamps fall in [t0, t1)."""
+        start, stop = np.searchsorted(self._sorted_times(clock), [t0, t1], side="left")
+        return range(int(start), int(stop))
+
+    def between(self, t0, t1, clock="sys"):
+        """Frames with timestamps in [t0, t1), as a memory-mapped view."""
+        frames = self.index_range(t0, t1, clock)
+        return self.frames[frames.start:frames.stop]
+
+    def iter_chunks(self, chunk_frames=256, start=0, stop=None):
+        """Yield (start index, frames) in chunks, for streaming passes over the whole file."""
+        stop = self.num_frames if stop is None else min(stop, self.num_frames)
+        for i in range(start, stop, chunk_frames):
+            yield i, self.frames[i:min(i + chunk_frames, stop)]
+
+
+def open_recording(prefix):
+    """Open a raw, chunked or SVD recording with the matching reader."""
+    if prefix.endswith(".raw") or prefix.endswith(".chunks"):
+        prefix = prefix.rsplit(".", 1)[0]
+    header_path = prefix + "_recording.yml"
+    if os.path.exists(header_path):
+        with open(header_path) as f:
+            storage = yaml.safe_load(f).get("storage")
+        if storage == "chunked":
+            from chunked import ChunkedRecording
+            return ChunkedRecording(prefix)
+        if storage == "svd":
+            from svd import SVDRecording
+            return SVDRecording(prefix)
+    return Recording(prefix)
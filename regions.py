@@ -0,0 +1,212 @@
+"""Region (ROI / atlas area) time series straight from the frame stream.
+
+The masks are compiled once into a sparse projection. When regions don't
+overlap and are unweighted (an atlas, a label image), the frame is cut into
+runs of consecutive pixels with the same label: one np.add.reduceat over each
+frame, read front to back, sums every run, and a second one over the (few
+thousand) run sums groups them by region. Overlapping or weighted masks are
+kept as one array of pixel indices grouped region by region; a batch is then
+one gather of those pixels (np.take into a reused buffer) and one reduceat over
+the groups. Either way the cost doesn't grow with the number of regions.
+
+Traces are logged as TRACE records (seq, cam_timestamp, one float32 per region)
+to P_traces.bin, with the region names in P_traces.yml.
+"""
+import os
+import threading
+
+import numpy as np
+import yaml
+
+from recording import open_recording
+from stage import FrameStage
+
+
+def trace_dtype(num_regions):
+    """Record of one frame's region means."""
+    return np.dtype([("seq", np.int64), ("cam_timestamp", np.uint32), ("values", np.float32, (num_regions,))])
+
+
+def load_traces(prefix):
+    """(records, names) of a trace log; records["values"] is frames x regions."""
+    with open(prefix + "_traces.yml") as f:
+        names = yaml.safe_load(f)["regions"]
+    return np.fromfile(prefix + "_traces.bin", dtype=trace_dtype(len(names))), names
+
+
+class RegionProjector:
+    """Mean (or weighted mean) of each region for batches of frames of `shape`.
+
+    `index` holds the flat pixel indices of region 0, then region 1, ...; `sizes`
+    how many belong to each. Build it with from_masks() or from_labels().
+    """
+
+    def __init__(self, shape, index, sizes, names=None, weights=None):
+        sizes = np.asarray(sizes)
+        if (sizes == 0).any():
+            raise ValueError(f"regions {np.flatnonzero(sizes == 0).tolist()} have no pixels")
+        self.shape = tuple(shape)
+        self.names = [str(name) for name in (names if names is not None else range(len(sizes)))]
+        self.sizes = sizes
+        self.index = np.asarray(index, np.intp)
+        self.starts = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(np.intp)
+        self.weights = None
+        self.norm = 1.0 / sizes
+        if weights is not None:
+            self.weights = np.asarray(weights, np.float32)
+            self.norm = 1.0 / np.add.reduceat(self.weights.astype(np.float64), self.starts)
+        self._gathered = None
+        self._weighted = None
+        self._runs = None
+        if weights is None and len(np.unique(self.index)) == len(self.index):
+            self._compile_runs()
+
+    def _compile_runs(self):
+        """Run starts over the flat frame, and the order and group starts that sum runs into regions."""
+        labels = np.full(int(np.prod(self.shape)), -1, np.int64)
+        labels[self.index] = np.repeat(np.arange(len(self.sizes)), self.sizes)
+        labels = labels.reshape(self.shape)
+        # runs never cross a row end, so an integer run sum stays below width x the largest pixel value
+        change = np.ones(self.shape, bool)
+        change[:, 1:] = labels[:, 1:] != labels[:, :-1]
+        bounds = np.flatnonzero(change)
+        run_labels = labels.ravel()[bounds]
+        kept = np.flatnonzero(run_labels >= 0)
+        self._runs = bounds
+        self._run_order = kept[np.argsort(run_labels[kept], kind="stable")]
+        counts = np.bincount(run_labels[kept], minlength=len(self.sizes))
+        self._run_starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.intp)
+        self._run_sums = None
+
+    @classmethod
+    def from_masks(cls, masks, names=None, weights=None):
+        """Regions from (regions, h, w) boolean masks, which may overlap; `weights` (same shape) weight pixels."""
+        masks = np.asarray(masks)
+        pixels = [np.flatnonzero(mask) for mask in masks]
+        if weights is not None:
+            weights = np.asarray(weights, np.float32).reshape(len(masks), -1)
+            weights = np.concatenate([w[p] for w, p in zip(weights, pixels)])
+        return cls(masks.shape[1:], np.concatenate(pixels), [len(p) for p in pixels], names, weights)
+
+    @classmethod
+    def from_labels(cls, labels, names=None):
+        """One region per nonzero value of an integer label image (e.g. an atlas), in increasing order."""
+        labels = np.asarray(labels)
+        flat = labels.ravel()
+        pixels = np.flatnonzero(flat)
+        order = np.argsort(flat[pixels], kind="stable")
+        values, sizes = np.unique(flat[pixels], return_counts=True)
+        return cls(labels.shape, pixels[order], sizes, names if names is not None else values.tolist())
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def _buffer(self, k, dtype):
+        if self._gathered is None or len(self._gathered) < k or self._gathered.dtype != dtype:
+            self._gathered = np.empty((k, len(self.index)), dtype)
+            if self.weights is not None:
+                self._weighted = np.empty((k, len(self.index)), np.float32)
+        return self._gathered[:k]
+
+    def project(self, frames):
+        """(k, regions) float32 region means of (k, h, w) frames."""
+        frames = np.asarray(frames)
+        k = len(frames)
+        if self._runs is not None:
+            return self._project_runs(frames.reshape(k, -1))
+        gathered = self._buffer(k, frames.dtype)
+        np.take(frames.reshape(k, -1), self.index, axis=1, out=gathered)
+        if self.weights is not None:
+            gathered = np.multiply(gathered, self.weights, out=self._weighted[:k])
+        sums = np.add.reduceat(gathered, self.starts, axis=1, dtype=np.float64)
+        sums *= self.norm
+        return sums.astype(np.float32)
+
+    def _project_runs(self, frames):
+        k = len(frames)
+        accumulator = np.uint64 if np.issubdtype(frames.dtype, np.integer) else np.float64
+        if self._run_sums is None or len(self._run_sums) < k or self._run_sums.dtype != accumulator:
+            self._run_sums = np.empty((k, len(self._runs)), accumulator)
+        run_sums = self._run_sums[:k]
+        for frame, out in zip(frames, run_sums):
+            np.add.reduceat(frame, self._runs, dtype=accumulator, out=out)
+        sums = np.add.reduceat(np.take(run_sums, self._run_order, axis=1), self._run_starts, axis=1,
+                               dtype=np.float64)
+        sums *= self.norm
+        return sums.astype(np.float32)
+
+
+class RegionStage(FrameStage):
+    """Extracts region traces from every frame of a ring, a batch at a time.
+
+    `latest` is (seq, values) of the newest frame; log_to(prefix) starts appending
+    every frame's traces to prefix_traces.bin (None stops).
+    """
+
+    name = "RegionStage"
+
+    def __init__(self, ring, projector, batch_frames=32):
+        super().__init__(ring, batch_frames=batch_frames)
+        if tuple(ring.pixel_shape) != tuple(projector.shape):
+            raise ValueError(f"region masks are {projector.shape}, frames are {ring.pixel_shape}")
+        self.projector = projector
+        self.dtype = trace_dtype(len(projector))
+        self.latest = None
+        self._records = np.zeros(batch_frames, self.dtype)
+        self._log = None
+        self._log_lock = threading.Lock()
+        fmt = ring.pixel_format
+        self._unpacked = None
+        if fmt is not None and fmt.packed:
+            self._unpacked = np.empty((batch_frames,) + ring.pixel_shape, fmt.dtype)
+
+    def log_to(self, prefix):
+        """Start appending traces to prefix_traces.bin (None stops logging and closes the file)."""
+        with self._log_lock:
+            if self._log:
+                self._log.close()
+            self._log = None
+            if prefix:
+                with open(prefix + "_traces.yml", "w") as f:
+                    yaml.safe_dump({"regions": self.projector.names}, f)
+                self._log = open(prefix + "_traces.bin", "ab")
+
+    def process_batch(self, seqs):
+        ring = self.ring
+        capacity = ring.capacity
+        records = self._records[:len(seqs)]
+        seq = seqs.start
+        while seq < seqs.stop:
+            # one view per contiguous run of slots (two when the batch wraps around the ring)
+            slot = seq % capacity
+            stop = min(seqs.stop, seq + capacity - slot)
+            frames = ring.frames[slot:slot + stop - seq]
+            if self._unpacked is not None:
+                for frame, out in zip(frames, self._unpacked):
+                    ring.unpacked(frame, out)
+                frames = self._unpacked[:stop - seq]
+            records["values"][seq - seqs.start:stop - seqs.start] = self.projector.project(frames)
+            seq = stop
+        slots = np.arange(seqs.start, seqs.stop) % capacity
+        records["seq"] = ring.seqs[slots]
+        records["cam_timestamp"] = ring.cam_timestamps[slots]
+        self.latest = (seqs.stop - 1, records["values"][-1].copy())
+        with self._log_lock:
+            if self._log:
+                self._log.write(records.tobytes())
+
+
+def extract_recording(prefix, projector, out_prefix=None, chunk_frames=1024):
+    """Region traces of every frame of a recording, written as a trace log at `out_prefix` (default: `prefix`)."""
+    recording = open_recording(prefix)
+    out_prefix = out_prefix or prefix
+    records = np.zeros(len(recording), trace_dtype(len(projector)))
+    records["seq"] = recording.records["seq"][:len(records)]
+    records["cam_timestamp"] = recording.records["cam_timestamp"][:len(records)]
+    for start, frames in recording.iter_chunks(chunk_frames):
+        records["values"][start:start + len(frames)] = projector.project(frames)
+    os.makedirs(os.path.dirname(out_prefix) or ".", exist_ok=True)
+    with open(out_prefix + "_traces.yml", "w") as f:
+        yaml.safe_dump({"regions": projector.names}, f)
+    records.tofile(out_prefix + "_traces.bin")
+    return records
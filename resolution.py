@@ -0,0 +1,110 @@
+"""Sensor-side resolution: ROI crops, hardware binning and skipping.
+
+The sensor ROI and bin/skip mode are set together through CameraSetImageResolutionEx;
+the transfer ROI (CameraSetTransferRoi) only crops what is sent over the link.
+Cutting the data on the camera shrinks bandwidth, host CPU and disk alike, while
+software binning (binning.py) only saves work downstream of the ring.
+"""
+import time
+
+import mvsdk
+
+# Mode argument of CameraSetImageResolutionEx
+MODE_NORMAL = 0
+MODE_BIN_SUM = 1
+MODE_BIN_AVERAGE = 2
+MODE_SKIP = 3
+
+MODES = {"sum": MODE_BIN_SUM, "average": MODE_BIN_AVERAGE, "skip": MODE_SKIP}
+CUSTOM_RESOLUTION = 0xFF  # iIndex for a resolution that isn't one of the presets
+
+
+def _mask_sizes(mask):
+    # bit 0 means 2x2, bit 1 means 3x3, ...
+    return [bit + 2 for bit in range(32) if mask >> bit & 1]
+
+
+def _size_code(size):
+    # ModeSize of CameraSetImageResolutionEx uses the same bits as the capability masks
+    return 1 << (size - 2)
+
+
+def supported_modes(cap):
+    """{"sum": [2, 4], "average": [...], "skip": [...]} from a camera's tSdkCameraCapbility."""
+    resolution_range = cap.sResolutionRange
+    return {
+        "sum": _mask_sizes(resolution_range.uBinSumModeMask),
+        "average": _mask_sizes(resolution_range.uBinAverageModeMask),
+        "skip": _mask_sizes(resolution_range.uSkipModeMask),
+    }
+
+
+def current_size(hCamera):
+    """(width, height) of the frames the camera currently outputs."""
+    resolution = mvsdk.CameraGetImageResolution(hCamera)
+    return resolution.iWidth, resolution.iHeight
+
+
+def set_hardware_binning(hCamera, cap, mode=None, size=2, roi=None):
+    """Switch the camera to `mode` ("sum", "average", "skip", or None for full resolution).
+
+    `roi` is (x, y, width, height) of the field of view in full-resolution sensor
+    pixels (default: the whole sensor). Returns the new output (width, height);
+    raises mvsdk.CameraException if the camera rejects the mode.
+    """
+    resolution_range = cap.sResolutionRange
+    x, y, width, height = roi or (0, 0, resolution_range.iWidthMax, resolution_range.iHeightMax)
+    if mode:
+        sizes = supported_modes(cap)[mode]
+        if size not in sizes:
+            raise ValueError(f"camera has no {size}x{size} {mode} mode (supported: {sizes or 'none'})")
+        err = mvsdk.CameraSetImageResolutionEx(hCamera, CUSTOM_RESOLUTION, MODES[mode], _size_code(size),
+                                               x, y, width, height, 0, 0)
+    else:
+        err = mvsdk.CameraSetImageResolutionEx(hCamera, CUSTOM_RESOLUTION, MODE_NORMAL, 0, x, y, width, height, 0, 0)
+    if err != mvsdk.CAMERA_STATUS_SUCCESS:
+        raise mvsdk.CameraException(err)  # the wrapper only records the error code
+    return current_size(hCamera)
+
+
+def clamp_roi(cap, roi, align=16):
+    """Fit (x, y, width, height) inside the sensor, with origin and size rounded down to `align` pixels."""
+    resolution_range = cap.sResolutionRange
+    x, y, width, height = (int(v) - int(v) % align for v in roi)
+    x = min(max(x, 0), resolution_range.iWidthMax - align)
+    y = min(max(y, 0), resolution_range.iHeightMax - align)
+    width = min(max(width, max(align, resolution_range.iWidthMin)), resolution_range.iWidthMax - x)
+    height = min(max(height, max(align, resolution_range.iHeightMin)), resolution_range.iHeightMax - y)
+    return x, y, width, height
+
+
+def set_transfer_roi(hCamera, roi=None, index=0):
+    """Crop only what is sent over the link (the sensor still reads out in full); None disables it.
+
+    Read the resulting frame size back with current_size() rather than assuming the ROI size.
+    """
+    if roi is None:
+        mvsdk.CameraEnableTransferRoi(hCamera, 0)
+        return
+    x, y, width, height = roi
+    mvsdk.CameraSetTransferRoi(hCamera, index, x, y, x + width, y + height)
+    mvsdk.CameraEnableTransferRoi(hCamera, 1 << index)
+
+
+def measure_max_rate(hCamera, frame_nbytes, seconds=1.0):
+    """Free-run the camera for `seconds` and return (frames per second, bytes per second) it delivered.
+
+    Switches to continuous acquisition for the measurement and restores the trigger
+    mode afterwards; the SDK counts captured frames whether or not anyone reads them.
+    """
+    trigger_mode = mvsdk.CameraGetTriggerMode(hCamera)
+    mvsdk.CameraSetTriggerMode(hCamera, 0)
+    try:
+        before = mvsdk.CameraGetFrameStatistic(hCamera).iCapture
+        start = time.perf_counter()
+        time.sleep(seconds)
+        frames = mvsdk.CameraGetFrameStatistic(hCamera).iCapture - before
+        fps = frames / (time.perf_counter() - start)
+    finally:
+        mvsdk.CameraSetTriggerMode(hCamera, trigger_mode)
+    return fps, fps * frame_nbytes
@@ -0,0 +1,103 @@
+import threading
+import time
+import traceback
+
+
+class FrameStage:
+    """Base for processing stages that consume a FrameRing on their own thread.
+
+    A stage reads through its own RingReader, so it never slows the producer or any
+    other consumer; if it falls more than a ring behind, the frames it missed show up
+    in `overruns`. Subclasses implement process(seq, frame), or process_batch(seqs)
+    to work on several frames at once.
+
+    With `max_rate` set (frames per second) the stage only ever looks at the newest
+    frame and skips the rest; `skipped` counts them. Monitors that only need a fresh
+    sample (histograms, focus scores) use this so their cost stays bounded no matter
+    how fast the camera runs. `busy_seconds` is the time spent processing, for
+    reporting what the stage costs.
+
+    An exception in process()/process_batch() drops that batch and the stage goes
+    on with the next one: the first traceback is printed, and every failed batch is
+    counted in `errors` with the newest message in `last_error`, so a stage that
+    fails on every frame shows up in the stats instead of silently starving the
+    stages downstream.
+    """
+
+    name = "FrameStage"
+
+    def __init__(self, ring, max_rate=None, batch_frames=32):
+        self.ring = ring
+        self.max_rate = max_rate
+        self.batch_frames = batch_frames
+        self.frames = 0
+        self.skipped = 0
+        self.busy_seconds = 0.0
+        self.errors = 0
+        self.last_error = None
+        self._reader = None
+        self._running = False
+        self._thread = None
+        self._started_at = None
+
+    @property
+    def overruns(self):
+        return self._reader.overruns if self._reader else 0
+
+    def start(self):
+        self._reader = self.ring.reader()
+        self._running = True
+        self._started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop after the frames already in the ring (all of them unless throttled) are processed."""
+        self._running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def cpu_fraction(self):
+        """Share of one core spent in process() since start()."""
+        if not self._started_at:
+            return 0.0
+        return self.busy_seconds / max(time.perf_counter() - self._started_at, 1e-9)
+
+    def process(self, seq, frame):
+        raise NotImplementedError
+
+    def process_batch(self, seqs):
+        ring = self.ring
+        for seq in seqs:
+            self.process(seq, ring.frames[seq % ring.capacity])
+
+    def _run(self):
+        reader = self._reader
+        interval = 1.0 / self.max_rate if self.max_rate else 0.0
+        while self._running or (not interval and reader.pending()):
+            if interval:
+                # latest frame wins: drop everything older, then wait out the rest of the interval
+                seqs = reader.read_many(self.ring.capacity, timeout=0.1)
+                if not seqs:
+                    continue
+                self.skipped += len(seqs) - 1
+                seqs = seqs[-1:]
+            else:
+                seqs = reader.read_many(self.batch_frames, timeout=0.1)
+                if not seqs:
+                    continue
+            start = time.perf_counter()
+            try:
+                self.process_batch(seqs)
+            except Exception as e:
+                if not self.errors:
+                    print(f"{self.name} failed on frames {seqs.start}..{seqs.stop - 1}:")
+                    traceback.print_exc()
+                self.errors += 1
+                self.last_error = f"{type(e).__name__}: {e}"
+            elapsed = time.perf_counter() - start
+            self.busy_seconds += elapsed
+            self.frames += len(seqs)
+            if interval and elapsed < interval:
+                time.sleep(interval - elapsed)
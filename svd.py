@@ -0,0 +1,300 @@
+"""Low-rank (SVD) compression of widefield movies.
+
+A movie of T frames of p pixels, minus its mean image, is approximated as
+U · SVt: `rank` spatial components U (p x rank) and their time courses SVt
+(rank x T, singular values folded in). Components come from a randomized range
+finder run as streaming passes over the recording, so RAM holds p x (rank +
+oversample) and T x (rank + oversample) floats, never the movie:
+
+    1. Y = Aᵀ Ω for a Gaussian Ω, and the mean image, in one pass
+    2. `power_iterations` passes of Y = Aᵀ (A Q), Q = orth(Y), for a sharper spectrum
+    3. Bt = A Q in a final pass; the SVD of the small Bt gives U, S and Vt
+
+An SVD recording with prefix P is stored as
+
+    P_U.npy           frame_height x frame_width x rank float32 spatial components
+    P_SVt.npy         rank x num_frames float32 time courses
+    P_mean.npy        frame_height x frame_width float32 mean image
+    P_frames.npy      the source's per-frame records (FRAME_DTYPE)
+    P_recording.yml   the usual header plus storage: svd, rank, source, bin_factor
+
+open_recording() returns an SVDRecording for it: frames are rebuilt on access,
+and traces() projects masks through U without rebuilding any frame.
+"""
+import collections
+import os
+import threading
+
+import numpy as np
+
+from binning import bin_frames, binned_shape
+from recording import FRAME_DTYPE, Recording, open_recording, write_recording_files
+from stage import FrameStage
+
+
+def _orthonormal(y):
+    return np.linalg.qr(y)[0].astype(np.float32)
+
+
+def _components(bt, q, rank):
+    """Spatial components, singular values and time courses from Bt = A Q."""
+    p_, s, rt = np.linalg.svd(bt, full_matrices=False)
+    u = q @ rt[:rank].T
+    svt = (p_[:, :rank] * s[:rank]).T
+    return u.astype(np.float32), s[:rank].astype(np.float32), np.ascontiguousarray(svt, np.float32)
+
+
+def randomized_svd(frames, rank, oversample=10, power_iterations=1, seed=0, overwrite=False):
+    """(U, S, SVt, mean) of (T, p) in-memory frames, by the same randomized algorithm.
+
+    With `overwrite`, float32 `frames` are centred in place instead of copied.
+    """
+    frames = np.asarray(frames, np.float32)
+    mean = frames.mean(axis=0)
+    if overwrite:
+        centered = frames
+        centered -= mean
+    else:
+        centered = frames - mean
+    omega = np.random.default_rng(seed).standard_normal((len(frames), rank + oversample)).astype(np.float32)
+    q = _orthonormal(centered.T @ omega)
+    for _ in range(power_iterations):
+        q = _orthonormal(centered.T @ (centered @ q))
+    u, s, svt = _components(centered @ q, q, rank)
+    return u, s, svt, mean
+
+
+def _binned_chunk(frames, bin_factor):
+    frames = np.asarray(frames)
+    if bin_factor == 1:
+        return frames.reshape(len(frames), -1).astype(np.float32)
+    out = np.empty((len(frames),) + binned_shape(*frames.shape[1:], bin_factor), np.float32)
+    return bin_frames(frames, bin_factor, out).reshape(len(frames), -1)
+
+
+def compress_recording(prefix, out_prefix, rank=200, oversample=20, power_iterations=1, bin_factor=1,
+                       chunk_frames=512, seed=0):
+    """Write an SVD recording of the recording at `prefix` to `out_prefix`; returns the singular values.
+
+    Reads the source 2 + `power_iterations` times, `chunk_frames` frames at a time,
+    optionally binned by `bin_factor` first.
+    """
+    recording = open_recording(prefix)
+    num_frames = len(recording)
+    height, width = binned_shape(recording.frame_height, recording.frame_width, bin_factor)
+    width_l = rank + oversample
+    rng = np.random.default_rng(seed)
+
+    # pass 1: range sketch of the raw frames and their mean; centring is applied afterwards,
+    # since Σ (a_t - mean) ω_t = Σ a_t ω_t - mean Σ ω_t
+    y = np.zeros((height * width, width_l), np.float32)
+    total = np.zeros(height * width, np.float64)
+    omega_sum = np.zeros(width_l, np.float64)
+    for _, frames in recording.iter_chunks(chunk_frames):
+        chunk = _binned_chunk(frames, bin_factor)
+        omega = rng.standard_normal((len(chunk), width_l)).astype(np.float32)
+        y += chunk.T @ omega
+        total += chunk.sum(axis=0, dtype=np.float64)
+        omega_sum += omega.sum(axis=0)
+    mean = (total / max(num_frames, 1)).astype(np.float32)
+    y -= np.outer(mean, omega_sum).astype(np.float32)
+    q = _orthonormal(y)
+
+    # power iterations: each chunk's share of A Q is used straight away, so one pass each
+    for _ in range(power_iterations):
+        y[...] = 0
+        for _, frames in recording.iter_chunks(chunk_frames):
+            chunk = _binned_chunk(frames, bin_factor)
+            chunk -= mean
+            y += chunk.T @ (chunk @ q)
+        q = _orthonormal(y)
+    del y
+
+    bt = np.empty((num_frames, width_l), np.float32)
+    for start, frames in recording.iter_chunks(chunk_frames):
+        chunk = _binned_chunk(frames, bin_factor)
+        chunk -= mean
+        bt[start:start + len(chunk)] = chunk @ q
+    u, s, svt = _components(bt, q, rank)
+
+    write_svd_recording(out_prefix, u.reshape(height, width, -1), svt, mean.reshape(height, width),
+                        recording.records[:num_frames], source=os.path.basename(prefix), bin_factor=bin_factor)
+    return s
+
+
+def write_svd_recording(prefix, u, svt, mean, records, **extra):
+    """Store components `u` (h, w, rank), time courses `svt` (rank, T) and the `mean` image at `prefix`."""
+    os.makedirs(os.path.dirname(prefix) or ".", exist_ok=True)
+    np.save(prefix + "_U.npy", np.asarray(u, np.float32))
+    np.save(prefix + "_SVt.npy", np.asarray(svt, np.float32))
+    np.save(prefix + "_mean.npy", np.asarray(mean, np.float32))
+    write_recording_files(prefix, records, u.shape[1], u.shape[0], np.float32, storage="svd",
+                          rank=int(u.shape[2]), **extra)
+
+
+class _SVDFrames:
+    """Array-like that rebuilds frames mean + U · SVt[:, t] for the indices asked for."""
+
+    def __init__(self, u, svt, mean):
+        self.u = u
+        self.svt = svt
+        self.mean = mean
+        self.shape = (svt.shape[1],) + mean.shape
+        self.dtype = np.dtype(np.float32)
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        u, mean = self.u, self.mean
+        if rest:
+            u, mean = u[rest], mean[rest]
+        weights = self.svt[:, key]
+        frames = np.tensordot(weights, u, axes=([0], [u.ndim - 1])) if weights.ndim == 2 else u @ weights
+        return frames + mean
+
+
+class SVDRecording(Recording):
+    """Recording reader for SVD recordings; same interface as Recording, frames are float32 reconstructions."""
+
+    def _open_frames(self, shape, dtype):
+        self.U = np.load(self.prefix + "_U.npy", mmap_mode="r")
+        self.SVt = np.load(self.prefix + "_SVt.npy", mmap_mode="r")
+        self.mean = np.load(self.prefix + "_mean.npy")
+        return _SVDFrames(self.U, self.SVt, self.mean)
+
+    def traces(self, masks):
+        """(regions, T) mean traces of boolean or weight `masks` (regions, h, w), straight from the components."""
+        masks = np.array(masks, np.float32).reshape(len(masks), -1)
+        masks /= np.maximum(masks.sum(axis=1, keepdims=True), 1e-12)
+        u = np.asarray(self.U).reshape(-1, self.U.shape[2])
+        return (masks @ u) @ self.SVt + (masks @ self.mean.ravel())[:, None]
+
+
+class SVDStage(FrameStage):
+    """Near-real-time SVD of a binned stream: learn components, then project every frame onto them.
+
+    The first `train_frames` frames (binned by `bin_factor`) are kept and
+    decomposed with randomized_svd() on a thread of its own; frames arriving
+    meanwhile wait in a backlog of `backlog_frames` (beyond that they are counted
+    in `skipped` and leave a gap in the seqs). From then on each frame costs one
+    (rank x p) matrix-vector product, and its time course and FRAME_DTYPE record
+    go into preallocated blocks of `block_frames`. Only the latest `max_frames`
+    (rounded up to whole blocks) are kept: older blocks are reused and counted
+    in `dropped`. save(prefix) writes the frames kept as an SVD recording.
+
+    `max_frames` only bounds the time courses (rank float32 per frame). The fit
+    is bounded by `train_frames` instead: it holds the binned training frames
+    (train_frames x p float32, centred in place) plus p x (rank + 10) and
+    train_frames x (rank + 10) sketches, and frees them once installed.
+    """
+
+    name = "SVDStage"
+
+    def __init__(self, ring, rank=100, bin_factor=4, train_frames=1000, block_frames=4096, max_frames=500000,
+                 backlog_frames=256):
+        super().__init__(ring, batch_frames=32)
+        fmt = ring.pixel_format
+        self.rank = rank
+        self.bin_factor = bin_factor
+        self.shape = binned_shape(*ring.pixel_shape, bin_factor)
+        self.train_frames = train_frames
+        self.block_frames = block_frames
+        self.max_blocks = max(1, -(-max_frames // block_frames))
+        self.U = None
+        self.S = None
+        self.mean = None
+        self.projected = 0
+        self.dropped = 0
+        self.skipped = 0
+        self._train = np.zeros((train_frames,) + self.shape, np.float32)
+        self._train_records = np.zeros(train_frames, FRAME_DTYPE)
+        self._trained = 0
+        self._backlog = np.zeros((backlog_frames,) + self.shape, np.float32)
+        self._backlog_records = np.zeros(backlog_frames, FRAME_DTYPE)
+        self._backlogged = 0
+        self._fitter = None
+        self._fitted = None  # (u, s, svt, mean) from the fit thread, installed by the stage thread
+        self._blocks = collections.deque()  # (time courses (rank, block_frames), records (block_frames,))
+        self._lock = threading.Lock()  # guards _blocks and `dropped` against save()
+        self._small = np.zeros(self.shape, np.float32)
+        self._u_flat = None
+        self._unpacked = np.empty(ring.pixel_shape, fmt.dtype) if fmt is not None and fmt.packed else None
+
+    @property
+    def fitting(self):
+        """True while the components are being computed from the training frames."""
+        return self._fitter is not None and self.U is None
+
+    def _record(self, seq):
+        src = seq % self.ring.capacity
+        return seq, self.ring.cam_timestamps[src], self.ring.sys_timestamps[src]
+
+    def _append(self, record, coefficients):
+        column = self.projected % self.block_frames
+        if column == 0:
+            with self._lock:
+                if len(self._blocks) == self.max_blocks:
+                    block = self._blocks.popleft()
+                    self.dropped += self.block_frames
+                else:
+                    block = (np.zeros((self.rank, self.block_frames), np.float32),
+                             np.zeros(self.block_frames, FRAME_DTYPE))
+                self._blocks.append(block)
+        svt, records = self._blocks[-1]
+        svt[:, column] = coefficients
+        records[column] = record
+        self.projected += 1
+
+    def _project(self, small, record):
+        small -= self.mean
+        self._append(record, small.ravel() @ self._u_flat)
+
+    def process(self, seq, frame):
+        if self.U is None and self._fitted is not None:
+            self._install()
+        frame = self.ring.unpacked(frame, self._unpacked)
+        if self.U is not None:
+            bin_frames(frame, self.bin_factor, self._small)
+            self._project(self._small, self._record(seq))
+        elif self._trained < self.train_frames:
+            bin_frames(frame, self.bin_factor, self._train[self._trained])
+            self._train_records[self._trained] = self._record(seq)
+            self._trained += 1
+            if self._trained == self.train_frames:
+                self._fitter = threading.Thread(target=self._fit, name=f"{self.name} fit", daemon=True)
+                self._fitter.start()
+        elif self._backlogged < len(self._backlog):
+            bin_frames(frame, self.bin_factor, self._backlog[self._backlogged])
+            self._backlog_records[self._backlogged] = self._record(seq)
+            self._backlogged += 1
+        else:
+            self.skipped += 1
+
+    def _fit(self):
+        self._fitted = randomized_svd(self._train.reshape(self.train_frames, -1), self.rank, overwrite=True)
+
+    def _install(self):
+        u, self.S, svt, mean = self._fitted
+        self.mean = mean.reshape(self.shape)
+        self._u_flat = u
+        for i, record in enumerate(self._train_records):
+            self._append(record, svt[:, i])  # the training frames keep their own time courses
+        for i in range(self._backlogged):
+            self._project(self._backlog[i], self._backlog_records[i])
+        self._train = self._train_records = self._backlog = self._backlog_records = None
+        self.U = u.reshape(self.shape + (self.rank,))
+
+    def save(self, prefix):
+        """Write the frames kept so far as an SVD recording at `prefix`."""
+        if self.U is None:
+            raise RuntimeError(f"SVDStage needs {self.train_frames} frames before it has components")
+        with self._lock:
+            n = self.projected - self.dropped
+            svt = np.concatenate([block[0] for block in self._blocks], axis=1)[:, :n]
+            records = np.concatenate([block[1] for block in self._blocks])[:n]
+        write_svd_recording(prefix, self.U, svt, self.mean, records, bin_factor=self.bin_factor)
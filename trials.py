@@ -0,0 +1,198 @@
+"""Event-locked trial averages with running per-condition means and variances.
+
+Each trial is a window of frames from `pre` frames before its event to `post`
+frames after. For every condition and every offset in that window, a Welford
+update folds each new frame into a running mean and sum of squared deviations,
+so averages and their spread are available at any time and no trial is kept.
+
+Events are host or camera times; they are mapped to frames through the frame
+timestamps, live (TrialStage, as frames arrive) or offline (average_recording).
+"""
+import collections
+import threading
+
+import numpy as np
+
+from binning import bin_frames, binned_shape
+from recording import open_recording
+from stage import FrameStage
+
+
+class TrialAverager:
+    """Running mean and variance stacks, (pre + post, h, w) per condition, of binned frames.
+
+    add() and save() hold `lock`, so a live stage can keep adding while another
+    thread saves or reads summary().
+    """
+
+    def __init__(self, shape, pre, post, bin_factor=1):
+        if pre < 0 or post < 1:
+            # the event frame itself is offset 0, so the window needs at least one frame after -pre
+            raise ValueError(f"trial window needs pre >= 0 and post >= 1 frames, got pre={pre}, post={post}")
+        self.pre = pre
+        self.post = post
+        self.window = pre + post
+        self.bin_factor = bin_factor
+        self.shape = binned_shape(*shape, bin_factor)
+        self.counts = {}  # condition -> frames averaged at each offset
+        self.means = {}
+        self.m2 = {}
+        self._f = np.zeros(self.shape, np.float32)
+        self._delta = np.zeros(self.shape, np.float32)
+        self._tmp = np.zeros(self.shape, np.float32)
+        self.lock = threading.Lock()
+
+    def _condition(self, condition):
+        if condition not in self.counts:
+            self.counts[condition] = np.zeros(self.window, np.int64)
+            self.means[condition] = np.zeros((self.window,) + self.shape, np.float32)
+            self.m2[condition] = np.zeros((self.window,) + self.shape, np.float32)
+        return self.counts[condition], self.means[condition], self.m2[condition]
+
+    def add(self, condition, offset, frame):
+        """Fold one frame at `offset` frames from its event (-pre <= offset < post) into `condition`, in place."""
+        i = offset + self.pre
+        if self.bin_factor > 1:
+            bin_frames(frame, self.bin_factor, self._f)
+        else:
+            np.copyto(self._f, frame, casting="unsafe")
+        with self.lock:
+            counts, means, m2 = self._condition(condition)
+            counts[i] += 1
+            np.subtract(self._f, means[i], out=self._delta)
+            np.multiply(self._delta, 1.0 / counts[i], out=self._tmp)
+            means[i] += self._tmp
+            np.subtract(self._f, means[i], out=self._tmp)
+            self._tmp *= self._delta
+            m2[i] += self._tmp
+
+    def add_trial(self, condition, frames, first_offset=None):
+        """Fold a whole window (k, ...) of consecutive frames starting at `first_offset` (default -pre)."""
+        offset = -self.pre if first_offset is None else first_offset
+        for i, frame in enumerate(frames):
+            self.add(condition, offset + i, frame)
+
+    def trials(self, condition):
+        """Trials that reached the event frame."""
+        return int(self.counts[condition][self.pre]) if condition in self.counts else 0
+
+    def summary(self):
+        """{condition: trials} snapshot, safe to take while frames are being added."""
+        with self.lock:
+            return {condition: int(counts[self.pre]) for condition, counts in self.counts.items()}
+
+    def mean(self, condition):
+        return self.means[condition]
+
+    def variance(self, condition):
+        counts = self.counts[condition].reshape((-1,) + (1,) * len(self.shape))
+        return self.m2[condition] / np.maximum(counts - 1, 1)
+
+    def save(self, path, **extra):
+        """Write counts, means and variances of every condition to an .npz file."""
+        arrays = {}
+        with self.lock:
+            for condition in self.counts:
+                arrays[f"{condition}_counts"] = self.counts[condition].copy()
+                arrays[f"{condition}_mean"] = self.means[condition].copy()
+                arrays[f"{condition}_variance"] = self.variance(condition)
+        np.savez(path, pre=self.pre, post=self.post, bin_factor=self.bin_factor, **arrays, **extra)
+
+
+class TrialStage(FrameStage):
+    """Live trial averaging of a ring: events come in through add_event() from any thread.
+
+    An event at host time `t` (time.time(), as in the ring's sys_timestamps) is
+    anchored to the first frame stamped at or after it. Its pre-event frames are
+    taken from the ring when that frame arrives (the ring must hold `pre` frames),
+    the rest as they come. `trials_done` counts completed windows.
+    """
+
+    name = "TrialStage"
+
+    def __init__(self, ring, averager):
+        super().__init__(ring)
+        self.averager = averager
+        self.trials_done = 0
+        self.missed = 0  # events whose pre-event frames had already left the ring
+        self._events = collections.deque()
+        self._lock = threading.Lock()
+        self._active = []  # [condition, anchor seq]
+        self._unpacked = None
+        fmt = ring.pixel_format
+        if fmt is not None and fmt.packed:
+            self._unpacked = np.empty(ring.pixel_shape, fmt.dtype)
+
+    def add_event(self, t, condition=0):
+        with self._lock:
+            self._events.append((t, condition))
+
+    def _frame(self, seq):
+        return self.ring.unpacked(self.ring.frames[seq % self.ring.capacity], self._unpacked)
+
+    def _anchor(self, seq):
+        """Start the trials whose event time this frame is the first at or after."""
+        t = self.ring.sys_timestamps[seq % self.ring.capacity]
+        with self._lock:
+            while self._events and self._events[0][0] <= t:
+                _, condition = self._events.popleft()
+                if seq - self.averager.pre < self.ring.oldest_seq():
+                    self.missed += 1
+                    continue
+                for offset in range(-self.averager.pre, 0):
+                    self.averager.add(condition, offset, self._frame(seq + offset))
+                self._active.append([condition, seq])
+
+    def process(self, seq, frame):
+        self._anchor(seq)
+        if not self._active:
+            return
+        averager = self.averager
+        frame = self.ring.unpacked(frame, self._unpacked)
+        still_active = []
+        for condition, anchor in self._active:
+            offset = seq - anchor
+            averager.add(condition, offset, frame)
+            if offset + 1 < averager.post:
+                still_active.append([condition, anchor])
+            else:
+                self.trials_done += 1
+        self._active = still_active
+
+
+def event_frames(times, events):
+    """Index of the first frame at or after each event time (len(times) when there is none)."""
+    return np.searchsorted(np.maximum.accumulate(np.asarray(times)), events, side="left")
+
+
+def load_events(path):
+    """(times, conditions) from a text file of `time condition` lines (comma or whitespace separated)."""
+    times, conditions = [], []
+    with open(path) as f:
+        for line in f:
+            fields = line.replace(",", " ").split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            times.append(float(fields[0]))
+            conditions.append(fields[1] if len(fields) > 1 else "0")
+    return np.array(times), conditions
+
+
+def average_recording(prefix, times, conditions, pre_s, post_s, clock="sys", bin_factor=1, first=0, step=1):
+    """TrialAverager over a recording for events at `times` (seconds on `clock`, see Recording.timestamps).
+
+    Windows are `pre_s` seconds before to `post_s` seconds after each event,
+    converted to frames with the recording's median frame interval. One window is
+    read at a time; `first`/`step` select one LED channel of an interleaved recording.
+    """
+    recording = open_recording(prefix)
+    frame_times = recording.timestamps(clock)[first::step]
+    interval = np.median(np.diff(frame_times)) if len(frame_times) > 1 else 1.0
+    pre, post = int(round(pre_s / interval)), int(round(post_s / interval))
+    averager = TrialAverager((recording.frame_height, recording.frame_width), pre, post, bin_factor)
+    for anchor, condition in zip(event_frames(frame_times, times), conditions):
+        start, stop = anchor - pre, anchor + post
+        if start < 0 or stop > len(frame_times):
+            continue  # window runs off the recording
+        averager.add_trial(condition, recording.frames[first + start * step:first + stop * step:step])
+    return averager